@@ -220,23 +220,23 @@ class Analyzer(common.Worker):
         self.lock.release()
 
     def update_settings(self):
-        cmdline = get_setting("analyzer_commandline", ["clang", "--analyze", "-o", "-"])
-        opts = get_setting("options")
+        cmdline = common.get_setting("analyzer_commandline", ["clang", "--analyze", "-o", "-"])
+        opts = common.get_setting("options")
         for setting in opts:
             cmdline.append(setting)
         self.cmdline = cmdline
-        self.extensions = get_setting("analyzer_extensions")
+        self.extensions = common.get_setting("analyzer_extensions")
 
     def analyze_file(self, filename):
         self.update_settings()
-        self.tasks.put((self.do_analyze_file, filename))
+        self.schedule(self.do_analyze_file, filename)
 
     def analyze_project(self, folders):
         self.update_settings()
-        self.tasks.put((self.do_analyze_project, folders))
+        self.schedule(self.do_analyze_project, folders)
 
     def display_status(self):
-        if get_setting("analyzer_status_messages", True):
+        if common.get_setting("analyzer_status_messages", True):
             super(Analyzer, self).display_status()
 
     def do_analyze_file(self, filename):
@@ -263,17 +263,24 @@ class Analyzer(common.Worker):
         self.set_status("Analyzing %s done" % filename)
 
     def do_analyze_project(self, folders):
+        futures = []
         for dir in folders:
             for dirpath, dirnames, filenames in os.walk(dir):
                 for file in filenames:
                     if "." in file:
                         extension = file[file.rfind(".") + 1:]
                         if extension in self.extensions:
-                            self.tasks.put((self.do_analyze_file, "%s/%s" % (dirpath, file)))
-        if get_cpu_count() > 1:
-            while not self.tasks.empty():
-                time.sleep(0.25)
-        self.tasks.put((self.set_status, "Project analyzed"))
+                            futures.append(self.schedule(self.do_analyze_file, "%s/%s" % (dirpath, file)))
+        if common.get_cpu_count() > 1:
+            # the other worker threads analyze the files while this one waits
+            for f in futures:
+                try:
+                    f.result()
+                except:
+                    pass
+            self.set_status("Project analyzed")
+        else:
+            self.schedule(self.set_status, "Project analyzed")
 
     def get_diagnostic_at_line(self, line):
         for i in range(len(self.diags)):
@@ -320,7 +327,7 @@ class ClangAnalyzeEventListener(sublime_plugin.EventListener):
             end = range[1]
             regions.append(sublime.Region(v.text_point(start[0]-1, start[1]-1), v.text_point(end[0]-1, end[1])))
         v.show(regions[0])
-        v.add_regions("clang.analyzer", regions, get_setting("marker_analyzer_scope", "invalid"), "", sublime.DRAW_OUTLINED)
+        v.add_regions("clang.analyzer", regions, common.get_setting("marker_analyzer_scope", "invalid"), "", sublime.DRAW_OUTLINED)
 
     def on_load(self, view):
         f = view.file_name()
@@ -331,7 +338,7 @@ class ClangAnalyzeEventListener(sublime_plugin.EventListener):
         v = output_view.get_view()
         if not v is None and view.id() == v.id():
             region = v.full_line(v.sel()[0].a)
-            v.add_regions("clang.analyze.selection", [region], get_setting("marker_analyzer_output_panel_scope", "invalid"), "", sublime.DRAW_OUTLINED)
+            v.add_regions("clang.analyze.selection", [region], common.get_setting("marker_analyzer_output_panel_scope", "invalid"), "", sublime.DRAW_OUTLINED)
             row, col = v.rowcol(v.sel()[0].a)
             diag = analyzer.get_diagnostic_at_line(row)
             self.prepare_ranges(diag.get_ranges(row), diag.files)
@@ -45,12 +45,20 @@ from internals import translationunitcache as cache
 from internals.translationunitcache import Language as Language
 from internals.translationunitcache import CompileOptions as CompileOptions
 from internals.translationunitcache import TranslationUnitCache as TUCache
+from internals.common import TaskPriority
+from internals.diskcache import DiskCache
+from internals.parsepool import ParsePool
+from internals.preamble import PreambleCache
+from internals.cachestats import format_stats
+from internals import compiledb
+from internals import systemincludes
 from sublime import Region
 import sublime
 import sublime_plugin
 import errormarkers
 import threading
 import os
+import json
 import re
 import sys
 import Queue as Queue
@@ -84,46 +92,94 @@ def get_language(view):
 
 SystemIncludes = None
 
+# get the SystemIncludes that finds the implicit -isystem paths of clang.
+def get_system_includes():
+    global SystemIncludes
+    if SystemIncludes == None:
+        SystemIncludes = systemincludes.SystemIncludes(
+            os.path.join(get_persistent_cache_path(), "system_includes.json"))
+    return SystemIncludes
+
+# start finding the system includes for the language in the background.
+# Objective C and C++ use the includes of C and C++.
+# Returns a Future for the list of paths.
+def find_system_includes(language):
+    package = os.path.join(sublime.packages_path(), "SublimeClang")
+    config = cindex.Config()
+    config.arch = sublime.arch()
+    if language.kind == Language.C or language.kind == Language.ObjC:
+        return get_system_includes().find(config.locate_clang(), "c",
+            os.path.join(package, "test.c"))
+    return get_system_includes().find(config.locate_clang_cpp(), "c++",
+        os.path.join(package, "test.cpp"))
+
+# forget the collected compile options, for example when the settings change.
+def clear_compile_options():
+    CompileOptionsCache.clear()
 
 # collect all compilation options based on the view and the file
-# the user is currently working on.
-# creates a CompileOptions object.
+# the user is currently working on. The options are collected once
+# and reused until the project file, the compilation database or the
+# settings change or a project file is created closer to the file.
+# returns a CompileOptions object.
 def collect_all_options(view, filename, language):
+    opts = CompileOptionsCache.get(view, filename, language)
+    future = find_system_includes(language)
+    if not future.done():
+        recollect_options(future, view, filename, language)
+    return opts
+
+# the files whose options were made without the system includes.
+RecollectPending = set()
+
+# collect the options of the file again once the system includes are
+# found and reparse the file with them if it's been parsed already.
+def recollect_options(future, view, filename, language):
+    key = (filename, language.key())
+    if key in RecollectPending:
+        return
+    RecollectPending.add(key)
+
+    def recollect():
+        RecollectPending.discard(key)
+        CompileOptionsCache.forget(filename, language)
+        if cache.tuCache == None or cache.tuCache.get_status(filename) == TUCache.STATUS_NOT_IN_CACHE:
+            return
+        opts = collect_all_options(view, filename, language)
+        cache.tuCache.reparse(filename, opts, [], None, TaskPriority.VISIBLE)
+    future.add_done_callback(lambda f: sublime.set_timeout(recollect, 0))
+
+# find the compile_commands.json to use for the file from the
+# project setting sublimeclang_compilation_database or the plugin
+# setting compilation_database. The setting can name the file or the
+# directory it's in. Returns None if there's none.
+def get_compilation_database(view, project_file):
+    path = common.get_setting("compilation_database", "", view)
+    if len(path) == 0:
+        return None
+    path = os.path.expanduser(path)
+    if "${project}" in path and project_file != None:
+        path = path.replace("${project}", os.path.dirname(os.path.abspath(project_file)))
+    return compiledb.get_database(path)
+
+# create the compile options for the file.
+def create_compile_options(view, filename, language):
     assert view is not None
     assert filename is not None
     assert language is not None
     assert language.is_supported()
     assert cindex.conf is not None
 
-    global SystemIncludes
-
-    # use clang to figure out the magical -isystem paths
-    # todo: ObjC and ObjCPP ??
-    if SystemIncludes == None:
-        packages = sublime.packages_path()
-        package  = os.path.join(packages, "SublimeClang")
-        source = ""
-        compiler = ""
-        cindex.conf.arch = sublime.arch()
-        if language.kind == Language.C:
-            source = "test.c"
-            compiler = cindex.conf.locate_clang()
-        elif language.kind == Language.CPP:
-            source = "test.cpp"
-            compiler = cindex.conf.locate_clang_cpp()
-        else:
-            raise Error("Unsupported language.")
-
-        source = os.path.join(package, source)
-        info = common.ClangInfo.collect(compiler, source)
-        SystemIncludes = info.internal_isystem
-        print("Found system includes:")
-        print(SystemIncludes)
-
     # this is how we got it from the settings before...
     #sys_includes = common.get_setting("system_include_paths", [])
 
-    opt = CompileOptions(language, SystemIncludes)
+    # don't hold up the editor waiting for the compiler, the options
+    # are collected again once the system includes are there.
+    system_includes = []
+    future = find_system_includes(language)
+    if future.done():
+        system_includes = future.result()
+    opt = CompileOptions(language, system_includes)
 
     # This is the bitmask sent to index.parse.
     # For example, to be able to go to the definition of
@@ -143,8 +199,20 @@ def collect_all_options(view, filename, language):
     if project_file != None:
         opt.project_file = project_file
         opt.project_options  = project_options
+
+    try:
+        database = get_compilation_database(view, project_file)
+    except cindex.CompilationDatabaseError as err:
+        print("SublimeClang: %s" % err)
+        database = None
+    if database != None:
+        opt.database_file = database.filename
+        opt.database_options = database.get_arguments(filename)
     return opt
 
+# the compile options collected so far.
+CompileOptionsCache = cache.CompileOptionsCache(create_compile_options, find_system_includes)
+
 # initialize cache if not done yet.
 
 def get_cache():
@@ -174,12 +242,8 @@ Visit https://github.com/ensisoft/SublimeClang for more information.""" % (libra
 
     if tulib.cachelib == None:
         libcache = ""
-        packages = sublime.packages_path()
-        package  = os.path.join(packages, "SublimeClang")
-        arch     = sublime.arch()
         try:
-            libname  = tulib.get_cache_library(arch)
-            libcache = os.path.join(package, libname)
+            libcache = get_cache_library_path()
 
             tulib.init_cache_lib(libcache)
             print("Loaded: '%s'" % (libcache))
@@ -199,16 +263,82 @@ Visit https://github.com/ensisoft/SublimeClang for more information.""" % (libca
     if cache.tuCache == None:
         number_threads = 4
         cache.tuCache = TUCache(number_threads)
+        configure_cache(cache.tuCache)
 
     return cache.tuCache
 
-def warm_up_cache(view, filename, language):
+# get the path of the libcache library for our architecture.
+def get_cache_library_path():
+    package = os.path.join(sublime.packages_path(), "SublimeClang")
+    return os.path.join(package, tulib.get_cache_library(sublime.arch()))
+
+# the settings the current parse worker pool was created with.
+parse_pool_config = None
+# the directory the current preamble cache keeps its headers in.
+preamble_config = None
+
+# apply the user settings to the translation unit cache.
+def configure_cache(tucache):
+    global parse_pool_config
+    global preamble_config
+    max_count  = common.get_setting("cache_max_translation_units", 0)
+    max_memory = common.get_setting("cache_max_memory", 0)
+    tucache.set_limits(max_count, max_memory * 1024 * 1024)
+    tucache.set_starvation_limit(common.get_setting("background_starvation_limit", 0))
+    tucache.set_header_context(common.get_setting("header_context", True))
+    if common.get_setting("persistent_cache", False):
+        tucache.set_disk_cache(DiskCache(get_persistent_cache_path()))
+    else:
+        tucache.set_disk_cache(None)
+
+    config = (common.get_setting("parse_workers", 0),
+              common.get_setting("parse_worker_python", "python"),
+              common.get_setting("parse_worker_timeout", 60),
+              common.get_setting("parse_worker_query_timeout", 5))
+    if config != parse_pool_config:
+        parse_pool_config = config
+        count, python, timeout, query_timeout = config
+        pool = None
+        if count > 0:
+            pool = ParsePool(python, sublime.arch(), get_cache_library_path(),
+                count, timeout, query_timeout)
+        tucache.set_parse_pool(pool)
+
+    config = None
+    if common.get_setting("shared_preamble", False):
+        config = os.path.join(get_persistent_cache_path(), "preambles")
+    if config != preamble_config:
+        preamble_config = config
+        preambles = None
+        if config != None:
+            preambles = PreambleCache(config)
+        tucache.set_preamble_cache(preambles)
+
+# get the directory where the persistent translation unit cache is kept.
+def get_persistent_cache_path():
+    path = common.get_setting("persistent_cache_path", "")
+    if len(path) == 0:
+        path = os.path.join(os.path.dirname(sublime.packages_path()), "Cache", "SublimeClang")
+    return os.path.expanduser(path)
+
+# check whether the file is open in any view in any window.
+def is_file_open(filename):
+    for window in sublime.windows():
+        for view in window.views():
+            if view.file_name() != None and get_filename(view) == filename:
+                return True
+    return False
+
+def warm_up_cache(view, filename, language, priority=TaskPriority.INTERACTIVE):
     cache = get_cache()
     state = cache.get_status(filename)
 
     if state == TUCache.STATUS_NOT_IN_CACHE:
         opts = collect_all_options(view, filename, language)
-        cache.prepare(filename, opts)
+        cache.prepare(filename, opts, None, priority)
+    elif state == TUCache.STATUS_PARSING:
+        # make sure the file isn't stuck behind less urgent work
+        cache.promote(filename, priority)
 
     return state
 
@@ -382,10 +512,34 @@ class ClangClearCache(sublime_plugin.TextCommand):
     def run(self, edit):
         if cache.tuCache is None:
             return
-        cache.tuCache.clear()
+        cache.tuCache.clear(True)
         sublime.status_message("Cache cleared!")
 
 
+# show the statistics collected by the cache in an output panel.
+# format is either "text" or "json".
+class ClangCacheStats(sublime_plugin.TextCommand):
+    def run(self, edit, format="text"):
+        if cache.tuCache is None:
+            sublime.status_message("The cache hasn't been started yet")
+            return
+        stats = cache.tuCache.get_stats()
+        if format == "json":
+            text = json.dumps(stats, indent=4, sort_keys=True)
+        else:
+            text = format_stats(stats)
+
+        window = self.view.window()
+        panel = window.get_output_panel("clang_cache_stats")
+        panel.set_read_only(False)
+        e = panel.begin_edit()
+        panel.erase(e, sublime.Region(0, panel.size()))
+        panel.insert(e, 0, text)
+        panel.end_edit(e)
+        panel.set_read_only(True)
+        window.run_command("show_panel", {"panel": "output.clang_cache_stats"})
+
+
 # test for suppressing diagnostics based on suspected clang bugs.
 # todo: are the messages localized??
 def suppress_based_on_clang_bug(source_file, message):
@@ -555,6 +709,15 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
 
         self.dont_complete_startswith = ['operator', '~']
 
+        clear_compile_options()
+
+        # have the system includes ready by the time they're needed.
+        find_system_includes(Language(Language.C))
+        find_system_includes(Language(Language.CPP))
+
+        if cache.tuCache != None:
+            configure_cache(cache.tuCache)
+
 
     def is_enabled(self, view):
         if common.get_setting("enabled", True, view) == False:
@@ -610,16 +773,17 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
         data = view.substr(sublime.Region(0, locations[0]))
 
         results = None
-        results = tu.complete(data, prefix)
+        results = tu.complete(data, prefix, common.get_setting("completion_limit", 0, view))
 
         if results == None:
+            # the cache can't complete this, ask libclang
             row, col = view.rowcol(locations[0] - len(prefix))
             unsaved_files = []
-            # todo fix this
-            #if view.is_dirty():
-            #    unsaved_files.append((sencode(view.file_name()),
-            #      view.substr(Region(0, view.size()))))
-            #    results = tu.cache.clangcomplete(sencode(view.file_name()), row+1, col+1, unsaved_files, is_member_completion(view, locations[0] - len(prefix)))
+            if view.is_dirty():
+                unsaved_files.append((filename, view.substr(Region(0, view.size()))))
+            results = tu.clangcomplete(filename, row+1, col+1, unsaved_files,
+                is_member_completion(view, locations[0] - len(prefix)), prefix,
+                common.get_setting("clang_completion_limit", 100, view))
 
         if len(self.dont_complete_startswith) and results:
             i = 0
@@ -668,28 +832,39 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
         cache = get_cache()
         opts  = collect_all_options(view, filename, language)
 
-        if cache.reparse(filename, opts, unsaved_files, self.reparse_done) == False:
-            self.start_recompile_timer(1) # Already parsing so retry in a bit
+        cache.reparse(filename, opts, unsaved_files, self.reparse_done)
 
     def on_activated(self, view):
         if self.is_enabled(view) == False:
             return
 
-        if self.reparse_on_focus == False:
-            return
         lang = get_language(view)
         if lang.is_supported() == False:
             return
 
+        get_cache().set_file_open(get_filename(view), True)
+
+        if self.reparse_on_focus == False:
+            return
+
         self.view = view
         self.start_recompile_timer(0.1)
 
     def on_post_save(self, view):
+        filename = view.file_name()
+        if filename != None and filename.endswith(".sublime-project"):
+            common.invalidate_project_files(os.path.dirname(get_filename(view)))
+
         if self.is_enabled(view) == False:
             return
 
         if self.reparse_on_save == False:
             return
+
+        # the other files including this one need to be reparsed too.
+        if cache.tuCache != None:
+            cache.tuCache.file_changed(get_filename(view))
+
         lang = get_language(view)
         if lang.is_supported() == False:
             return
@@ -728,18 +903,31 @@ class SublimeClangAutoComplete(sublime_plugin.EventListener):
 
         source = get_filename(view)
 
-        warm_up_cache(view, source, lang)
+        # files opened in the background are warmed up after the one
+        # the user is looking at.
+        priority = TaskPriority.BACKGROUND
+        window = sublime.active_window()
+        if window != None and window.active_view() != None and \
+                window.active_view().id() == view.id():
+            priority = TaskPriority.VISIBLE
+
+        get_cache().set_file_open(source, True)
+        warm_up_cache(view, source, lang, priority)
 
     def on_close(self, view):
-        if self.remove_on_close == False:
-            return
         lang = get_language(view)
         if lang.is_supported() == False:
             return
+        if cache.tuCache == None:
+            return
 
-        if cache.tuCache != None:
-            filename = get_filename(view)
-            cache.tuCache.remove(filename)
+        filename = get_filename(view)
+        if not is_file_open(filename):
+            cache.tuCache.set_file_open(filename, False)
+
+        if self.remove_on_close == False:
+            return
+        cache.tuCache.remove(filename)
 
     def on_query_context(self, view, key, operator, operand, match_all):
         if key == "clang_supported_language":
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2016 Sami Väisänen, Ensisoft
+http://www.ensisoft.com
+"""
+
+import threading
+import time
+
+# Running totals for the durations of one kind of operation.
+class Timing(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max   = 0.0
+        self.last  = 0.0
+
+    def add(self, seconds):
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        self.max   = max(self.max, seconds)
+        self.last  = seconds
+
+    def as_dict(self):
+        mean = 0.0
+        if self.count > 0:
+            mean = self.total / self.count
+        return {"count" : self.count, "total" : self.total, "mean" : mean,
+                "max" : self.max, "last" : self.last}
+
+# Numbers collected by the translation unit cache so that it's possible
+# to see where the time goes.
+class CacheStats(object):
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.files     = {} # filename -> {operation -> Timing}
+        self.waits     = {} # priority name -> Timing
+        self.counters  = {}
+        self.started   = time.time()
+
+    # record how long the operation (parse, reparse, complete...) on
+    # the file took.
+    def record(self, filename, operation, seconds):
+        self.lock.acquire()
+        try:
+            timings = self.files.setdefault(filename, {})
+            timings.setdefault(operation, Timing()).add(seconds)
+        finally:
+            self.lock.release()
+
+    # record how long a task of the priority waited in the queue.
+    def record_wait(self, priority_name, seconds):
+        self.lock.acquire()
+        try:
+            self.waits.setdefault(priority_name, Timing()).add(seconds)
+        finally:
+            self.lock.release()
+
+    def count(self, name, n=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.files    = {}
+            self.waits    = {}
+            self.counters = {}
+            self.started  = time.time()
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        self.lock.acquire()
+        try:
+            files = {}
+            for filename, timings in self.files.items():
+                files[filename] = dict([(op, t.as_dict()) for op, t in timings.items()])
+            waits = dict([(p, t.as_dict()) for p, t in self.waits.items()])
+            return {"seconds"  : time.time() - self.started,
+                    "counters" : dict(self.counters),
+                    "queue_wait" : waits,
+                    "files"    : files}
+        finally:
+            self.lock.release()
+
+# format the statistics returned by TranslationUnitCache.get_stats
+# for reading.
+def format_stats(stats):
+    lines = []
+    lines.append("Collected over %d seconds" % stats["seconds"])
+    lines.append("")
+    lines.append("Translation units: %d live, %.1f MB" % (stats["live_translation_units"],
+        stats["memory_usage"] / (1024.0 * 1024.0)))
+    depth = stats["queue_depth"]
+    lines.append("Queued tasks: %s" % ", ".join(["%s %d" % (name, depth[name]) for name in sorted(depth.keys())]))
+    lines.append("")
+
+    counters = stats["counters"]
+    hits   = counters.get("hits", 0)
+    misses = counters.get("misses", 0)
+    rate = 0.0
+    if hits + misses > 0:
+        rate = 100.0 * hits / (hits + misses)
+    lines.append("Cache: %d hits, %d misses (%.1f%% hit rate)" % (hits, misses, rate))
+    for name in sorted(counters.keys()):
+        if name not in ("hits", "misses"):
+            lines.append("  %s: %d" % (name, counters[name]))
+    lines.append("")
+
+    lines.append("Queue wait (seconds)        count     mean      max")
+    for name in sorted(stats["queue_wait"].keys()):
+        t = stats["queue_wait"][name]
+        lines.append("  %-24s %7d %8.3f %8.3f" % (name, t["count"], t["mean"], t["max"]))
+    lines.append("")
+
+    lines.append("Operation (seconds)         count     mean      max     last")
+    for filename in sorted(stats["files"].keys()):
+        lines.append(filename)
+        timings = stats["files"][filename]
+        for op in sorted(timings.keys()):
+            t = timings[op]
+            lines.append("  %-24s %7d %8.3f %8.3f %8.3f" % (op, t["count"], t["mean"], t["max"], t["last"]))
+    return "\n".join(lines) + "\n"
+
+stats = CacheStats()
@@ -2283,6 +2283,15 @@ class _CXUnsavedFile(Structure):
     """Helper for passing unsaved file arguments."""
     _fields_ = [("name", c_char_p), ("contents", c_char_p), ('length', c_ulong)]
 
+class _CXTUResourceUsageEntry(Structure):
+    """Helper for reading a single translation unit resource usage entry."""
+    _fields_ = [("kind", c_uint), ("amount", c_ulong)]
+
+class _CXTUResourceUsage(Structure):
+    """Helper for reading the resource usage of a translation unit."""
+    _fields_ = [("data", c_void_p), ("numEntries", c_uint),
+                ("entries", POINTER(_CXTUResourceUsageEntry))]
+
 # Functions calls through the python interface are rather slow. Fortunately,
 # for most symboles, we do not need to perform a function call. Their spelling
 # never changes and is consequently provided by this spelling cache.
@@ -2733,6 +2742,23 @@ class TranslationUnit(ClangObject):
 
         return iter(includes)
 
+    @property
+    def resource_usage(self):
+        """
+        Return a dictionary mapping the name of each kind of memory used by
+        this translation unit to the number of bytes it currently uses.
+        """
+        usage = conf.lib.clang_getCXTUResourceUsage(self)
+        try:
+            ret = {}
+            for i in range(usage.numEntries):
+                entry = usage.entries[i]
+                name = conf.lib.clang_getTUResourceUsageName(entry.kind)
+                ret[name] = ret.get(name, 0) + entry.amount
+        finally:
+            conf.lib.clang_disposeCXTUResourceUsage(usage)
+        return ret
+
     def get_file(self, filename):
         """Obtain a File from this translation unit."""
 
@@ -3248,8 +3274,8 @@ functionList = [
   ("clang_disposeCodeCompleteResults",
    [CodeCompletionResults]),
 
-# ("clang_disposeCXTUResourceUsage",
-#  [CXTUResourceUsage]),
+  ("clang_disposeCXTUResourceUsage",
+   [_CXTUResourceUsage]),
 
   ("clang_disposeDiagnostic",
    [Diagnostic]),
@@ -3399,9 +3425,9 @@ functionList = [
    _CXString,
    _CXString.from_result),
 
-# ("clang_getCXTUResourceUsage",
-#  [TranslationUnit],
-#  CXTUResourceUsage),
+  ("clang_getCXTUResourceUsage",
+   [TranslationUnit],
+   _CXTUResourceUsage),
 
   ("clang_getCXXAccessSpecifier",
    [Cursor],
@@ -3952,7 +3978,7 @@ class Config:
 
     # locate clang
     def locate_clang(self):
-        clang = self.get_clang_cpp()
+        clang = self.locate_clang_cpp()
         clang = clang.replace("++", "")
         return clang
 
@@ -36,6 +36,7 @@ import re
 import sys
 import glob
 import json
+import collections
 
 if sys.version[0] == '2':
     def sencode(s):
@@ -162,11 +163,162 @@ class LockedVariable:
         self.l.release()
 
 
+# The result of a task that is scheduled to run on a Worker thread.
+# The caller can wait for the task to complete or register callbacks
+# that are invoked (on the worker thread) once the task is done.
+class Future(object):
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.event     = threading.Event()
+        self.value     = None
+        self.error     = None
+        self.callbacks = []
+
+    def done(self):
+        return self.event.is_set()
+
+    # wait for the task to complete and return its result.
+    # if the task raised an exception it is re-raised here.
+    def result(self, timeout=None):
+        self.event.wait(timeout)
+        if not self.event.is_set():
+            raise RuntimeError("Timed out waiting for the result")
+        if self.error != None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        self.lock.acquire()
+        try:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        callback(self)
+
+    def set_result(self, value):
+        self.value = value
+        self.__finish()
+
+    def set_error(self, error):
+        self.error = error
+        self.__finish()
+
+    def __finish(self):
+        self.lock.acquire()
+        try:
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        for c in callbacks:
+            try:
+                c(self)
+            except:
+                import traceback
+                traceback.print_exc()
+
+
+# The classes of work the Worker threads pick tasks from.
+# Lower value means more urgent.
+class TaskPriority:
+    INTERACTIVE = 0 # the user is waiting for this, e.g. the active view
+    VISIBLE     = 1 # something the user can see but isn't working on
+    BACKGROUND  = 2 # warm ups and house keeping
+
+    LEVELS      = 3
+    NAMES       = ["interactive", "visible", "background"]
+
+
+# A queue of tasks with priorities. The most urgent task is taken first
+# unless a task has been waiting longer than the starvation limit
+# (max_wait seconds) in which case the task that has waited the longest
+# goes first. This keeps background tasks moving even when there's a
+# steady stream of more urgent work.
+class TaskQueue(object):
+    def __init__(self, max_wait=0):
+        self.cond     = threading.Condition()
+        self.queues   = [collections.deque() for i in range(TaskPriority.LEVELS)]
+        self.max_wait = max_wait
+
+    def put(self, item, priority=TaskPriority.VISIBLE):
+        self.cond.acquire()
+        try:
+            self.queues[priority].append((time.time(), item))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    # move a task that is still waiting in the queue to a more urgent
+    # class. Returns True if the task was found.
+    def promote(self, item, priority):
+        self.cond.acquire()
+        try:
+            for level in range(priority + 1, TaskPriority.LEVELS):
+                queue = self.queues[level]
+                for entry in queue:
+                    if entry[1] is item:
+                        queue.remove(entry)
+                        self.queues[priority].append(entry)
+                        return True
+        finally:
+            self.cond.release()
+        return False
+
+    def get(self):
+        return self.get_timed()[1]
+
+    # get the next task and the number of seconds it waited in the queue.
+    def get_timed(self):
+        self.cond.acquire()
+        try:
+            while self.qsize() == 0:
+                self.cond.wait()
+            now = time.time()
+            level = None
+            oldest = None
+            for i, queue in enumerate(self.queues):
+                if len(queue) == 0:
+                    continue
+                if level == None:
+                    level = i
+                queued = queue[0][0]
+                if self.max_wait > 0 and now - queued >= self.max_wait:
+                    if oldest == None or queued < self.queues[oldest][0][0]:
+                        oldest = i
+            if oldest != None:
+                level = oldest
+            queued, item = self.queues[level].popleft()
+            return (now - queued, item)
+        finally:
+            self.cond.release()
+
+    def qsize(self):
+        return sum([len(queue) for queue in self.queues])
+
+    # get the number of tasks waiting in each priority class.
+    def depths(self):
+        self.cond.acquire()
+        try:
+            return [len(queue) for queue in self.queues]
+        finally:
+            self.cond.release()
+
+    def empty(self):
+        return self.qsize() == 0
+
+
 class Worker(object):
     def __init__(self, threadcount=-1):
         if threadcount < 1:
             threadcount = get_cpu_count()
-        self.tasks = Queue.Queue()
+        self.tasks = TaskQueue()
+        # tasks waiting for a previous task with the same key to finish.
+        self.chains = LockedVariable({})
+        # keyed tasks that are waiting in the task queue.
+        self.queued = {}
         for i in range(threadcount):
             t = threading.Thread(target=self.worker)
             t.daemon = True
@@ -179,6 +331,78 @@ class Worker(object):
         self.status = msg
         run_in_main_thread(self.display_status)
 
+    # set the number of seconds a task may wait in the queue
+    # before it's run regardless of its priority. 0 for no limit.
+    def set_starvation_limit(self, seconds):
+        self.tasks.max_wait = seconds
+
+    # schedule the task to be run with the given data on a worker thread.
+    # tasks with the same key (for example the name of the file the task
+    # operates on) are run one at a time in the order they were scheduled.
+    # a later task is chained onto the one in flight instead of occupying
+    # a worker thread while it waits. Returns a Future for the result.
+    def schedule(self, task, data, key=None, priority=TaskPriority.VISIBLE):
+        future = Future()
+        item = (task, data, key, future, priority)
+        if key == None:
+            self.tasks.put(item, priority)
+            return future
+        chains = self.chains.lock()
+        try:
+            if key in chains:
+                chains[key].append(item)
+                # don't let an urgent task wait behind a less
+                # urgent one that hasn't even started yet.
+                self.__promote(key, priority)
+                return future
+            chains[key] = []
+            self.queued[key] = item
+            self.tasks.put(item, priority)
+        finally:
+            self.chains.unlock()
+        return future
+
+    # raise the priority of the queued task with the given key.
+    def promote(self, key, priority):
+        self.chains.lock()
+        try:
+            self.__promote(key, priority)
+        finally:
+            self.chains.unlock()
+
+    def __promote(self, key, priority):
+        item = self.queued.get(key)
+        if item != None:
+            self.tasks.promote(item, priority)
+
+    # start the next task chained on the key if any.
+    def __advance(self, key):
+        chains = self.chains.lock()
+        try:
+            pending = chains[key]
+            if len(pending):
+                # the chain runs as urgently as its most urgent task
+                item = pending.pop(0)
+                priority = min([i[4] for i in pending] + [item[4]])
+                self.queued[key] = item
+                self.tasks.put(item, priority)
+            else:
+                del chains[key]
+        finally:
+            self.chains.unlock()
+
+    # called on the worker thread when a task that waited in the queue
+    # for the given number of seconds is about to run.
+    def task_started(self, priority, waited):
+        pass
+
+    def __started(self, key):
+        self.chains.lock()
+        try:
+            del self.queued[key]
+        finally:
+            self.chains.unlock()
+
     def worker(self):
         try:
             # Just so we give time for the editor itself to start
@@ -188,45 +412,122 @@ class Worker(object):
         except:
             pass
         while True:
-            task, data = self.tasks.get()
+            waited, item = self.tasks.get_timed()
+            task, data, key, future, priority = item
+            if key != None:
+                self.__started(key)
+            self.task_started(priority, waited)
             try:
-                task(data)
+                future.set_result(task(data))
             except:
                 import traceback
                 traceback.print_exc()
+                future.set_error(sys.exc_info()[1])
             finally:
-                self.tasks.task_done()
+                if key != None:
+                    self.__advance(key)
+
+# Maps directories to the project files that apply to them so that
+# looking up the project file for a source file doesn't need to list
+# every ancestor directory on every call. A directory's modification
+# time changes when a file appears in it or disappears from it, so the
+# directories that have been looked at are checked against their
+# modification times, at most every recheck seconds.
+class ProjectFileIndex(object):
+    def __init__(self, recheck=2.0):
+        self.lock     = threading.Lock()
+        self.regex    = re.compile("\\.sublime-project$")
+        self.dirs     = {} # directory -> (project file in it or None, directory mtime)
+        self.resolved = {} # directory -> project file that applies or None
+        self.recheck  = recheck
+        self.checked  = 0
+
+    def __scan(self, dir):
+        try:
+            mtime = os.path.getmtime(dir)
+            entities = os.listdir(dir)
+        except OSError:
+            return (None, None)
+        for e in entities:
+            if self.regex.search(e) == None:
+                continue
+            name = os.path.join(dir, e)
+            if os.path.isfile(name):
+                return (os.path.normpath(name), mtime)
+        return (None, mtime)
+
+    def __revalidate(self):
+        now = time.time()
+        if now - self.checked < self.recheck:
+            return
+        self.checked = now
+        changed = False
+        for dir, (project, mtime) in self.dirs.items():
+            try:
+                current = os.path.getmtime(dir)
+            except OSError:
+                current = None
+            if current != mtime:
+                del self.dirs[dir]
+                changed = True
+        if changed:
+            self.resolved.clear()
+
+    def find(self, source_file):
+        dir = os.path.dirname(source_file)
+        self.lock.acquire()
+        try:
+            self.__revalidate()
+            chain  = []
+            result = None
+            while len(dir) != 0:
+                if dir in self.resolved:
+                    result = self.resolved[dir]
+                    break
+                chain.append(dir)
+                if dir not in self.dirs:
+                    self.dirs[dir] = self.__scan(dir)
+                project = self.dirs[dir][0]
+                if project != None:
+                    result = project
+                    break
+                # move up one folder
+                (head, tail) = os.path.split(dir)
+                if head == dir:
+                    break
+                dir = head
+            for d in chain:
+                self.resolved[d] = result
+            return result
+        finally:
+            self.lock.release()
+
+    # forget what's known about the directory or about all directories
+    # if dir is None.
+    def invalidate(self, dir=None):
+        self.lock.acquire()
+        try:
+            if dir == None:
+                self.dirs.clear()
+            elif dir in self.dirs:
+                del self.dirs[dir]
+            self.resolved.clear()
+        finally:
+            self.lock.release()
+
+project_files = ProjectFileIndex()
 
 # Find the project file for project/user specific settings.
 # The search is performed based on the C++ source file location.
 # and ascends from that folder towards the root.
 # Returns filename with complete path to the file or None if not found.
 def find_project_file(source_file):
-    p = re.compile("\\.sublime-project$")
-    dir = os.path.dirname(source_file)
-    while len(dir) != 0:
-        #print("Trying: " + dir)
-        entities = os.listdir(dir)
-        for e in entities:
-            if e == ".":
-                continue
-            elif e == "..":
-                continue
-            name = os.path.join(dir, e)
-            if os.path.isfile(name) == False:
-                continue
-            #print("Found file: " + e)
-            m = p.search(e)
-            if m == None:
-                continue
-            return os.path.normpath(dir + "/" + e)
-        if (dir == "/"):
-            return None
+    return project_files.find(source_file)
 
-        # move up one folder
-        (head, tail) = os.path.split(dir)
-        dir = head
-    return None
+# Tell the project file lookup that a project file in the directory has
+# been created, changed or deleted.
+def invalidate_project_files(directory=None):
+    project_files.invalidate(directory)
 
 # Read the project specific settings from the project file.
 def read_project_settings(project_file):
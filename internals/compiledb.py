@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2016 Sami Väisänen, Ensisoft
+http://www.ensisoft.com
+"""
+
+from clang import cindex
+import os
+import threading
+
+SOURCE_EXTENSIONS = [".c", ".cc", ".cpp", ".cxx", ".c++", ".m", ".mm"]
+
+# options whose value is the next argument.
+OPTIONS_WITH_VALUE = ["-o", "-I", "-D", "-U", "-include", "-imacros", "-isystem",
+    "-iquote", "-idirafter", "-isysroot", "--sysroot", "-F", "-iframework",
+    "-include-pch", "-iprefix", "-iwithprefix", "-iwithprefixbefore", "-ivfsoverlay",
+    "-x", "-arch", "-MF", "-MT", "-MQ", "-MJ", "-Xclang", "-Xpreprocessor",
+    "-Xassembler", "-Xlinker", "-mllvm", "--param", "-target",
+    "-serialize-diagnostics", "-dependency-file"]
+
+# options whose value is a path that's relative to the build directory.
+PATH_OPTIONS = ["-I", "-include-pch", "-include", "-imacros", "-isystem", "-iquote", "-idirafter",
+    "-isysroot", "--sysroot", "-F", "-iframework", "-ivfsoverlay"]
+
+# options that only make sense when actually building the file.
+BUILD_ONLY_OPTIONS = ["-c", "-M", "-MM", "-MD", "-MMD", "-MP"]
+BUILD_ONLY_OPTIONS_WITH_VALUE = ["-o", "-MF", "-MT", "-MQ", "-MJ", "-Xassembler", "-Xlinker",
+    "-serialize-diagnostics", "-dependency-file"]
+
+def is_source_file(filename):
+    return os.path.splitext(filename)[1].lower() in SOURCE_EXTENSIONS
+
+def make_absolute(path, directory):
+    if os.path.isabs(path):
+        return os.path.normpath(path)
+    return os.path.normpath(os.path.join(directory, path))
+
+# turn the command line of a compile command into the arguments for
+# parsing the file. Returns (source file, arguments).
+def convert_command(directory, args):
+    source = None
+    ret = []
+    i = 1 # skip the compiler
+    while i < len(args):
+        arg = args[i]
+        value = None
+        if arg in OPTIONS_WITH_VALUE and i + 1 < len(args):
+            value = args[i + 1]
+            i = i + 1
+        i = i + 1
+
+        if arg in BUILD_ONLY_OPTIONS or arg in BUILD_ONLY_OPTIONS_WITH_VALUE:
+            continue
+        if arg.startswith("-o") and value == None:
+            continue
+        if value != None:
+            if arg in PATH_OPTIONS:
+                value = make_absolute(value, directory)
+            ret.append(arg)
+            ret.append(value)
+            continue
+        if not arg.startswith("-"):
+            if is_source_file(arg):
+                source = make_absolute(arg, directory)
+            continue
+        if arg in OPTIONS_WITH_VALUE:
+            # missing its value
+            ret.append(arg)
+            continue
+        for opt in PATH_OPTIONS:
+            if opt.startswith("--"):
+                opt = opt + "="
+            if arg.startswith(opt) and len(arg) > len(opt):
+                arg = opt + make_absolute(arg[len(opt):], directory)
+                break
+        ret.append(arg)
+    return (source, ret)
+
+# The compile commands of a compile_commands.json loaded into memory and
+# indexed by the source file.
+class CompilationDatabaseIndex(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime    = os.path.getmtime(filename)
+        self.commands = {} # source file -> arguments
+        self.trees    = {} # directory -> a source file in or below it
+
+        db = cindex.CompilationDatabase.fromDirectory(os.path.dirname(filename))
+        commands = db.getAllCompileCommands()
+        if commands == None:
+            return
+        for cmd in commands:
+            source, args = convert_command(cmd.directory, list(cmd.arguments))
+            if source == None:
+                continue
+            self.commands[source] = args
+
+        for source in sorted(self.commands.keys()):
+            dir = os.path.dirname(source)
+            while dir not in self.trees:
+                self.trees[dir] = source
+                (head, tail) = os.path.split(dir)
+                if head == dir:
+                    break
+                dir = head
+
+    def is_current(self):
+        try:
+            return os.path.getmtime(self.filename) == self.mtime
+        except OSError:
+            return False
+
+    # get the arguments for compiling the file. Files that aren't in the
+    # database (headers) get the arguments of the nearest source file,
+    # preferring a source file with the same name. Returns None if
+    # there's nothing to go by.
+    def get_arguments(self, filename):
+        filename = os.path.normpath(os.path.abspath(filename))
+        if filename in self.commands:
+            return self.commands[filename]
+
+        dir = os.path.dirname(filename)
+        stem = os.path.splitext(filename)[0]
+        for ext in SOURCE_EXTENSIONS:
+            if stem + ext in self.commands:
+                return self.commands[stem + ext]
+        while True:
+            if dir in self.trees:
+                return self.commands[self.trees[dir]]
+            (head, tail) = os.path.split(dir)
+            if head == dir:
+                return None
+            dir = head
+
+databases = {} # compile_commands.json -> CompilationDatabaseIndex
+databases_lock = threading.Lock()
+
+# get the index for the compilation database. The database is loaded
+# the first time it's asked for and again when it has changed.
+def get_database(filename):
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, "compile_commands.json")
+    filename = os.path.normpath(os.path.abspath(filename))
+    databases_lock.acquire()
+    try:
+        db = databases.get(filename)
+        if db == None or not db.is_current():
+            if not os.path.isfile(filename):
+                return None
+            db = CompilationDatabaseIndex(filename)
+            databases[filename] = db
+        return db
+    finally:
+        databases_lock.release()
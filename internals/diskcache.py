@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2016 Sami Väisänen, Ensisoft
+http://www.ensisoft.com
+"""
+
+from clang import cindex
+import hashlib
+import json
+import os
+
+# Keeps parsed translation units around on the disk between editor
+# sessions. Each translation unit is saved as an AST file together with
+# a manifest that lists the file, the fingerprint of the compile options
+# it was parsed with (see CompileOptions.fingerprint) and the
+# modification time and size of every file that went into it. A saved
+# translation unit is only loaded when none of those files have changed.
+class DiskCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __get_paths(self, filename, fingerprint):
+        key = hashlib.sha1(filename + "\0" + fingerprint).hexdigest()
+        base = os.path.join(self.directory, key)
+        return (base + ".ast", base + ".json")
+
+    def __remove(self, files):
+        for f in files:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+    @staticmethod
+    def __get_file_state(filename):
+        try:
+            info = os.stat(filename)
+        except OSError:
+            return None
+        return [int(info.st_mtime), info.st_size]
+
+    # whether the translation unit saved for the file compiled with the
+    # options with the given fingerprint is there and none of the files
+    # it depends on have changed since. Stale entries are removed.
+    def is_current(self, filename, fingerprint):
+        ast, manifest = self.__get_paths(filename, fingerprint)
+        if not os.path.exists(manifest):
+            return False
+        try:
+            f = open(manifest, "r")
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            self.__remove([ast, manifest])
+            return False
+
+        if data.get("filename") != filename or data.get("fingerprint") != fingerprint:
+            return False
+        for dependency, state in data["dependencies"].items():
+            if self.__get_file_state(dependency) != state:
+                self.__remove([ast, manifest])
+                return False
+        return True
+
+    # load the translation unit that was saved for the file compiled with
+    # the options with the given fingerprint. returns None if there's no
+    # such translation unit or if any of the files it depends on have
+    # changed since.
+    def load(self, index, filename, fingerprint):
+        if not self.is_current(filename, fingerprint):
+            return None
+        ast, manifest = self.__get_paths(filename, fingerprint)
+        try:
+            return cindex.TranslationUnit.from_ast_file(ast, index)
+        except cindex.TranslationUnitLoadError:
+            self.__remove([ast, manifest])
+        return None
+
+    # save the translation unit of the file parsed with options with the
+    # given fingerprint. tu is the libclang translation unit.
+    def store(self, tu, filename, fingerprint):
+        # use the modification times libclang saw when it read the files
+        # so that a file changed after the parse invalidates the entry.
+        files = [tu.get_file(filename)]
+        for inc in tu.get_includes():
+            files.append(inc.include)
+
+        dependencies = {}
+        for f in files:
+            state = self.__get_file_state(f.name)
+            if state == None:
+                return False
+            dependencies[f.name] = [f.time, state[1]]
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        ast, manifest = self.__get_paths(filename, fingerprint)
+        self.__remove([ast, manifest])
+        try:
+            tu.save(ast + ".tmp")
+            os.rename(ast + ".tmp", ast)
+        except cindex.TranslationUnitSaveError:
+            self.__remove([ast + ".tmp"])
+            return False
+
+        f = open(manifest, "w")
+        try:
+            json.dump({"filename" : filename, "fingerprint" : fingerprint,
+                "dependencies" : dependencies}, f)
+        finally:
+            f.close()
+        return True
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for f in os.listdir(self.directory):
+            if f.endswith(".ast") or f.endswith(".json") or f.endswith(".tmp"):
+                self.__remove([os.path.join(self.directory, f)])
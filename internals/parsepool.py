@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2016 Sami Väisänen, Ensisoft
+http://www.ensisoft.com
+"""
+
+from cachestats import stats
+from common import *
+from translationunit import Diagnostic
+import json
+import os
+import subprocess
+import threading
+import time
+import Queue
+
+class ParseServerError(Exception):
+    pass
+
+# the process doesn't have the translation unit, it has been restarted
+# since it was parsed.
+class LostTranslationUnit(ParseServerError):
+    pass
+
+# A helper process running parseserver.py. Requests are sent one at a
+# time. A process that doesn't answer in time or that has exited is
+# killed and started again on the next request.
+class ParseProcess(object):
+    def __init__(self, command):
+        self.command  = command
+        self.lock     = threading.Lock()
+        self.process  = None
+        self.replies  = None
+        self.nextId   = 0
+        self.restarts = 0
+
+    def __start(self):
+        startupinfo = None
+        if os.name == "nt":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        self.process = subprocess.Popen(self.command,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, startupinfo=startupinfo)
+        self.replies = Queue.Queue()
+        t = threading.Thread(target=self.__read, args=(self.process, self.replies))
+        t.daemon = True
+        t.start()
+
+    # read the replies from the process until it exits.
+    def __read(self, process, replies):
+        while True:
+            line = process.stdout.readline()
+            if not line:
+                break
+            replies.put(line)
+        replies.put(None)
+
+    def __kill(self, reason):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+        self.process  = None
+        self.restarts = self.restarts + 1
+        stats.count("worker_restarts")
+        print("SublimeClang: parse worker stopped (%s)" % reason)
+
+    def call(self, request, timeout):
+        self.lock.acquire()
+        try:
+            if self.process == None:
+                self.__start()
+            self.nextId = self.nextId + 1
+            request["id"] = self.nextId
+            try:
+                self.process.stdin.write(json.dumps(request) + "\n")
+                self.process.stdin.flush()
+            except IOError:
+                self.__kill("exited")
+                raise ParseServerError("The parse worker has exited")
+            try:
+                line = self.replies.get(True, timeout)
+            except Queue.Empty:
+                self.__kill("timed out on %s of %s" % (request["command"], request["filename"]))
+                raise ParseServerError("The parse worker timed out")
+            if line == None:
+                self.__kill("crashed on %s of %s" % (request["command"], request["filename"]))
+                raise ParseServerError("The parse worker has crashed")
+        finally:
+            self.lock.release()
+
+        reply = json.loads(line)
+        assert reply["id"] == request["id"]
+        if reply.get("lost"):
+            raise LostTranslationUnit("The parse worker has lost the translation unit")
+        if "error" in reply:
+            raise ParseServerError(reply["error"])
+        return reply["result"]
+
+    def stop(self):
+        self.lock.acquire()
+        try:
+            if self.process != None:
+                self.__kill("shut down")
+        finally:
+            self.lock.release()
+
+# A pool of helper processes that parse translation units out of the
+# editor process.
+class ParsePool(object):
+    # python is the interpreter used to run the helper processes,
+    # arch and libcache tell them which libraries to load. timeout is the
+    # number of seconds a parse may take and query_timeout the number of
+    # seconds any other request may take.
+    def __init__(self, python, arch, libcache, count, timeout, query_timeout):
+        server  = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parseserver.py")
+        command = [python, server, arch, libcache]
+        self.processes = [ParseProcess(command) for i in range(max(count, 1))]
+        self.timeout       = timeout
+        self.query_timeout = query_timeout
+        self.handles = LockedVariable([0])
+
+    def new_handle(self):
+        handles = self.handles.lock()
+        try:
+            handles[0] = handles[0] + 1
+            return handles[0]
+        finally:
+            self.handles.unlock()
+
+    # a file always goes to the same process so that the following
+    # requests find its translation unit there.
+    def get_process(self, filename):
+        return self.processes[hash(filename) % len(self.processes)]
+
+    def shutdown(self):
+        for p in self.processes:
+            p.stop()
+
+# Stands in for a TranslationUnit that lives in one of the processes of
+# a ParsePool.
+class RemoteTranslationUnit(object):
+    def __init__(self, pool, filename, opts, args, unsaved_files):
+        self.lock      = threading.Lock()
+        self.pool      = pool
+        self.process   = pool.get_process(filename)
+        self.handle    = pool.new_handle()
+        self.filename  = filename
+        self.opts      = opts
+        self.args      = args
+        self.fingerprint = None
+        self.last_used = time.time()
+        self.from_disk = False
+        self.dirty     = len(unsaved_files) > 0
+        self.preamble  = None
+        self.unsaved_files = unsaved_files # the latest parse was done with
+        self.memory_usage, includes = self.__call("parse", pool.timeout, unsaved_files=unsaved_files)
+        self.includes = set(includes)
+
+    def __call(self, command, timeout, **kwargs):
+        try:
+            return self.__send(command, timeout, **kwargs)
+        except LostTranslationUnit:
+            # parse the file again with the time a parse is given before
+            # asking again, the query timeout is too short for a parse.
+            self.memory_usage, includes = self.__send("parse", self.pool.timeout, unsaved_files=self.unsaved_files)
+            self.includes = set(includes)
+            return self.__send(command, timeout, **kwargs)
+
+    def __send(self, command, timeout, **kwargs):
+        request = {
+            "command"    : command,
+            "handle"     : self.handle,
+            "filename"   : self.filename,
+            "args"       : self.args,
+            "index_type" : self.opts.index_type
+        }
+        request.update(kwargs)
+        return self.process.call(request, timeout)
+
+    def touch(self):
+        self.last_used = time.time()
+
+    # the translation unit isn't in this process so there's nothing
+    # to save.
+    def store(self, disk_cache):
+        return False
+
+    # drop the translation unit from the helper process.
+    def release(self):
+        try:
+            self.__call("remove", self.pool.query_timeout)
+        except ParseServerError:
+            pass
+
+    def complete(self, data, prefix, limit=0):
+        start = time.time()
+        ret = self.__call("complete", self.pool.query_timeout, data=data, prefix=prefix, limit=limit)
+        stats.record(self.filename, "complete", time.time() - start)
+        if ret == None:
+            return None
+        return [(display, insert) for display, insert in ret]
+
+    def clangcomplete(self, filename, row, col, unsaved_files, membercomp, prefix="", limit=0):
+        start = time.time()
+        ret = self.__call("clangcomplete", self.pool.query_timeout, complete_filename=filename, row=row, col=col,
+            unsaved_files=unsaved_files, membercomp=membercomp, prefix=prefix, limit=limit)
+        stats.record(self.filename, "clangcomplete", time.time() - start)
+        if ret == None:
+            return None
+        return [(display, insert) for display, insert in ret]
+
+    def __find(self, command, data, offset, found_callback, folders):
+        target = self.__call(command, self.pool.timeout, data=data, offset=offset)
+        self.dirty = True
+        if isinstance(target, dict):
+            from extensivesearch import ExtensiveSearch
+            ExtensiveSearch(None, target["search"], found_callback, folders, self.opts)
+            return
+        found_callback(target)
+
+    def find_definition(self, data, offset, found_callback, folders):
+        self.__find("find_definition", data, offset, found_callback, folders)
+
+    def find_declaration(self, data, offset, found_callback, folders):
+        self.__find("find_declaration", data, offset, found_callback, folders)
+
+    def reparse(self, unsaved_files):
+        self.memory_usage, includes = self.__call("reparse", self.pool.timeout, unsaved_files=unsaved_files)
+        self.includes = set(includes)
+        self.unsaved_files = unsaved_files
+        self.dirty = len(unsaved_files) > 0
+
+    def get_diagnostics(self):
+        ret = list()
+        for value, line, column, spelling, filename, flag in self.__call("get_diagnostics", self.pool.query_timeout):
+            info = Diagnostic(value, line, column, spelling, filename)
+            if len(flag):
+                info.disable_flag = flag
+            ret.append(info)
+        return ret
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2016 Sami Väisänen, Ensisoft
+http://www.ensisoft.com
+"""
+
+# Helper process that parses translation units on behalf of the plugin
+# so that a runaway parse or a crash inside libclang doesn't take the
+# editor down with it. See parsepool.py for the editor side.
+#
+# Usage: python parseserver.py <arch> <libcache>
+#
+# The protocol is one JSON object per line. Each request has an "id",
+# a "command" and the "handle" of the translation unit it applies to
+# together with the "filename", "args" and "index_type" needed to parse
+# it. The reply echoes the id and carries either a "result" or an
+# "error" message. A request for a translation unit the server doesn't
+# have (for example after a restart) is answered with "lost" set instead,
+# the editor then parses the file again with a parse request that's given
+# the time a parse takes.
+
+import hashlib
+import json
+import sys
+import traceback
+
+from clang import cindex
+import extensivesearch
+import translationunit
+
+# the extensive search runs in the editor, the server only reports what
+# should be searched for.
+class SearchRequest(object):
+    def __init__(self, cursor, spelling, found_callback, folders, opts, *args, **kwargs):
+        found_callback({"search" : spelling})
+
+extensivesearch.ExtensiveSearch = SearchRequest
+
+def to_str(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [to_str(v) for v in value]
+    return value
+
+class LostTranslationUnit(Exception):
+    pass
+
+class ParseServer(object):
+    def __init__(self):
+        self.index = cindex.Index.create()
+        self.translationUnits = {} # handle -> TranslationUnit
+
+    def __parse(self, request, unsaved_files):
+        handle   = request["handle"]
+        filename = to_str(request["filename"])
+        args     = to_str(request["args"])
+        blob = self.index.parse(None, args, unsaved_files, request["index_type"])
+        assert blob is not None
+        # the compile options stay in the editor, the arguments are all
+        # the server needs. The last argument is the file itself.
+        context = hashlib.sha1("\0".join(args[:-1])).hexdigest()
+        tu = translationunit.TranslationUnit(blob, filename, None, context)
+        tu.args = args
+        tu.unsaved = set([name for name, value in unsaved_files])
+        self.translationUnits[handle] = tu
+        return tu
+
+    def __get(self, request):
+        tu = self.translationUnits.get(request["handle"])
+        if tu == None:
+            raise LostTranslationUnit()
+        return tu
+
+    def __get_unsaved_files(self, request):
+        return [(to_str(name), to_str(data)) for name, data in request.get("unsaved_files", [])]
+
+    def parse(self, request):
+        tu = self.__parse(request, self.__get_unsaved_files(request))
+        return [tu.memory_usage, list(tu.includes)]
+
+    def reparse(self, request):
+        unsaved_files = self.__get_unsaved_files(request)
+        if request["handle"] in self.translationUnits:
+            tu = self.translationUnits[request["handle"]]
+            tu.reparse(unsaved_files)
+        else:
+            tu = self.__parse(request, unsaved_files)
+        return [tu.memory_usage, list(tu.includes)]
+
+    def complete(self, request):
+        tu = self.__get(request)
+        ret = tu.complete(to_str(request["data"]), to_str(request["prefix"]), request.get("limit", 0))
+        if ret == None:
+            return None
+        return [[display, insert] for display, insert in ret]
+
+    def clangcomplete(self, request):
+        tu = self.__get(request)
+        ret = tu.clangcomplete(to_str(request["complete_filename"]), request["row"], request["col"],
+            self.__get_unsaved_files(request), request["membercomp"], to_str(request["prefix"]), request["limit"])
+        if ret == None:
+            return None
+        return [[display, insert] for display, insert in ret]
+
+    def get_diagnostics(self, request):
+        tu = self.__get(request)
+        ret = []
+        for d in tu.get_diagnostics():
+            # get_diagnostics sets disable_flag on the instance when
+            # libclang knows the flag.
+            flag = ""
+            if isinstance(d.disable_flag, basestring):
+                flag = d.disable_flag
+            ret.append([d.value, d.line, d.column, d.spelling, d.filename, flag])
+        return ret
+
+    def __find(self, request, find):
+        tu = self.__get(request)
+        found = []
+        find(tu)(to_str(request["data"]), request["offset"], found.append, [])
+        if len(found):
+            return found[0]
+        return None
+
+    def find_definition(self, request):
+        return self.__find(request, lambda tu: tu.find_definition)
+
+    def find_declaration(self, request):
+        return self.__find(request, lambda tu: tu.find_declaration)
+
+    def remove(self, request):
+        if request["handle"] in self.translationUnits:
+            del self.translationUnits[request["handle"]]
+        return None
+
+    def run(self, input, output):
+        commands = {
+            "parse"            : self.parse,
+            "reparse"          : self.reparse,
+            "complete"         : self.complete,
+            "clangcomplete"    : self.clangcomplete,
+            "get_diagnostics"  : self.get_diagnostics,
+            "find_definition"  : self.find_definition,
+            "find_declaration" : self.find_declaration,
+            "remove"           : self.remove
+        }
+        while True:
+            line = input.readline()
+            if not line:
+                break
+            request = json.loads(line)
+            reply = {"id" : request["id"]}
+            try:
+                reply["result"] = commands[request["command"]](request)
+            except LostTranslationUnit:
+                reply["lost"] = True
+            except:
+                traceback.print_exc()
+                reply["error"] = str(sys.exc_info()[1])
+            output.write(json.dumps(reply) + "\n")
+            output.flush()
+
+def main():
+    arch, libcache = sys.argv[1], sys.argv[2]
+    # anything printed on the way would end up in the protocol stream.
+    output = sys.stdout
+    sys.stdout = sys.stderr
+
+    cindex.conf = cindex.Config()
+    cindex.arch = arch
+    cindex.register_enumerations()
+    translationunit.init_cache_lib(libcache)
+
+    ParseServer().run(sys.stdin, output)
+
+if __name__ == "__main__":
+    main()
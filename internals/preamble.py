@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2016 Sami Väisänen, Ensisoft
+http://www.ensisoft.com
+"""
+
+from clang import cindex
+from common import *
+import hashlib
+import os
+import re
+import time
+
+# the language clang needs to be told to compile a header in.
+HEADER_LANGUAGES = {
+    "c++"    : "c++-header",
+    "c"      : "c-header",
+    "objc"   : "objective-c-header",
+    "objc++" : "objective-c++-header"
+}
+
+INCLUDE_RE = re.compile(r"^#\s*include\s*([<\"][^>\"]+[>\"])")
+
+# files in the preamble directory that haven't been written to for this
+# many seconds are left over from earlier sessions.
+STALE_FILE_AGE = 7 * 24 * 60 * 60
+
+# get the block of #include directives the file starts with. Comments,
+# empty lines and #pragma once before and in between the directives are
+# skipped. Each include is returned as (target, directory) where the
+# directory is the one the target is looked up relative to for quoted
+# includes and None for angle bracket includes. data is the contents of
+# the file if it's not to be read from the disk.
+def get_leading_includes(filename, data=None):
+    ret = []
+    if data == None:
+        try:
+            f = open(filename, "r")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return tuple(ret)
+    lines = data.splitlines()
+
+    in_comment = False
+    for line in lines:
+        line = line.strip()
+        if in_comment:
+            if "*/" in line:
+                in_comment = False
+                line = line[line.find("*/") + 2:].strip()
+            else:
+                continue
+        if line.startswith("/*"):
+            if "*/" not in line:
+                in_comment = True
+                continue
+            line = line[line.find("*/") + 2:].strip()
+        if len(line) == 0 or line.startswith("//") or re.match(r"^#\s*pragma\s+once", line):
+            continue
+        match = INCLUDE_RE.match(line)
+        if not match:
+            break
+        target = match.group(1)
+        directory = None
+        if target.startswith("\""):
+            directory = os.path.dirname(filename)
+        ret.append((target, directory))
+    return tuple(ret)
+
+def get_common_prefix(a, b):
+    n = 0
+    while n < len(a) and n < len(b) and a[n] == b[n]:
+        n = n + 1
+    return a[:n]
+
+# A header made of a block of #includes that several translation units
+# parsed with the same options start with. It's compiled once into a
+# precompiled header that the translation units then include instead of
+# each compiling the headers into their own preamble.
+class Preamble(object):
+    def __init__(self, key, args, language, includes):
+        self.key      = key
+        self.args     = args # compiler arguments without the filename
+        self.language = language
+        self.includes = includes
+        self.pch      = None # path of the precompiled header once built
+        self.builds   = 0
+        self.failed   = False
+        self.headers  = set() # files included by the precompiled header
+
+    def is_ready(self):
+        return self.pch != None and not self.failed
+
+# Keeps track of the include blocks the translation units start with and
+# the preambles built for the shared ones.
+class PreambleCache(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock      = threading.Lock()
+        self.blocks    = {} # fingerprint -> {filename : includes}
+        self.preambles = {} # (fingerprint, includes) -> Preamble
+        self.owners    = {} # pch -> Preamble
+        self.__remove_stale_files()
+
+    # other instances of the editor may be using the files in the
+    # directory, only the ones nobody has written to for a long time
+    # are removed.
+    def __remove_stale_files(self):
+        if not os.path.isdir(self.directory):
+            return
+        now = time.time()
+        for f in os.listdir(self.directory):
+            if f.endswith(".h") or f.endswith(".pch"):
+                path = os.path.join(self.directory, f)
+                try:
+                    if now - os.path.getmtime(path) > STALE_FILE_AGE:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    # get the precompiled header the file should be parsed with.
+    # fingerprint identifies the compile configuration and args are the
+    # arguments the file is compiled with, the filename being the last one.
+    # data is the unsaved contents of the file or None. Returns (pch, preamble)
+    # where pch is the path of a ready preamble to use or None and preamble
+    # is a new Preamble that should be built or None.
+    def get(self, filename, fingerprint, args, language, data=None):
+        includes = get_leading_includes(filename, data)
+        if len(includes) == 0:
+            return (None, None)
+        key = fingerprint
+
+        self.lock.acquire()
+        try:
+            blocks = self.blocks.setdefault(key, {})
+            blocks[filename] = includes
+
+            # use the longest preamble that the file starts with.
+            pch = None
+            best = 0
+            for (k, inc), preamble in self.preambles.items():
+                if k != key or not preamble.is_ready():
+                    continue
+                if len(inc) > best and includes[:len(inc)] == inc:
+                    pch  = preamble.pch
+                    best = len(inc)
+
+            # see if the file shares a longer block with another file
+            shared = ()
+            for other, inc in blocks.items():
+                if other == filename:
+                    continue
+                prefix = get_common_prefix(includes, inc)
+                if len(prefix) > len(shared):
+                    shared = prefix
+            if len(shared) <= best or (key, shared) in self.preambles:
+                return (pch, None)
+
+            preamble = Preamble(key, args[:-1], language, shared)
+            self.preambles[(key, shared)] = preamble
+            return (pch, preamble)
+        finally:
+            self.lock.release()
+
+    # build the precompiled header for the preamble.
+    def build(self, index, preamble):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # the process id keeps other instances of the editor from
+        # overwriting the files.
+        name   = "%s-%d" % (hashlib.sha1(preamble.key + "\0" + repr(preamble.includes)).hexdigest(), os.getpid())
+        header = os.path.join(self.directory, name + ".h")
+        f = open(header, "w")
+        try:
+            for target, directory in preamble.includes:
+                f.write("#include %s\n" % target)
+        finally:
+            f.close()
+
+        args = list(preamble.args)
+        for directory in set([d for t, d in preamble.includes if d != None]):
+            args = args + ["-iquote", directory]
+        args = args + ["-x", HEADER_LANGUAGES[preamble.language], header]
+
+        pch = None
+        try:
+            tu = index.parse(None, args, None, cindex.TranslationUnit.PARSE_INCOMPLETE)
+            if not self.__has_errors(tu):
+                headers = set([os.path.abspath(inc.include.name) for inc in tu.get_includes()])
+                # a new name for each build, translation units parsed with
+                # the previous one keep on using it.
+                preamble.builds = preamble.builds + 1
+                pch = os.path.join(self.directory, "%s-%d.pch" % (name, preamble.builds))
+                tu.save(pch)
+        except (cindex.TranslationUnitLoadError, cindex.TranslationUnitSaveError):
+            pch = None
+
+        self.lock.acquire()
+        try:
+            if pch == None:
+                preamble.failed = True
+            else:
+                preamble.pch     = pch
+                preamble.failed  = False
+                preamble.headers = headers
+                self.owners[pch] = preamble
+        finally:
+            self.lock.release()
+        return pch != None
+
+    def __has_errors(self, tu):
+        for d in tu.diagnostics:
+            if d.severity >= cindex.Diagnostic.Error:
+                return True
+        return False
+
+    # check whether parsing the translation unit with the pch failed
+    # because of it, for example because a header in it has changed
+    # since it was built.
+    def is_rejected(self, tu, pch):
+        for d in tu.get_diagnostics():
+            if d.is_fatal() and ("precompiled" in d.spelling or "PCH" in d.spelling or pch in d.spelling):
+                return True
+        return False
+
+    # get the files included by the precompiled header.
+    def get_headers(self, pch):
+        self.lock.acquire()
+        try:
+            preamble = self.owners.get(pch)
+            if preamble == None:
+                return set()
+            return preamble.headers
+        finally:
+            self.lock.release()
+
+    # check whether the pch is the latest build of its preamble.
+    def is_current(self, pch):
+        self.lock.acquire()
+        try:
+            preamble = self.owners.get(pch)
+            return preamble != None and preamble.pch == pch
+        finally:
+            self.lock.release()
+
+    # the file has changed, stop handing out the precompiled headers
+    # that include it. Returns the preambles to rebuild.
+    def file_changed(self, filename):
+        ret = []
+        self.lock.acquire()
+        try:
+            for preamble in self.preambles.values():
+                if preamble.is_ready() and filename in preamble.headers:
+                    preamble.pch = None
+                    ret.append(preamble)
+        finally:
+            self.lock.release()
+        return ret
+
+    # stop handing out the pch. Returns the preamble to rebuild or None
+    # if it's already been taken care of.
+    def invalidate(self, pch):
+        self.lock.acquire()
+        try:
+            preamble = self.owners.get(pch)
+            if preamble == None or preamble.pch != pch:
+                return None
+            preamble.pch = None
+            return preamble
+        finally:
+            self.lock.release()
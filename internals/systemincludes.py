@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2016 Sami Väisänen, Ensisoft
+http://www.ensisoft.com
+"""
+
+from common import *
+import json
+import os
+import threading
+
+# Finds the system include paths clang uses implicitly (the -internal-isystem
+# paths in the output of clang -###) for a compiler and a language. The
+# compiler is run on a background thread and the paths are saved in a file
+# so that later sessions don't need to run it again. Results are keyed by
+# the compiler, its modification time and the language so that upgrading
+# the compiler finds the paths again.
+class SystemIncludes(object):
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock       = threading.Lock()
+        self.futures    = {} # key -> Future
+        self.found      = self.__load() # key -> [paths]
+
+    def __load(self):
+        try:
+            f = open(self.cache_file, "r")
+            try:
+                found = json.load(f)
+                return dict([(k, [sencode(p) for p in v]) for k, v in found.items()])
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+
+    def __save(self):
+        directory = os.path.dirname(self.cache_file)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            f = open(self.cache_file, "w")
+            try:
+                json.dump(self.found, f, indent=4)
+            finally:
+                f.close()
+        except (IOError, OSError) as err:
+            print("SublimeClang: failed to save the system includes: %s" % err)
+
+    def __get_key(self, compiler, language):
+        try:
+            mtime = int(os.path.getmtime(compiler))
+        except OSError:
+            mtime = 0
+        return "%s|%d|%s" % (compiler, mtime, language)
+
+    # start finding the system includes for the language. source is a
+    # file in that language to give the compiler. Returns a Future for
+    # the list of include paths.
+    def find(self, compiler, language, source):
+        key = self.__get_key(compiler, language)
+        self.lock.acquire()
+        try:
+            future = self.futures.get(key)
+            if future != None:
+                return future
+            future = Future()
+            self.futures[key] = future
+            if key in self.found:
+                future.set_result(self.found[key])
+                return future
+        finally:
+            self.lock.release()
+
+        t = threading.Thread(target=self.__run, args=(key, compiler, source, future))
+        t.daemon = True
+        t.start()
+        return future
+
+    def __run(self, key, compiler, source, future):
+        includes = []
+        try:
+            info = ClangInfo.collect(compiler, source)
+            if info != None:
+                includes = info.internal_isystem
+            print("Found system includes for %s:" % key)
+            print(includes)
+            self.lock.acquire()
+            try:
+                self.found[key] = includes
+                self.__save()
+            finally:
+                self.lock.release()
+        except Exception as err:
+            # parse without the system includes rather than not at all
+            print("SublimeClang: failed to find the system includes with %s: %s" % (compiler, err))
+            includes = []
+        finally:
+            # the editor may be waiting for them
+            future.set_result(includes)
@@ -29,12 +29,15 @@ http://www.ensisoft.com
 """
 
 from clang import cindex
-from ctypes import cdll, Structure, POINTER, c_char_p, c_void_p, c_uint, c_bool
+from cachestats import stats
+from ctypes import cdll, Structure, POINTER, c_char_p, c_void_p, c_int, c_uint, c_ubyte, c_bool, string_at
 from common import *
 from parsehelp import *
 # brain damaged circular imports...
 #from extensivesearch import ExtensiveSearch
+import os
 import re
+import time
 
 def get_cache_library(arch):
     import platform
@@ -66,6 +69,67 @@ class CacheEntry(Structure):
     def display(self):
         return bdecode(self.raw_display)
 
+PACKED_STATIC    = 1
+PACKED_BASECLASS = 2
+
+# IMPORTANT: must match PackedResults in src/libcache.h
+class PackedResults(Structure):
+    _fields_ = [("length", c_uint), ("size", c_uint), ("strings", c_void_p), ("kinds", POINTER(c_uint)), ("access", POINTER(c_uint)), ("flags", POINTER(c_ubyte))]
+
+# what's read of a CacheEntry through PackedResults, everything but the cursor.
+class PackedEntry(object):
+    __slots__ = ["display", "insert", "kind", "access", "static", "baseclass"]
+
+    def __init__(self, display, insert, kind, access, flags):
+        self.display   = display
+        self.insert    = insert
+        self.kind      = kind
+        self.access    = access
+        self.static    = (flags & PACKED_STATIC) != 0
+        self.baseclass = (flags & PACKED_BASECLASS) != 0
+
+# IMPORTANT: must match CompletionFilter in src/libcache.h
+# Which entries of a completion to keep, see make_filter.
+class CompletionFilter(Structure):
+    _fields_ = [("kinds", POINTER(c_uint)), ("kinds_length", c_uint), ("exclude_kinds", c_bool), ("static", c_int), ("baseclass", c_int), ("max_access", c_uint), ("base_privates", c_bool)]
+
+# make a CompletionFilter. kinds are the cursor kinds to keep (or to drop
+# with exclude_kinds), static and baseclass are 1 to keep only static or
+# base class members, 0 to keep none of them and -1 for either. max_access
+# is the most restricted access kept.
+def make_filter(kinds=[], exclude_kinds=False, static=-1, baseclass=-1, max_access=cindex.CXXAccessSpecifier.PRIVATE, base_privates=True):
+    f = CompletionFilter()
+    f.kinds = (c_uint*len(kinds))(*[k.value for k in kinds])
+    f.kinds_length = len(kinds)
+    f.exclude_kinds = exclude_kinds
+    f.static = static
+    f.baseclass = baseclass
+    f.max_access = max_access
+    f.base_privates = base_privates
+    return f
+
+# whether the CacheEntry passes the CompletionFilter, the same as
+# CompletionFilter::accepts in src/libcache.h.
+def filter_accepts(f, entry):
+    if f.static != -1 and entry.static != (f.static == 1):
+        return False
+    if f.baseclass != -1 and entry.baseclass != (f.baseclass == 1):
+        return False
+    if entry.access > f.max_access:
+        return False
+    if not f.base_privates and entry.baseclass and entry.access == cindex.CXXAccessSpecifier.PRIVATE:
+        return False
+    if f.kinds_length:
+        kind = entry.cursor.kind.value
+        found = kind in [f.kinds[i] for i in range(f.kinds_length)]
+        if found == f.exclude_kinds:
+            return False
+    return True
+
+# the kinds of the members of a class that aren't members of its instances.
+TYPE_MEMBER_KINDS = [cindex.CursorKind.ENUM_CONSTANT_DECL, cindex.CursorKind.ENUM_DECL,
+    cindex.CursorKind.TYPEDEF_DECL, cindex.CursorKind.CLASS_DECL, cindex.CursorKind.STRUCT_DECL]
+
 class _Cache(Structure):
     def __del__(self):
         _deleteCache(self)
@@ -83,33 +147,151 @@ class CacheCompletionResults(Structure):
             raise IndexError
         return completionResults_getEntry(self, key)[0]
 
+    # the (display, insert) strings of all the entries, read in one go
+    # rather than entry by entry when the cache library can pack them.
+    def strings(self):
+        if completionResults_pack == None:
+            return PartialCompletionResults(self, self.__entries()).strings()
+        packed = completionResults_pack(self)[0]
+        return self.__unpack_strings(packed)
+
+    # all the entries as PackedEntries, read in one go.
+    def unpack(self):
+        if completionResults_pack == None:
+            return PartialCompletionResults(self, self.__entries()).unpack()
+        packed = completionResults_pack(self)[0]
+        kinds  = packed.kinds
+        access = packed.access
+        flags  = packed.flags
+        return [PackedEntry(display, insert, cindex.CursorKind.from_id(kinds[i]), access[i], flags[i])
+                for i, (display, insert) in enumerate(self.__unpack_strings(packed))]
+
+    def __entries(self):
+        return [self[i] for i in range(len(self))]
+
+    def __unpack_strings(self, packed):
+        if packed.length == 0:
+            return []
+        strings = bdecode(string_at(packed.strings, packed.size)).split("\0")
+        return list(zip(strings[0:2*packed.length:2], strings[1:2*packed.length:2]))
+
     def __del__(self):
         completionResults_dispose(self)
 
+# Some of the entries of CacheCompletionResults picked in Python when the
+# cache library doesn't have the export that picks them, see
+# init_cache_lib. Used the same way as the results it's made from.
+class PartialCompletionResults(object):
+    def __init__(self, results, entries):
+        self.results = results # owns the entries
+        self.entries = entries
+
+    @property
+    def length(self):
+        return len(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def strings(self):
+        return [(e.display, e.insert) for e in self.entries]
+
+    def unpack(self):
+        return [PackedEntry(e.display, e.insert, e.cursor.kind, e.access,
+                            (e.static and PACKED_STATIC) | (e.baseclass and PACKED_BASECLASS))
+                for e in self.entries]
+
+# the entries of the results that pass accept as completion results, or
+# None when the results are. The results are freed with the returned ones.
+def pick_results(results, accept, limit=0):
+    if not results:
+        return None
+    results = results[0]
+    entries = []
+    for i in range(len(results)):
+        if limit and len(entries) == limit:
+            break
+        e = results[i]
+        if accept(e):
+            entries.append(e)
+    return [PartialCompletionResults(results, entries)]
+
+# the fallbacks of the exports the cache library may not have.
+def _create_cache_shared(base, context):
+    return _createCache(base)
+
+def _update_cache(previous, base, changed, length):
+    return _createCache(base)
+
+def _complete_startswith_limit(cache, prefix, limit):
+    return pick_results(cache_complete_startswith(cache, prefix), lambda e: True, limit)
+
+# without the priorities of the results the limit keeps the first ones.
+def _clang_complete_prefix(cache, filename, row, col, unsaved, length, membercomp, prefix, limit):
+    prefix = bdecode(prefix).lower()
+    return pick_results(cache_clangComplete(cache, filename, row, col, unsaved, length, membercomp),
+                        lambda e: e.insert.lower().startswith(prefix), limit)
+
+def _complete_cursor_filtered(cache, cursor, filters, length):
+    filters = filters[:length]
+    return pick_results(cache_completeCursor(cache, cursor), lambda e: any(filter_accepts(f, e) for f in filters))
+
+def _complete_startswith_filtered(cache, prefix, filters, length):
+    filters = filters[:length]
+    return pick_results(cache_complete_startswith(cache, prefix), lambda e: any(filter_accepts(f, e) for f in filters))
+
 cachelib                   = None
 _createCache               = None
+_createCacheShared         = None
+_updateCache               = None
 _deleteCache               = None
 cache_completeNamespace    = None
 cache_complete_startswith  = None
+cache_complete_startswith_limit = None
 completionResults_length   = None
 completionResults_getEntry = None
+completionResults_pack     = None
 completionResults_dispose  = None
 cache_findType             = None
 cache_completeCursor       = None
+cache_completeCursor_filtered = None
+cache_complete_startswith_filtered = None
 cache_clangComplete        = None
+cache_clangComplete_prefix = None
+
+# bind an export of the cache library that the prebuilt libraries made
+# before it was added don't have. fallback is used in place of it then.
+def _bind_optional(name, argtypes, restype, fallback):
+    func = getattr(cachelib, name, None)
+    if func == None:
+        return fallback
+    func.argtypes = argtypes
+    if restype != None:
+        func.restype = restype
+    return func
 
 def init_cache_lib(libname):
     global cachelib
     global _createCache
+    global _createCacheShared
+    global _updateCache
     global _deleteCache
     global cache_completeNamespace
     global cache_complete_startswith
+    global cache_complete_startswith_limit
     global completionResults_length
     global completionResults_getEntry
+    global completionResults_pack
     global completionResults_dispose
     global cache_findType
     global cache_completeCursor
+    global cache_completeCursor_filtered
+    global cache_complete_startswith_filtered
     global cache_clangComplete
+    global cache_clangComplete_prefix
 
     assert cachelib == None
     assert libname != None
@@ -118,6 +300,10 @@ def init_cache_lib(libname):
     _createCache = cachelib.createCache
     _createCache.restype = POINTER(_Cache)
     _createCache.argtypes = [cindex.Cursor]
+    _createCacheShared = _bind_optional("createCacheShared", [cindex.Cursor, c_char_p],
+        POINTER(_Cache), _create_cache_shared)
+    _updateCache = _bind_optional("updateCache", [POINTER(_Cache), cindex.Cursor, POINTER(c_char_p), c_uint],
+        POINTER(_Cache), _update_cache)
     _deleteCache = cachelib.deleteCache
     _deleteCache.argtypes = [POINTER(_Cache)]
     cache_completeNamespace = cachelib.cache_completeNamespace
@@ -126,12 +312,17 @@ def init_cache_lib(libname):
     cache_complete_startswith = cachelib.cache_complete_startswith
     cache_complete_startswith.argtypes = [POINTER(_Cache), c_char_p]
     cache_complete_startswith.restype = POINTER(CacheCompletionResults)
+    cache_complete_startswith_limit = _bind_optional("cache_complete_startswith_limit", [POINTER(_Cache), c_char_p, c_uint],
+        POINTER(CacheCompletionResults), _complete_startswith_limit)
     completionResults_length = cachelib.completionResults_length
     completionResults_length.argtypes = [POINTER(CacheCompletionResults)]
     completionResults_length.restype = c_uint
     completionResults_getEntry = cachelib.completionResults_getEntry
     completionResults_getEntry.argtypes = [POINTER(CacheCompletionResults)]
     completionResults_getEntry.restype = POINTER(CacheEntry)
+    # the results are read entry by entry without it.
+    completionResults_pack = _bind_optional("completionResults_pack", [POINTER(CacheCompletionResults)],
+        POINTER(PackedResults), None)
     completionResults_dispose = cachelib.completionResults_dispose
     completionResults_dispose.argtypes = [POINTER(CacheCompletionResults)]
     cache_findType = cachelib.cache_findType
@@ -140,10 +331,24 @@ def init_cache_lib(libname):
     cache_completeCursor = cachelib.cache_completeCursor
     cache_completeCursor.argtypes = [POINTER(_Cache), cindex.Cursor]
     cache_completeCursor.restype = POINTER(CacheCompletionResults)
+    cache_completeCursor_filtered = _bind_optional("cache_completeCursor_filtered", [POINTER(_Cache), cindex.Cursor, POINTER(CompletionFilter), c_uint],
+        POINTER(CacheCompletionResults), _complete_cursor_filtered)
+    cache_complete_startswith_filtered = _bind_optional("cache_complete_startswith_filtered", [POINTER(_Cache), c_char_p, POINTER(CompletionFilter), c_uint],
+        POINTER(CacheCompletionResults), _complete_startswith_filtered)
     cache_clangComplete = cachelib.cache_clangComplete
     cache_clangComplete.argtypes = [POINTER(_Cache), c_char_p, c_uint, c_uint, POINTER(cindex._CXUnsavedFile), c_uint, c_bool]
     cache_clangComplete.restype = POINTER(CacheCompletionResults)
+    cache_clangComplete_prefix = _bind_optional("cache_clangComplete_prefix", [POINTER(_Cache), c_char_p, c_uint, c_uint, POINTER(cindex._CXUnsavedFile), c_uint, c_bool, c_char_p, c_uint],
+        POINTER(CacheCompletionResults), _clang_complete_prefix)
+
 
+# the members of the cursor that pass any of the filters.
+def complete_cursor_filtered(cache, cursor, filters):
+    return cache_completeCursor_filtered(cache, cursor, (CompletionFilter*len(filters))(*filters), len(filters))
+
+# the entries starting with prefix that pass any of the filters.
+def complete_startswith_filtered(cache, prefix, filters):
+    return cache_complete_startswith_filtered(cache, prefix, (CompletionFilter*len(filters))(*filters), len(filters))
 
 def remove_duplicates(data):
     if data == None:
@@ -228,17 +433,71 @@ class Diagnostic(object):
 
 # represents the result of a SourceFile compilation
 class TranslationUnit(object):
-    def __init__(self, tu, filename, opts):
+    # The cache shares the strings of the headers with the caches of the
+    # other translation units made with the same context, by default the
+    # fingerprint of the compile options.
+    def __init__(self, tu, filename, opts, context=None):
         self.lock = threading.Lock()
         self.tu = tu
-        self.cache = _createCache(tu.cursor)[0]
+        if context == None and opts != None:
+            context = opts.fingerprint()
+        if context != None:
+            self.cache = _createCacheShared(tu.cursor, bencode(context))[0]
+        else:
+            self.cache = _createCache(tu.cursor)[0]
         self.filename = filename
         self.opts     = opts # compile options
+        self.last_used = time.time()
+        self.memory_usage = 0 # bytes
+        self.from_disk = False # loaded from the persistent cache
+        self.dirty = False # parsed with unsaved buffer contents
+        self.unsaved = set() # files whose unsaved buffer contents it was parsed with
+        self.unsaved_files = [] # the (name, contents) pairs of those buffers
+        self.preamble = None # shared precompiled header the unit was parsed with
+        self.includes = set() # files included by the translation unit
+        self.args = None # arguments the unit was parsed with
+        self.fingerprint = None # CompileOptions.fingerprint of those arguments
+        self.__measure_memory_usage()
+        self.__collect_includes()
 
     def __del__(self):
         self.tu = None
         self.cache = None
 
+    # mark the translation unit as recently used.
+    def touch(self):
+        self.last_used = time.time()
+
+    # save the translation unit in the persistent disk cache.
+    # only translation units that match the files on the disk are saved.
+    def store(self, disk_cache):
+        self.lock.acquire()
+        try:
+            # the shared precompiled headers don't outlive the session.
+            if self.dirty or self.from_disk or self.preamble != None:
+                return False
+            return disk_cache.store(self.tu, self.filename, self.fingerprint)
+        finally:
+            self.lock.release()
+
+    # collect the names of the files the translation unit includes.
+    # the headers in a precompiled header are not included.
+    def __collect_includes(self):
+        try:
+            self.includes = set([os.path.abspath(inc.include.name) for inc in self.tu.get_includes()])
+        except:
+            self.includes = set()
+
+    # sample the number of bytes libclang uses for this translation unit.
+    # the value is kept around so that the cache doesn't need to call
+    # into libclang whenever it wants to know how big we are.
+    def __measure_memory_usage(self):
+        try:
+            self.memory_usage = sum(self.tu.resource_usage.values())
+        except:
+            # the libclang in use might not support resource usage queries.
+            self.memory_usage = 0
+
     def __format_cursor(self, cursor):
         assert cursor != None
         return "%s:%d:%d" % (cursor.location.file.name, cursor.location.line,
@@ -263,7 +522,7 @@ class TranslationUnit(object):
             nsarg = self.__get_native_namespace(namespace)
             comp = cache_completeNamespace(self.cache, nsarg, len(nsarg))
             if comp:
-                ret = [(x.display, x.insert) for x in comp[0]]
+                ret = comp[0].strings()
         return ret
 
     def __get_namespace_from_cursor(self, cursor):
@@ -396,7 +655,8 @@ class TranslationUnit(object):
         return ret2
 
 
-    def __complete_code(self, data, prefix):
+    # limit is the max number of global symbols to complete, 0 for no limit.
+    def __complete_code(self, data, prefix, limit):
         line = parsehelp.extract_line_at_offset(data, len(data)-1)
         before = line
         if len(prefix) > 0:
@@ -410,14 +670,10 @@ class TranslationUnit(object):
             match = re.search(r"([^\(\s,]+::)+$", before)
             if match == None:
                 ret = None
-                cached_results = cache_complete_startswith(self.cache, bencode(prefix))
+                cached_results = complete_startswith_filtered(self.cache, bencode(prefix),
+                    [make_filter(kinds=[cindex.CursorKind.MACRO_DEFINITION, cindex.CursorKind.CXX_METHOD], exclude_kinds=True)])
                 if cached_results:
-                    ret = []
-                    for x in cached_results[0]:
-                        x.cursor._tu = self.tu
-                        if x.cursor.kind != cindex.CursorKind.MACRO_DEFINITION and \
-                                x.cursor.kind != cindex.CursorKind.CXX_METHOD:
-                            ret.append((x.display, x.insert))
+                    ret = cached_results[0].strings()
                 return ret
             before = match.group(1)
             namespace = before.split("::")
@@ -443,33 +699,28 @@ class TranslationUnit(object):
                     if c.kind == cindex.CursorKind.NAMESPACE:
                         namespace = self.__get_namespace_from_cursor(c)
                         return self.__complete_namespace(namespace)
-                    comp = cache_completeCursor(self.cache, c)
-
+                    inherits = False
+                    clazz = parsehelp.extract_class_from_function(data)
+                    if clazz == None:
+                        clazz = parsehelp.extract_class(data)
+                    if clazz != None:
+                        c2 = self.__find_type(data, clazz)
+                        inherits = self.__inherits(c, c2)
+
+                    selfcompletion = clazz == c.spelling
+
+                    # the public static members and types, anything but the
+                    # private members for a derived class and everything
+                    # but the members of the base classes for the class itself.
+                    filters = [make_filter(static=1, max_access=cindex.CXXAccessSpecifier.PUBLIC),
+                               make_filter(kinds=TYPE_MEMBER_KINDS, max_access=cindex.CXXAccessSpecifier.PUBLIC)]
+                    if selfcompletion:
+                        filters.append(make_filter(baseclass=0))
+                    if inherits:
+                        filters.append(make_filter(max_access=cindex.CXXAccessSpecifier.PROTECTED))
+                    comp = complete_cursor_filtered(self.cache, c, filters)
                     if comp:
-                        inherits = False
-                        clazz = parsehelp.extract_class_from_function(data)
-                        if clazz == None:
-                            clazz = parsehelp.extract_class(data)
-                        if clazz != None:
-                            c2 = self.__find_type(data, clazz)
-                            inherits = self.__inherits(c, c2)
-
-                        selfcompletion = clazz == c.spelling
-
-                        for c in comp[0]:
-                            assert self.tu != None
-                            c.cursor._tu = self.tu
-                            if (selfcompletion and not c.baseclass) or \
-                                    (inherits and not c.access == cindex.CXXAccessSpecifier.PRIVATE) or \
-                                    (c.access == cindex.CXXAccessSpecifier.PUBLIC and \
-                                     (
-                                        c.static or \
-                                        c.cursor.kind == cindex.CursorKind.TYPEDEF_DECL or \
-                                        c.cursor.kind == cindex.CursorKind.CLASS_DECL or \
-                                        c.cursor.kind == cindex.CursorKind.STRUCT_DECL or \
-                                        c.cursor.kind == cindex.CursorKind.ENUM_CONSTANT_DECL or \
-                                        c.cursor.kind == cindex.CursorKind.ENUM_DECL)):
-                                ret.append((c.display, c.insert))
+                        ret.extend(comp[0].strings())
             ret = self.__filter(ret, constr)
             return ret
         elif re.search(r"(\w+\]+\s+$|\[[\w\.\-\>]+\s+$|([^ \t]+)(\.|\->)$)", before):
@@ -651,7 +902,17 @@ class TranslationUnit(object):
                     if clazz == None:
                         clazz = parsehelp.extract_class(data)
                     selfcompletion = clazz == r.spelling
-                    comp = cache_completeCursor(self.cache, r)
+                    if r.kind == cindex.CursorKind.OBJC_INTERFACE_DECL:
+                        comp = cache_completeCursor(self.cache, r)
+                    else:
+                        # the instance members, the class itself sees its
+                        # own private members too.
+                        max_access = cindex.CXXAccessSpecifier.PUBLIC
+                        if selfcompletion:
+                            max_access = cindex.CXXAccessSpecifier.PRIVATE
+                        comp = complete_cursor_filtered(self.cache, r,
+                            [make_filter(kinds=TYPE_MEMBER_KINDS + [cindex.CursorKind.CLASS_TEMPLATE], exclude_kinds=True,
+                                         static=0, max_access=max_access, base_privates=False)])
                     replaces = []
                     if template[1] != None:
                         tempnames = []
@@ -691,29 +952,19 @@ class TranslationUnit(object):
                                     if c.static == isStatic and c.cursor.kind != cindex.CursorKind.OBJC_IVAR_DECL:
                                         ret.append((c.display, c.insert))
                         else:
-                            for c in comp[0]:
-                                if not c.static and c.cursor.kind != cindex.CursorKind.ENUM_CONSTANT_DECL and \
-                                        c.cursor.kind != cindex.CursorKind.ENUM_DECL and \
-                                        c.cursor.kind != cindex.CursorKind.TYPEDEF_DECL and \
-                                        c.cursor.kind != cindex.CursorKind.CLASS_DECL and \
-                                        c.cursor.kind != cindex.CursorKind.STRUCT_DECL and \
-                                        c.cursor.kind != cindex.CursorKind.CLASS_TEMPLATE and \
-                                        (c.access == cindex.CXXAccessSpecifier.PUBLIC or \
-                                            (selfcompletion and not (c.baseclass and c.access == cindex.CXXAccessSpecifier.PRIVATE))):
-                                    disp = c.display
-                                    ins = c.insert
-                                    for r in replaces:
-                                        disp = re.sub(r[0], r[1], disp)
-                                        ins = re.sub(r[0], r[1], ins)
-                                    add = (disp, ins)
-                                    ret.append(add)
+                            for disp, ins in comp[0].strings():
+                                for r in replaces:
+                                    disp = re.sub(r[0], r[1], disp)
+                                    ins = re.sub(r[0], r[1], ins)
+                                add = (disp, ins)
+                                ret.append(add)
             ret = self.__filter(ret)
             return remove_duplicates(ret)
         else:
             constr = re.search(r"(^|\W)new\s+$", before) != None
-            cached_results = cache_complete_startswith(self.cache, bencode(prefix))
+            cached_results = cache_complete_startswith_limit(self.cache, bencode(prefix), limit)
             if cached_results:
-                ret = [(x.display, x.insert) for x in cached_results[0]]
+                ret = cached_results[0].strings()
             variables = parsehelp.extract_variables(data) if not constr else []
             var = [("%s\t%s" % (v[1], re.sub(r"(^|\b)\s*static\s+", "", v[0])), v[1]) for v in variables]
             if len(var) and ret == None:
@@ -727,14 +978,9 @@ class TranslationUnit(object):
             if clazz != None:
                 c = self.__find_type(data, clazz)
                 if c != None and not c.kind.is_invalid():
-                    comp = cache_completeCursor(self.cache, c)
+                    comp = complete_cursor_filtered(self.cache, c, [make_filter(static=0, base_privates=False)])
                     if comp:
-                        for c in comp[0]:
-                            c.cursor._tu = self.tu
-                            if not c.static and \
-                                    not (c.baseclass and c.access == cindex.CXXAccessSpecifier.PRIVATE):
-                                add = (c.display, c.insert)
-                                ret.append(add)
+                        ret.extend(comp[0].strings())
             namespaces = parsehelp.extract_used_namespaces(data)
             ns = parsehelp.extract_namespace(data)
             if ns:
@@ -747,17 +993,19 @@ class TranslationUnit(object):
             ret = self.__filter(ret, constr)
         return remove_duplicates(ret)
 
-    def complete(self, data, prefix):
+    def complete(self, data, prefix, limit=0):
+        start = time.time()
         self.lock.acquire()
         ret = None
         try:
-            ret = self.__complete_code(data, prefix)
+            ret = self.__complete_code(data, prefix, limit)
         finally:
             self.lock.release()
+        stats.record(self.filename, "complete", time.time() - start)
         return ret
 
 
-    def __clangcomplete_code(self, filename, row, col, unsaved_files, membercomp):
+    def __clangcomplete_code(self, filename, row, col, unsaved_files, membercomp, prefix, limit):
         ret = None
         unsaved = None
         if len(unsaved_files):
@@ -769,19 +1017,25 @@ class TranslationUnit(object):
                 unsaved[i].name = bencode(name)
                 unsaved[i].contents = value
                 unsaved[i].length = len(value)
-        comp = cache_clangComplete(self.cache, bencode(filename), row, col, unsaved, len(unsaved_files), membercomp)
+        comp = cache_clangComplete_prefix(self.cache, bencode(filename), row, col, unsaved, len(unsaved_files), membercomp, bencode(prefix), limit)
 
         if comp:
-            ret = [(c.display, c.insert) for c in comp[0]]
+            ret = comp[0].strings()
         return ret
 
-    def clangcomplete(self, filename, row, col, unsaved_files, membercomp):
+    # complete with libclang, which is slower but knows more than the
+    # cache. Only the results starting with prefix are returned and with
+    # a limit only that many of the most likely ones, most likely first.
+    # 0 for no limit.
+    def clangcomplete(self, filename, row, col, unsaved_files, membercomp, prefix="", limit=0):
+        start = time.time()
         self.lock.acquire()
         ret = None
         try:
-            ret = self.__clangcomplete_code(self, filename, row, col, unsaved_files, membercomp)
+            ret = self.__clangcomplete_code(filename, row, col, unsaved_files, membercomp, prefix, limit)
         finally:
             self.lock.release()
+        stats.record(self.filename, "clangcomplete", time.time() - start)
         return ret
 
 
@@ -803,8 +1057,11 @@ class TranslationUnit(object):
         target = None
         try:
             self.lock.acquire()
-            self.tu.reparse([(self.filename, data)])
-            self.cache = _createCache(self.tu.cursor)[0]
+            unsaved_files = self.merge_unsaved_files([(self.filename, data)])
+            self.tu.reparse(unsaved_files)
+            self.__update_cache(unsaved_files)
+            self.dirty = True
+            self.__measure_memory_usage()
             cursor, cursor_spelling, word_under_cursor = self.__get_impdef_prep(data, offset)
             if len(word_under_cursor) == 0:
                 found_callback(None)
@@ -878,8 +1135,11 @@ class TranslationUnit(object):
         target = None
         try:
             self.lock.acquire()
-            self.tu.reparse([(self.filename, data)])
-            self.cache = _createCache(self.tu.cursor)[0]
+            unsaved_files = self.merge_unsaved_files([(self.filename, data)])
+            self.tu.reparse(unsaved_files)
+            self.__update_cache(unsaved_files)
+            self.dirty = True
+            self.__measure_memory_usage()
             cursor, cursor_spelling, word_under_cursor = self.__get_impdef_prep(data, offset)
             if len(word_under_cursor) == 0:
                 found_callback(None)
@@ -898,11 +1158,29 @@ class TranslationUnit(object):
 
         found_callback(target)
 
+    # the buffers to reparse with given the unsaved buffers of the file.
+    def merge_unsaved_files(self, unsaved_files):
+        return unsaved_files
+
+    # make the cache of the reparsed translation unit reusing what it can
+    # of the previous one. The files that came from unsaved buffers now or
+    # the last time may have changed without their modification times
+    # telling so.
+    def __update_cache(self, unsaved_files):
+        unsaved = set([name for name, value in unsaved_files])
+        changed = [bencode(name) for name in self.unsaved | unsaved]
+        self.cache = _updateCache(self.cache, self.tu.cursor, (c_char_p*len(changed))(*changed), len(changed))[0]
+        self.unsaved = unsaved
+        self.unsaved_files = list(unsaved_files)
+
     def reparse(self, unsaved_files):
         try:
             self.lock.acquire()
             self.tu.reparse(unsaved_files)
-            self.cache = _createCache(self.tu.cursor)[0]
+            self.__update_cache(unsaved_files)
+            self.dirty = len(unsaved_files) > 0
+            self.__measure_memory_usage()
+            self.__collect_includes()
         finally:
             self.lock.release()
 
@@ -929,3 +1207,108 @@ class TranslationUnit(object):
         finally:
             self.lock.release()
         return ret
+
+
+# A header that's parsed as part of a translation unit of a source file
+# including it (the host) instead of as a translation unit of its own.
+# The header gets the options and the defines it's actually compiled
+# with and no time is spent parsing it again. Reparsing the header
+# reparses the host with the header's buffer contents in place of the
+# file on the disk.
+class HeaderTranslationUnit(TranslationUnit):
+    def __init__(self, host, filename, opts):
+        self.host      = host
+        self.filename  = filename
+        self.opts      = opts
+        self.last_used = time.time()
+        self.from_disk = False
+        self.preamble  = None
+        self.includes  = set()
+        self.args      = None
+        self.fingerprint = None
+        self.__collect_includes()
+
+    # the libclang objects are the ones of the host so that whatever
+    # the base class does to them happens to the host.
+    @property
+    def tu(self):
+        return self.host.tu
+
+    @tu.setter
+    def tu(self, tu):
+        self.host.tu = tu
+
+    @property
+    def cache(self):
+        return self.host.cache
+
+    @cache.setter
+    def cache(self, cache):
+        self.host.cache = cache
+
+    @property
+    def dirty(self):
+        return self.host.dirty
+
+    @dirty.setter
+    def dirty(self, dirty):
+        self.host.dirty = dirty
+
+    @property
+    def unsaved(self):
+        return self.host.unsaved
+
+    @unsaved.setter
+    def unsaved(self, unsaved):
+        self.host.unsaved = unsaved
+
+    @property
+    def unsaved_files(self):
+        return self.host.unsaved_files
+
+    @unsaved_files.setter
+    def unsaved_files(self, unsaved_files):
+        self.host.unsaved_files = unsaved_files
+
+    @property
+    def lock(self):
+        return self.host.lock
+
+    # the memory is used by the host, measuring it measures the host.
+    @property
+    def memory_usage(self):
+        return 0
+
+    @memory_usage.setter
+    def memory_usage(self, memory_usage):
+        self.host.memory_usage = memory_usage
+
+    def __del__(self):
+        self.host = None
+
+    # the header changes along with whatever the host includes. The host
+    # itself is reparsed under its own name when it changes, which is the
+    # reparse of the header as well.
+    def __collect_includes(self):
+        self.includes = set(self.host.includes)
+        self.includes.discard(os.path.abspath(self.filename))
+        self.includes.discard(os.path.abspath(self.host.filename))
+
+    # the host saves itself.
+    def store(self, disk_cache):
+        return False
+
+    # the header's buffer takes the place of the one the host last had for
+    # it, the buffers of the host itself and its other includes are kept.
+    def merge_unsaved_files(self, unsaved_files):
+        buffers = [(name, value) for name, value in self.host.unsaved_files if name != self.filename]
+        buffers += [(name, value) for name, value in unsaved_files if name == self.filename]
+        return buffers
+
+    def reparse(self, unsaved_files):
+        self.host.reparse(self.merge_unsaved_files(unsaved_files))
+        self.__collect_includes()
+
+    def get_diagnostics(self):
+        filename = os.path.abspath(self.filename)
+        return [d for d in TranslationUnit.get_diagnostics(self) if os.path.abspath(d.filename) == filename]
@@ -29,13 +29,17 @@ http://www.ensisoft.com
 """
 
 from clang import cindex
+from cachestats import stats
 from common import *
-from translationunit import TranslationUnit
+from translationunit import TranslationUnit, HeaderTranslationUnit
+from parsepool import RemoteTranslationUnit
+import hashlib
+import os
 import Queue
-import time
 import shlex
 import subprocess
 import sys
+import time
 
 # our supported languages
 class Language:
@@ -88,6 +92,76 @@ class Language:
         return self.value
 
 
+# options that take the next argument as their value.
+SEPARATE_VALUE_OPTIONS = ["-D", "-U", "-I", "-iquote", "-isystem", "-idirafter", "-F",
+    "-iframework", "-include", "-imacros", "-include-pch", "-iprefix", "-iwithprefix",
+    "-iwithprefixbefore", "-ivfsoverlay", "-x", "-Xclang", "-Xpreprocessor", "-mllvm",
+    "--param", "-target", "-arch", "-isysroot", "--sysroot"]
+
+# include path options in the order clang searches them.
+INCLUDE_PATH_OPTIONS = ["-iquote", "-I", "-F", "-isystem", "-idirafter"]
+
+# options whose later occurrences with the same value have no effect,
+# a header included with -include is only included once.
+FIRST_OCCURRENCE_OPTIONS = ["-include", "-imacros"]
+
+# bring compiler arguments into a canonical form where arguments that
+# mean the same compile configuration come out the same:
+# - defines (-D/-U) are sorted by name, the last one for a name wins
+# - include paths are grouped by their kind keeping the search order
+#   within a kind, only the first occurrence of a path counts
+# - forced includes (-include/-imacros) keep their order, only the
+#   first occurrence of a header counts
+# - for any other argument only its last occurrence counts
+# An option missing its value at the end is kept as it is.
+def canonicalize_arguments(args):
+    defines  = {} # name -> define
+    includes = dict([(opt, []) for opt in INCLUDE_PATH_OPTIONS])
+    others   = []
+    forced   = set()
+    i = 0
+    while i < len(args):
+        opt = args[i]
+        value = None
+        if opt in SEPARATE_VALUE_OPTIONS and i + 1 < len(args):
+            value = args[i + 1]
+            i = i + 2
+        else:
+            i = i + 1
+            for o in ["-D", "-U"] + INCLUDE_PATH_OPTIONS:
+                if opt.startswith(o) and len(opt) > len(o):
+                    opt, value = o, opt[len(o):]
+                    break
+
+        if value == None:
+            others.append(opt)
+        elif opt == "-D" or opt == "-U":
+            defines[value.split("=")[0]] = opt + value
+        elif opt in includes:
+            path = os.path.normpath(value)
+            if path not in includes[opt]:
+                includes[opt].append(path)
+        elif opt in FIRST_OCCURRENCE_OPTIONS:
+            if (opt, value) not in forced:
+                forced.add((opt, value))
+                others.append(opt + " " + value)
+        else:
+            others.append(opt + " " + value)
+
+    seen = set()
+    last = []
+    for arg in reversed(others):
+        if arg not in seen:
+            seen.add(arg)
+            last.append(arg)
+    last.reverse()
+
+    ret = [defines[name] for name in sorted(defines.keys())]
+    for opt in INCLUDE_PATH_OPTIONS:
+        ret = ret + [opt + path for path in includes[opt]]
+    return ret + last
+
+
 class CompileOptions(object):
     def __init__(self, lang, sys_includes):
         assert lang is not None
@@ -97,8 +171,11 @@ class CompileOptions(object):
         self.index_parse_type = 13
         self.system_includes  = sys_includes
         self.language_options = None # array
+        self.database_options = None # array, from the compilation database
         self.project_options  = None # array
         self.project_file     = ""
+        self.database_file    = "" # compile_commands.json the options came from
+        self.fingerprint_     = None
         self.language         = lang
 
 
@@ -114,6 +191,10 @@ class CompileOptions(object):
             s = s + '\n'.join(self.language_options)
             s = s + "\n"
 
+        if self.database_options is not None:
+            s = s + '\n'.join(self.database_options)
+            s = s + "\n"
+
         if self.project_options is not None:
             s = s + '\n'.join(self.project_options)
         return s
@@ -129,6 +210,17 @@ class CompileOptions(object):
             return False
         return True
 
+    # get a hash of the compile configuration (language and the arguments
+    # in canonical form) that's the same for options that compile a file
+    # the same way.
+    def fingerprint(self):
+        if self.fingerprint_ == None:
+            # the options from the settings and the project are unicode
+            args = [a.encode("utf-8") if isinstance(a, unicode) else a for a in self.prepare()]
+            args = ["-x" + self.language.key()] + canonicalize_arguments(args)
+            self.fingerprint_ = hashlib.sha1("\0".join(args)).hexdigest()
+        return self.fingerprint_
+
     def prepare(self):
         assert self.system_includes is not None
         opts = []
@@ -137,11 +229,91 @@ class CompileOptions(object):
 
         if self.language_options is not None:
             opts = opts + self.language_options
+        if self.database_options is not None:
+            opts = opts + self.database_options
         if self.project_options is not None:
             opts = opts + self.project_options
         return opts
 
 
+def get_mtime(filename):
+    if filename == None:
+        return None
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+# The compile options collected so far. The options of a file are reused
+# until the project file or the compilation database they came from
+# change or a project file is created closer to the file.
+# create(view, filename, language) makes the CompileOptions of a file and
+# system_includes(language) returns the Future for the system includes
+# create puts in them.
+class CompileOptionsCache(object):
+    def __init__(self, create, system_includes):
+        self.create = create
+        self.system_includes = system_includes
+        # (filename, language) -> (project file, [(file, mtime)], CompileOptions)
+        self.options = LockedVariable({})
+
+    def get(self, view, filename, language):
+        key = (filename, language.key())
+        options = self.options.lock()
+        cached = options.get(key)
+        self.options.unlock()
+        if cached != None:
+            project_file, sources, opts = cached
+            if find_project_file(filename) == project_file:
+                if all([get_mtime(f) == mtime for f, mtime in sources]):
+                    return opts
+
+        # options made before the system includes are found are used
+        # but not kept.
+        pending = not self.system_includes(language).done()
+        opts = self.create(view, filename, language)
+        if pending:
+            return opts
+        project_file = None
+        sources = []
+        if opts.project_file:
+            project_file = opts.project_file
+            sources.append((project_file, get_mtime(project_file)))
+        if opts.database_file:
+            sources.append((opts.database_file, get_mtime(opts.database_file)))
+        options = self.options.lock()
+        options[key] = (project_file, sources, opts)
+        self.options.unlock()
+        return opts
+
+    # forget the options of the file so that they're made again.
+    def forget(self, filename, language):
+        options = self.options.lock()
+        options.pop((filename, language.key()), None)
+        self.options.unlock()
+
+    # forget all the options, for example when the settings change.
+    def clear(self):
+        options = self.options.lock()
+        options.clear()
+        self.options.unlock()
+
+
+# A reparse that has been scheduled but hasn't started yet. A newer
+# request for the same file replaces its contents so that only the
+# latest state of the file gets parsed.
+class ReparseRequest(object):
+    def __init__(self, opts, unsaved_files, on_done, generation):
+        self.future = None
+        self.update(opts, unsaved_files, on_done, generation)
+
+    def update(self, opts, unsaved_files, on_done, generation):
+        self.opts          = opts
+        self.unsaved_files = unsaved_files
+        self.on_done       = on_done
+        self.generation    = generation
+
+
 class TranslationUnitCache(Worker):
     STATUS_PARSING      = 1
     STATUS_REPARSING    = 2
@@ -152,9 +324,238 @@ class TranslationUnitCache(Worker):
         self.as_super = super(TranslationUnitCache, self)
         self.as_super.__init__(num_threads)
         self.translationUnits = LockedVariable({})
-        self.parsingList = LockedVariable([])
-        self.busyList = LockedVariable([])
+        self.parsingList = LockedVariable([]) # a file is listed once per scheduled parse
+        self.pendingParses = LockedVariable({})
+        self.reparseRequests = LockedVariable({}) # filename -> ReparseRequest
+        self.reparseGenerations = {} # filename -> latest request, guarded by reparseRequests
+        self.openFiles = LockedVariable(set())
+        self.dependencies = LockedVariable({}) # filename -> files it includes
+        self.dependents = {} # header -> files including it, guarded by dependencies
         self.index = None
+        self.diskCache = None
+        self.parsePool = None
+        self.preambles = None
+        self.maxCount  = 0 # max number of translation units, 0 for no limit
+        self.maxMemory = 0 # max bytes used by translation units, 0 for no limit
+        self.headerContext = True # parse headers as part of a file including them
+
+    # set the limits used for evicting translation units from the cache.
+    # max_count is the number of translation units to keep around and
+    # max_memory is the number of bytes they're allowed to use (as
+    # reported by libclang). Use 0 to disable a limit.
+    def set_limits(self, max_count, max_memory):
+        self.maxCount  = max_count
+        self.maxMemory = max_memory
+        self.__evict()
+
+    # set the DiskCache used to persist translation units between
+    # sessions or None to not persist them.
+    def set_disk_cache(self, disk_cache):
+        self.diskCache = disk_cache
+
+    # set the PreambleCache used to share precompiled headers between
+    # translation units or None to not share them.
+    def set_preamble_cache(self, preamble_cache):
+        self.preambles = preamble_cache
+
+    # set whether headers are parsed as part of an already parsed
+    # translation unit including them rather than on their own.
+    def set_header_context(self, enabled):
+        self.headerContext = enabled
+
+    # set the ParsePool used to parse translation units out of process
+    # or None to parse them in this process. The translation units parsed
+    # so far are dropped.
+    def set_parse_pool(self, parse_pool):
+        tus = self.translationUnits.lock()
+        try:
+            dropped = tus.values()
+            tus.clear()
+            old = self.parsePool
+            self.parsePool = parse_pool
+        finally:
+            self.translationUnits.unlock()
+        self.__release(dropped)
+        if old != None:
+            old.shutdown()
+
+    # release the translation units that were dropped from the cache.
+    # headers parsed as part of a dropped translation unit go with it.
+    def __release(self, dropped):
+        tus = self.translationUnits.lock()
+        try:
+            for header in [tu for tu in tus.values() if isinstance(tu, HeaderTranslationUnit)]:
+                if header.host in dropped:
+                    del tus[header.filename]
+                    dropped.append(header)
+        finally:
+            self.translationUnits.unlock()
+        for tu in dropped:
+            self.__untrack(tu.filename)
+            if isinstance(tu, RemoteTranslationUnit):
+                tu.release()
+
+    # find a translation unit in the cache that includes the header and
+    # that the header can be parsed as part of. Prefers a source file with
+    # the same name, then the files that are open and then the most
+    # recently used ones. Returns None if there's no such translation unit.
+    def __find_host(self, filename, opts):
+        header = os.path.abspath(filename)
+        self.dependencies.lock()
+        files = list(self.dependents.get(header, set()))
+        self.dependencies.unlock()
+        if len(files) == 0:
+            return None
+
+        stem = os.path.splitext(header)[0]
+        hosts = []
+        tus = self.translationUnits.lock()
+        of = self.openFiles.lock()
+        try:
+            for f in files:
+                tu = tus.get(f)
+                # the header can't be replaced with the buffer contents if
+                # it's in the precompiled header the host was parsed with
+                # and a translation unit loaded from the disk can't be
+                # reparsed at all.
+                if tu == None or type(tu) != TranslationUnit or tu.from_disk or \
+                        tu.opts.language.key() != opts.language.key():
+                    continue
+                if tu.preamble != None and (self.preambles == None or \
+                        header in self.preambles.get_headers(tu.preamble) or \
+                        not self.preambles.is_current(tu.preamble)):
+                    continue
+                same_name = os.path.splitext(os.path.abspath(f))[0] == stem
+                hosts.append(((same_name, f in of, tu.last_used), tu))
+        finally:
+            self.openFiles.unlock()
+            self.translationUnits.unlock()
+        if len(hosts) == 0:
+            return None
+        hosts.sort(key=lambda h: h[0])
+        return hosts[-1][1]
+
+    # record the files the translation unit depends on.
+    def __track(self, tu):
+        includes = set(tu.includes)
+        if tu.preamble != None and self.preambles != None:
+            includes = includes | self.preambles.get_headers(tu.preamble)
+        deps = self.dependencies.lock()
+        try:
+            for header in deps.get(tu.filename, set()) - includes:
+                self.dependents[header].discard(tu.filename)
+                if len(self.dependents[header]) == 0:
+                    del self.dependents[header]
+            for header in includes:
+                self.dependents.setdefault(header, set()).add(tu.filename)
+            deps[tu.filename] = includes
+        finally:
+            self.dependencies.unlock()
+
+    def __untrack(self, filename):
+        deps = self.dependencies.lock()
+        try:
+            for header in deps.pop(filename, set()):
+                self.dependents[header].discard(filename)
+                if len(self.dependents[header]) == 0:
+                    del self.dependents[header]
+        finally:
+            self.dependencies.unlock()
+
+    # the file has been changed on the disk. Reparse the translation
+    # units that include it in the background, with the buffers they
+    # were last parsed with so that unsaved edits aren't lost. The
+    # buffer of the changed file itself is what was just saved.
+    def file_changed(self, filename):
+        filename = os.path.abspath(filename)
+        if self.preambles != None:
+            for preamble in self.preambles.file_changed(filename):
+                self.schedule(self.__task_build_preamble, preamble, None, TaskPriority.BACKGROUND)
+
+        self.dependencies.lock()
+        files = list(self.dependents.get(filename, set()))
+        self.dependencies.unlock()
+
+        tus = self.translationUnits.lock()
+        try:
+            affected = [tus[f] for f in files if f in tus]
+        finally:
+            self.translationUnits.unlock()
+        for tu in affected:
+            unsaved_files = [(name, value) for name, value in tu.unsaved_files if os.path.abspath(name) != filename]
+            self.reparse(tu.filename, tu.opts, unsaved_files, None, TaskPriority.BACKGROUND, True)
+        if len(affected):
+            self.set_status("%s changed, reparsing %d dependent file(s)" % (os.path.basename(filename), len(affected)))
+
+    # tell the cache whether the file is currently open in some view.
+    # translation units for files that are not open are evicted first.
+    def set_file_open(self, filename, is_open):
+        of = self.openFiles.lock()
+        try:
+            if is_open:
+                of.add(filename)
+            else:
+                of.discard(filename)
+        finally:
+            self.openFiles.unlock()
+
+    def __is_over_limits(self, count, memory):
+        if self.maxCount > 0 and count > self.maxCount:
+            return True
+        if self.maxMemory > 0 and memory > self.maxMemory:
+            return True
+        return False
+
+    # evict least recently used translation units until the cache
+    # is within its limits again. Translation units without an open view
+    # go first. The translation unit for keep and the ones currently
+    # being parsed are never evicted.
+    def __evict(self, keep=None):
+        if self.maxCount <= 0 and self.maxMemory <= 0:
+            return
+        evicted = []
+        tus = self.translationUnits.lock()
+        pl = self.parsingList.lock()
+        of = self.openFiles.lock()
+        try:
+            count  = len(tus)
+            memory = sum([tu.memory_usage for tu in tus.values()])
+            if not self.__is_over_limits(count, memory):
+                return
+            candidates = [tu for name, tu in tus.items() if name != keep and name not in pl]
+            candidates.sort(key=lambda tu: (tu.filename in of, tu.last_used))
+            for tu in candidates:
+                if not self.__is_over_limits(count, memory):
+                    break
+                del tus[tu.filename]
+                count  -= 1
+                memory -= tu.memory_usage
+                evicted.append(tu)
+        finally:
+            self.openFiles.unlock()
+            self.parsingList.unlock()
+            self.translationUnits.unlock()
+
+        self.__release(evicted)
+        stats.count("evictions", len(evicted))
+        if len(evicted):
+            self.set_status("Evicted %d translation unit(s) from the cache" % len(evicted))
+
+    # get the statistics collected by the cache.
+    def get_stats(self):
+        ret = stats.as_dict()
+        tus = self.translationUnits.lock()
+        try:
+            ret["live_translation_units"] = len(tus)
+            ret["memory_usage"] = sum([tu.memory_usage for tu in tus.values()])
+        finally:
+            self.translationUnits.unlock()
+        depths = self.tasks.depths()
+        ret["queue_depth"] = dict([(TaskPriority.NAMES[i], n) for i, n in enumerate(depths)])
+        return ret
+
+    def task_started(self, priority, waited):
+        stats.record_wait(TaskPriority.NAMES[priority], waited)
 
     def get_status(self, filename):
         tu = self.translationUnits.lock()
@@ -176,175 +577,317 @@ class TranslationUnitCache(Worker):
     def __display_status(self):
         self.as_super.__display_status()
 
-    def __add_busy(self, filename, task, data):
-        bl = self.busyList.lock()
-        test = filename in bl
-
-        if test:
-            self.busyList.unlock()
-            # Another thread is already doing something with
-            # this file, so try again later
-            if self.tasks.empty():
-                try:
-                    time.sleep(1)
-                except:
-                    pass
-            self.tasks.put((task, data))
-            return True
-        else:
-            bl.append(filename)
-            self.busyList.unlock()
-        return False
-
-    def __remove_busy(self, filename):
-        bl = self.busyList.lock()
+    def __remove_parsing(self, filename):
+        l = self.parsingList.lock()
         try:
-            bl.remove(filename)
+            l.remove(filename)
         finally:
-            self.busyList.unlock()
+            self.parsingList.unlock()
 
     def __task_parse(self, data):
         filename, opts, on_done = data
-        if self.__add_busy(filename, self.__task_parse, data):
-            return
         try:
             self.set_status("Parsing %s" % filename)
             self.get_translation_unit(filename, opts)
             self.set_status("Parsing %s done" % filename)
         finally:
-            l = self.parsingList.lock()
-            try:
-                l.remove(filename)
-            finally:
-                self.parsingList.unlock()
-                self.__remove_busy(filename)
+            self.__remove_parsing(filename)
         if on_done != None:
             run_in_main_thread(on_done)
 
     def __task_reparse(self, data):
-        filename, opts, unsaved_files, on_done = data
-        if self.__add_busy(filename, self.__task_reparse, data):
-            return
+        filename, request = data
+        requests = self.reparseRequests.lock()
+        try:
+            # requests from here on schedule a new reparse.
+            del requests[filename]
+            opts, unsaved_files = request.opts, request.unsaved_files
+        finally:
+            self.reparseRequests.unlock()
+        start = time.time()
         try:
             self.set_status("Reparsing %s" % filename)
             tu = self.get_translation_unit(filename, opts, unsaved_files)
-            if tu != None:
+            if tu != None and tu.from_disk and len(unsaved_files) == 0 and \
+                    self.diskCache.is_current(filename, tu.fingerprint):
+                # nothing it was loaded from has changed since, so it's
+                # what a reparse would give.
+                stats.count("disk_reparses_skipped")
+                self.set_status("Reparsing %s done" % filename)
+            elif tu != None and (tu.from_disk or self.__has_stale_preamble(tu)):
+                # a translation unit loaded from the disk can't be reparsed
+                # and neither can one whose precompiled header is out of
+                # date, so parse the file from scratch instead.
+                self.__replace(tu, opts, unsaved_files)
+                self.set_status("Reparsing %s done" % filename)
+            elif tu != None:
                 tu.reparse(unsaved_files)
+                self.__track(tu)
+                stats.record(filename, "reparse", time.time() - start)
                 self.set_status("Reparsing %s done" % filename)
+                self.__evict(filename)
 
         finally:
-            l = self.parsingList.lock()
-            try:
-                l.remove(filename)
-            finally:
-                self.parsingList.unlock()
-                self.__remove_busy(filename)
-        if on_done != None:
-            run_in_main_thread(on_done)
+            self.__remove_parsing(filename)
+
+        # only the latest request gets to know the file was parsed, the
+        # ones before it were superseded.
+        self.reparseRequests.lock()
+        latest = self.reparseGenerations[filename] == request.generation
+        self.reparseRequests.unlock()
+        if latest and request.on_done != None:
+            run_in_main_thread(request.on_done)
+
+    # parse the file of the translation unit from scratch and put the
+    # result in its place. The old one answers requests until then.
+    def __replace(self, tu, opts, unsaved_files):
+        args = opts.prepare()
+        args.append(tu.filename)
+        fresh = self.__parse(tu.filename, opts, args, unsaved_files, False)
+        fresh.args = args
+        fresh.fingerprint = opts.fingerprint()
+        tus = self.translationUnits.lock()
+        try:
+            # removed meanwhile
+            if tus.get(tu.filename) is not tu:
+                return
+            tus[tu.filename] = fresh
+        finally:
+            self.translationUnits.unlock()
+        self.__release([tu])
+        self.__track(fresh)
+        self.__evict(fresh.filename)
+
+    def __has_stale_preamble(self, tu):
+        return tu.preamble != None and self.preambles != None and not self.preambles.is_current(tu.preamble)
 
-    def __task_clear(self, data):
+    def __task_clear(self, persistent):
         tus = self.translationUnits.lock()
         try:
+            dropped = tus.values()
             tus.clear()
 
             # todo refactor this
             #searchcache.clear()
         finally:
             self.translationUnits.unlock()
+        self.__release(dropped)
+        if persistent and self.diskCache != None:
+            self.diskCache.clear()
+
+    def __task_store(self, tu):
+        if self.diskCache != None and tu.store(self.diskCache):
+            self.set_status("Saved %s in the persistent cache" % tu.filename)
+
+    def __task_build_preamble(self, preamble):
+        self.set_status("Building a shared preamble of %d include(s)" % len(preamble.includes))
+        start = time.time()
+        if self.preambles.build(self.index, preamble):
+            stats.record("<shared preamble>", "build", time.time() - start)
+            self.set_status("Building a shared preamble of %d include(s) done" % len(preamble.includes))
+        else:
+            self.set_status("Building a shared preamble failed")
 
     def __task_remove(self, data):
-        if self.__add_busy(data, self.__task_remove, data):
-            return
+        dropped = []
+        tus = self.translationUnits.lock()
         try:
-            tus = self.translationUnits.lock()
-            try:
-                if data in tus:
-                    del tus[data]
-            finally:
-                self.translationUnits.unlock()
+            if data in tus:
+                dropped.append(tus[data])
+                del tus[data]
         finally:
-            self.__remove_busy(data)
-
-    def reparse(self, filename, opts, unsaved_files=[], on_done=None):
-        ret = False
-        pl = self.parsingList.lock()
+            self.translationUnits.unlock()
+        self.__release(dropped)
+
+    # Tasks operating on a file are serialized per file, a task
+    # scheduled while another one is working on the same file is
+    # chained to run after it. The scheduling functions return a
+    # Future for the task or None if nothing was scheduled.
+
+    # reparse the file. if a reparse of the file is still waiting to
+    # start it's updated to parse this state of the file instead and
+    # the callback of the earlier request is dropped. A refresh is a
+    # reparse because a file the file includes has changed, a reparse
+    # still waiting to start sees the change anyway so it's left as it
+    # is, with its callback, unsaved files and priority.
+    def reparse(self, filename, opts, unsaved_files=[], on_done=None, priority=TaskPriority.INTERACTIVE, refresh=False):
+        requests = self.reparseRequests.lock()
         try:
-            if filename not in pl:
-                ret = True
-                pl.append(filename)
-                self.tasks.put((
-                    self.__task_reparse,
-                    (filename, opts, unsaved_files, on_done)))
-        finally:
+            generation = self.reparseGenerations.get(filename, 0) + 1
+            self.reparseGenerations[filename] = generation
+            request = requests.get(filename)
+            if request != None and refresh:
+                request.generation = generation
+                return request.future
+            if request != None:
+                request.update(opts, unsaved_files, on_done, generation)
+                self.promote(filename, priority)
+                return request.future
+
+            request = ReparseRequest(opts, unsaved_files, on_done, generation)
+            requests[filename] = request
+            pl = self.parsingList.lock()
+            pl.append(filename)
             self.parsingList.unlock()
-        return ret
-
-    def add_ex(self, filename, opts, on_done=None):
-        tu = self.translationUnits.lock()
-        pl = self.parsingList.lock()
-        try:
-            if filename not in tu and filename not in pl:
-                pl.append(filename)
-                self.tasks.put((
-                    self.__task_parse,
-                    (filename, opts, on_done)))
+            request.future = self.schedule(self.__task_reparse,
+                (filename, request), filename, priority)
         finally:
-            self.translationUnits.unlock()
-            self.parsingList.unlock()
+            self.reparseRequests.unlock()
+        return request.future
+
+    def add_ex(self, filename, opts, on_done=None, priority=TaskPriority.VISIBLE):
+        return self.prepare(filename, opts, on_done, priority)
 
-    def prepare(self, filename, opts, on_done=None):
-        ret = False
+    def prepare(self, filename, opts, on_done=None, priority=TaskPriority.BACKGROUND):
+        future = None
         tu = self.translationUnits.lock()
         pl = self.parsingList.lock()
         try:
             if filename not in tu and filename not in pl:
-                ret = True
                 pl.append(filename)
-                self.tasks.put((
-                    self.__task_parse,
-                    (filename, opts, on_done)))
+                future = self.schedule(self.__task_parse,
+                    (filename, opts, on_done), filename, priority)
+            elif filename in pl:
+                self.promote(filename, priority)
         finally:
             self.translationUnits.unlock()
             self.parsingList.unlock()
-        return ret
-
+        return future
+
+
+    def __parse(self, filename, opts, args, unsaved_files, use_disk_cache):
+        fingerprint = opts.fingerprint()
+        if self.diskCache != None and use_disk_cache and len(unsaved_files) == 0:
+            start = time.time()
+            blob = self.diskCache.load(self.index, filename, fingerprint)
+            if blob != None:
+                stats.count("disk_hits")
+                stats.record(filename, "load", time.time() - start)
+                tu = TranslationUnit(blob, filename, opts)
+                tu.from_disk = True
+                return tu
+
+        pch = None
+        if self.preambles != None:
+            pch, preamble = self.preambles.get(filename, fingerprint, args, opts.language.key(),
+                dict(unsaved_files).get(filename))
+            if preamble != None:
+                self.schedule(self.__task_build_preamble, preamble, None, TaskPriority.BACKGROUND)
+        if pch != None:
+            tu = self.__parse_with(filename, opts, args[:-1] + ["-include-pch", pch] + args[-1:], unsaved_files)
+            if not self.preambles.is_rejected(tu, pch):
+                tu.preamble = pch
+                return tu
+            # the preamble has gone stale, rebuild it and parse without.
+            stats.count("preamble_rejections")
+            preamble = self.preambles.invalidate(pch)
+            if preamble != None:
+                self.schedule(self.__task_build_preamble, preamble, None, TaskPriority.BACKGROUND)
+
+        return self.__parse_with(filename, opts, args, unsaved_files)
+
+    def __parse_with(self, filename, opts, args, unsaved_files):
+        start = time.time()
+        blob = self.index.parse(None, args, unsaved_files, opts.index_type)
+        assert blob is not None
+        stats.record(filename, "parse", time.time() - start)
+        tu = TranslationUnit(blob, filename, opts)
+        tu.dirty = len(unsaved_files) > 0
+        tu.unsaved = set([name for name, value in unsaved_files])
+        tu.unsaved_files = list(unsaved_files)
+        return tu
 
-    def get_translation_unit(self, filename, opts, unsaved_files=[]):
+    # get the translation unit for the file, parsing it if needed.
+    # if use_disk_cache is True the translation unit can be loaded from
+    # the persistent disk cache instead of parsing it.
+    def get_translation_unit(self, filename, opts, unsaved_files=[], use_disk_cache=True):
         if self.index == None:
             self.index = cindex.Index.create()
         tu = None
         tus = self.translationUnits.lock()
         args = opts.prepare()
         args.append(filename)
+        fingerprint = opts.fingerprint()
 
         if filename not in tus:
+            # Only one thread gets to parse the file with the given
+            # arguments at a time, anyone else asking for the same
+            # translation unit meanwhile waits for that result.
+            key = (filename, fingerprint)
+            pending = self.pendingParses.lock()
+            future = pending.get(key)
+            is_owner = future == None
+            if is_owner:
+                future = Future()
+                pending[key] = future
+            self.pendingParses.unlock()
             self.translationUnits.unlock()
 
-            blob = self.index.parse(None, args, unsaved_files, opts.index_type)
-            assert blob is not None
+            if not is_owner:
+                stats.count("joined_parses")
+                return future.result()
+            stats.count("misses")
 
-            tu = TranslationUnit(blob, filename, opts)
-            tu.args = args
-            tus = self.translationUnits.lock()
-            tus[filename] = tu
-            self.translationUnits.unlock()
+            try:
+                if self.parsePool != None:
+                    # the helper processes keep their own translation units,
+                    # the persistent cache is only used when parsing here.
+                    start = time.time()
+                    tu = RemoteTranslationUnit(self.parsePool, filename, opts, args, unsaved_files)
+                    stats.record(filename, "parse", time.time() - start)
+                else:
+                    host = None
+                    if self.headerContext:
+                        host = self.__find_host(filename, opts)
+                    if host != None:
+                        stats.count("header_context_hits")
+                        tu = HeaderTranslationUnit(host, filename, opts)
+                        if len(unsaved_files):
+                            tu.reparse(unsaved_files)
+                    else:
+                        tu = self.__parse(filename, opts, args, unsaved_files, use_disk_cache)
+                # the arguments without the shared preamble
+                tu.args = args
+                tu.fingerprint = fingerprint
+                tus = self.translationUnits.lock()
+                tus[filename] = tu
+                self.translationUnits.unlock()
+                self.__track(tu)
+            except:
+                future.set_error(sys.exc_info()[1])
+                raise
+            finally:
+                pending = self.pendingParses.lock()
+                del pending[key]
+                self.pendingParses.unlock()
+            future.set_result(tu)
+            self.__evict(filename)
+            if self.diskCache != None and self.parsePool == None and not tu.from_disk and not tu.dirty:
+                self.schedule(self.__task_store, tu, filename, TaskPriority.BACKGROUND)
         else:
             tu = tus[filename]
-            recompile = tu.args != args
+            tu.touch()
+            stats.count("hits")
+            recompile = tu.fingerprint != fingerprint
 
             if recompile:
                 del tus[filename]
             self.translationUnits.unlock()
 
             if recompile:
-                self.set_status("Options change detected. Will recompile %s" % filename)
-                self.add_ex(filename, opts, None)
+                # the released unit is gone for good (a remote one from its
+                # helper process), parse the file again in its place.
+                self.__release([tu])
+                self.set_status("Options change detected. Recompiling %s" % filename)
+                return self.get_translation_unit(filename, opts, unsaved_files, use_disk_cache)
         return tu
 
     def remove(self, filename):
-        self.tasks.put((self.__task_remove, filename))
+        return self.schedule(self.__task_remove, filename, filename, TaskPriority.BACKGROUND)
 
-    def clear(self):
-        self.tasks.put((self.__task_clear, None))
+    # drop all the translation units. The ones saved on the disk are kept
+    # unless persistent is True, they're keyed on the options anyway.
+    def clear(self, persistent=False):
+        return self.schedule(self.__task_clear, persistent, None, TaskPriority.INTERACTIVE)
 
 tuCache =  None #TranslationUnitCache()
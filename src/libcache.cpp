@@ -34,9 +34,13 @@ freely, subject to the following restrictions:
 #include <string.h>
 #include <vector>
 #include <map>
+#include <set>
+#include <unordered_map>
 #include <algorithm>
 #include <assert.h>
+#include <ctype.h>
 #include <memory>
+#include <mutex>
 #include "libcache.h"
 
 static const char* getCursorKindName(CXCursorKind c)
@@ -589,55 +593,36 @@ void trim(EntryList& mEntries)
 class EntryCompare
 {
 public:
-    bool operator()(const std::shared_ptr<CacheEntry> a, const std::shared_ptr<CacheEntry> b) const
+    bool operator()(const CacheEntry* a, const CacheEntry* b) const
     {
         if (!b)
             return false;
         return strcmp(a->display, b->display) < 0;
     }
 };
-class EntryStringCompare
+// compare the beginning of the display string of an entry to a prefix
+// whose length is known up front.
+class EntryPrefixCompare
 {
 public:
-    EntryStringCompare(bool exact=false)
-        : mExact(exact)
+    EntryPrefixCompare(const char *prefix)
+        : mPrefix(prefix), mLength(strlen(prefix))
     {
 
     }
-
-    bool operator()(const std::shared_ptr<CacheEntry> a, const char *str) const
+    bool operator()(const CacheEntry* a, const char *str) const
     {
-        return compare(a, str) < 0;
+        return strncmp(a->display, mPrefix, mLength) < 0;
     }
-    bool operator()(const char *str, const std::shared_ptr<CacheEntry> a) const
+    bool operator()(const char *str, const CacheEntry* a) const
     {
-        return compare(a, str) > 0;
+        return strncmp(a->display, mPrefix, mLength) > 0;
     }
 private:
-    int compare(const std::shared_ptr<CacheEntry> a, const char *str) const
-    {
-        size_t length;
-
-        if (mExact)
-        {
-            char * off = strchr(a->display, '\t');
-            length = strlen(a->display);
-            if (off != NULL)
-            {
-                length = off - a->display;
-            }
-            length = std::max(strlen(str), length);
-        }
-        else
-            length = strlen(str);
-
-        return strncmp(a->display, str, length);
-    }
-    bool mExact;
+    const char * mPrefix;
+    size_t       mLength;
 };
 
-
-
 CXCursor get_using_cursor(CXCursor cursor, CXCursorKind ck)
 {
     CursorList cur;
@@ -659,22 +644,356 @@ CXCursor get_using_cursor(CXCursor cursor, CXCursorKind ck)
 }
 
 
+// the typed text of a completion string, the part the results of
+// clang_codeCompleteAt are sorted by.
+std::string get_typed_text(CXCompletionString comp)
+{
+    const unsigned int count = clang_getNumCompletionChunks(comp);
+    for (unsigned int i = 0; i < count; i++)
+    {
+        if (clang_getCompletionChunkKind(comp, i) == CXCompletionChunk_TypedText)
+        {
+            CXString s = clang_getCompletionChunkText(comp, i);
+            std::string ret(clang_getCString(s));
+            clang_disposeString(s);
+            return ret;
+        }
+    }
+    return "";
+}
+
+// compare the beginning of the typed text of a completion result to a
+// prefix ignoring case, which is how clang_sortCodeCompletionResults
+// orders the results. The results without a typed text (the overload
+// candidates of a call) are sorted after all the others.
+class CompletionPrefixCompare
+{
+public:
+    CompletionPrefixCompare(const char *prefix)
+        : mPrefix(prefix), mLength(strlen(prefix))
+    {
+
+    }
+    bool operator()(const CXCompletionResult& a, const char *str) const
+    {
+        return compare(a) < 0;
+    }
+    bool operator()(const char *str, const CXCompletionResult& a) const
+    {
+        return compare(a) > 0;
+    }
+private:
+    int compare(const CXCompletionResult& a) const
+    {
+        const std::string typed = get_typed_text(a.CompletionString);
+        if (typed.empty())
+            return 1;
+        for (size_t i = 0; i < mLength; i++)
+        {
+            const int c1 = i < typed.length() ? tolower((unsigned char) typed[i]) : 0;
+            const int c2 = tolower((unsigned char) mPrefix[i]);
+            if (c1 != c2)
+                return c1 - c2;
+        }
+        return 0;
+    }
+    const char * mPrefix;
+    size_t       mLength;
+};
+
+// orders completion results by their priority, more likely ones first,
+// keeping the sorted order between results of the same priority.
+class CompletionPriorityCompare
+{
+public:
+    CompletionPriorityCompare(const CXCompletionResult* results)
+        : mResults(results)
+    {
+
+    }
+    bool operator()(unsigned int a, unsigned int b) const
+    {
+        const unsigned int pa = clang_getCompletionPriority(mResults[a].CompletionString);
+        const unsigned int pb = clang_getCompletionPriority(mResults[b].CompletionString);
+        if (pa != pb)
+            return pa < pb;
+        return a < b;
+    }
+private:
+    const CXCompletionResult* mResults;
+};
+
+// The display and insert strings made for a cursor.
+struct CacheFormat
+{
+    CXCursorKind       kind;
+    unsigned long long identity; // see get_identity
+    const char *       display;
+    const char *       insert;
+};
+
+// A hash of what tells a declaration apart from another of the same kind
+// in the same place, its USR and its type. A declaration whose text
+// depends on macros defined before its file is included gets a
+// different identity when those macros change.
+unsigned long long get_identity(CXCursor cursor)
+{
+    // FNV-1a
+    unsigned long long hash = 14695981039346656037ull;
+    CXString strings[2] = {clang_getCursorUSR(cursor), clang_getTypeSpelling(clang_getCursorType(cursor))};
+    for (int i = 0; i < 2; i++)
+    {
+        const char* str = clang_getCString(strings[i]);
+        for (; str && *str; str++)
+            hash = (hash ^ (unsigned char)*str) * 1099511628211ull;
+        hash = hash * 1099511628211ull; // the separator
+        clang_disposeString(strings[i]);
+    }
+    return hash;
+}
+
+// The strings made for the cursors of one file, in the order the cursors
+// were visited, along with the pools they are in. Once made they don't
+// change so they can be shared by the partitions of the same file in
+// later caches of the translation unit and in the caches of other
+// translation units.
+struct PartitionFormats
+{
+    std::vector<CacheFormat>                        list;
+    std::vector<unsigned int>                       order;   // see CachePartition::order
+    std::vector<std::shared_ptr<const StringPool> > strings;
+};
+
+// The top level declarations of one file. When the translation unit is
+// reparsed and the file hasn't changed the same declarations are visited
+// again in the same order, so the strings made for them the last time
+// can be used again instead of formatting every cursor anew. The cursors
+// themselves don't survive a reparse, the entries are made again with
+// the new ones.
+class CachePartition
+{
+public:
+    CachePartition(const std::string& f, time_t t)
+    : file(f), mtime(t)
+    {}
+
+    std::string               file;
+    time_t                    mtime;
+    std::shared_ptr<const PartitionFormats> formats;
+    EntryList                 entries; // in the order they were made
+    std::vector<unsigned int> order;   // indices of entries in sorted order
+};
+
+// The formats of the headers of all the caches in the process. The same
+// system and library headers are included by most translation units, so
+// they're formatted once and their strings are kept once instead of once
+// per translation unit. Formats are keyed by the file, its modification
+// time and a context given by the caller that tells apart translation
+// units compiled with different options. The macros defined before a
+// header is included can still differ, so the formats are only replayed
+// for cursors with the identity they were made for. Only weak references
+// are kept here, the formats and the pools of their strings go away with
+// the last partition using them.
+class SharedFormats
+{
+public:
+    SharedFormats() : mSwept(0)
+    {}
+
+    std::shared_ptr<const PartitionFormats> find(const std::string& context, const std::string& file, time_t mtime)
+    {
+        std::lock_guard<std::mutex> lock(mLock);
+        std::map<std::string, std::weak_ptr<const PartitionFormats> >::iterator i = mFormats.find(getKey(context, file, mtime));
+        if (i == mFormats.end())
+            return std::shared_ptr<const PartitionFormats>();
+        return i->second.lock();
+    }
+
+    void publish(const std::string& context, const std::string& file, time_t mtime, const std::shared_ptr<const PartitionFormats>& formats)
+    {
+        std::lock_guard<std::mutex> lock(mLock);
+        mFormats[getKey(context, file, mtime)] = formats;
+        // forget the formats nobody uses any more once there could be
+        // as many of them as there are formats in use.
+        if (mFormats.size() > 2 * mSwept)
+        {
+            std::map<std::string, std::weak_ptr<const PartitionFormats> >::iterator i = mFormats.begin();
+            while (i != mFormats.end())
+            {
+                if (i->second.expired())
+                    mFormats.erase(i++);
+                else
+                    ++i;
+            }
+            mSwept = mFormats.size();
+        }
+    }
+
+    // the number of files with formats in use in the context.
+    size_t count(const std::string& context)
+    {
+        std::lock_guard<std::mutex> lock(mLock);
+        const std::string prefix = context + '\0';
+        size_t ret = 0;
+        for (std::map<std::string, std::weak_ptr<const PartitionFormats> >::iterator i = mFormats.begin(); i != mFormats.end(); ++i)
+        {
+            if (i->first.compare(0, prefix.size(), prefix) == 0 && !i->second.expired())
+                ret++;
+        }
+        return ret;
+    }
+
+private:
+    static std::string getKey(const std::string& context, const std::string& file, time_t mtime)
+    {
+        char buf[32];
+        snprintf(buf, sizeof(buf), "%lld", (long long) mtime);
+        return context + '\0' + file + '\0' + buf;
+    }
+
+    std::mutex mLock;
+    std::map<std::string, std::weak_ptr<const PartitionFormats> > mFormats;
+    size_t     mSwept; // number of formats after the last sweep
+};
+
+static SharedFormats g_sharedFormats;
+
+size_t getSharedFormatsCount(const char* context)
+{
+    return g_sharedFormats.count(context);
+}
+
+// Makes the display and insert strings for cursors. With the formats of
+// an earlier partition of the same file the strings recorded in them are
+// replayed for as long as the visited cursors have the same kind and
+// identity as the recorded ones. Only the cursors in the file of the
+// partition are recorded and replayed. The strings of the recorded formats
+// go to strings, those of the other cursors to the pool of the entries.
+class CacheFormatter
+{
+public:
+    CacheFormatter(const std::shared_ptr<StringPool>& strings, StringPool& other, CXFile file, std::shared_ptr<const PartitionFormats> source)
+    : mStrings(strings), mOther(other), mFile(file), mSource(std::move(source)), mReplayed(0), mFormatted(false)
+    {}
+
+    // whether the cursor is in the file of the partition. Cursors from
+    // other files (base classes declared elsewhere) may have changed
+    // even if this file hasn't, so they aren't recorded.
+    bool covers(CXCursor cursor) const
+    {
+        CXFile file = NULL;
+        clang_getExpansionLocation(clang_getCursorLocation(cursor), &file, NULL, NULL, NULL);
+        return file == mFile;
+    }
+
+    void format(CXCursor cursor, CXCursorKind ck, const char*& disp, const char*& ins)
+    {
+        // a file included in the middle of a declaration, an enum for example
+        if (!covers(cursor))
+        {
+            std::string i;
+            std::string d;
+            parse_res(i, d, cursor);
+            disp = mOther.intern(d.c_str());
+            ins  = mOther.intern(i.c_str());
+            return;
+        }
+        const unsigned long long identity = get_identity(cursor);
+        if (!mFormatted && mSource && mReplayed < mSource->list.size() &&
+            mSource->list[mReplayed].kind == ck && mSource->list[mReplayed].identity == identity)
+        {
+            mFormats.push_back(mSource->list[mReplayed++]);
+        }
+        else
+        {
+            mFormatted = true;
+            std::string i;
+            std::string d;
+            parse_res(i, d, cursor);
+            CacheFormat f = {ck, identity, mStrings->intern(d.c_str()), mStrings->intern(i.c_str())};
+            mFormats.push_back(f);
+        }
+        disp = mFormats.back().display;
+        ins  = mFormats.back().insert;
+    }
+
+    // whether everything in the source formats was replayed and nothing else.
+    bool replayedAll() const
+    {
+        return mSource && !mFormatted && mReplayed == mSource->list.size();
+    }
+
+    const std::shared_ptr<const PartitionFormats>& getSource() const
+    {
+        return mSource;
+    }
+
+    // the formats recorded, with the pools of their strings.
+    std::shared_ptr<PartitionFormats> finish()
+    {
+        std::shared_ptr<PartitionFormats> ret = std::make_shared<PartitionFormats>();
+        ret->list.swap(mFormats);
+        if (mReplayed > 0)
+            ret->strings = mSource->strings;
+        if (mFormatted)
+            ret->strings.push_back(mStrings);
+        return ret;
+    }
+
+private:
+    std::shared_ptr<StringPool>             mStrings;
+    StringPool&                             mOther;
+    CXFile                                  mFile;
+    std::shared_ptr<const PartitionFormats> mSource;
+    std::vector<CacheFormat>                mFormats;
+    size_t                                  mReplayed;
+    bool                                    mFormatted; // whether anything wasn't replayed
+};
+
 class CompletionVisitorData
 {
 public:
-    CompletionVisitorData(EntryList& e, CX_CXXAccessSpecifier a=CX_CXXPrivate, bool base=false)
-    : entries(e), access(a), isBaseClass(base)
+    CompletionVisitorData(EntryStore& s, EntryList& e, CX_CXXAccessSpecifier a=CX_CXXPrivate, bool base=false, CacheFormatter* f=NULL)
+    : store(s), entries(e), access(a), isBaseClass(base), formatter(f), constructorsOnly(false)
     {
     }
 
     void visit_children(CXCursor cursor)
     {
         clang_visitChildren(cursor, get_completion_children, this);
+        visit_anonymous_fields();
+    }
+
+    // visit a single cursor as if it was visited as a child of parent.
+    void visit(CXCursor cursor, CXCursor parent)
+    {
+        if (get_completion_children(cursor, parent, this) == CXChildVisit_Recurse)
+            clang_visitChildren(cursor, get_completion_children, this);
+    }
+
+    void visit_anonymous_fields()
+    {
         for (CursorList::iterator i = mAnonymousFields.begin(); i < mAnonymousFields.end(); i++)
         {
-            CompletionVisitorData d(entries, access, isBaseClass);
+            CompletionVisitorData d(store, entries, access, isBaseClass, formatter);
+            d.constructorsOnly = constructorsOnly;
             d.visit_children(*i);
         }
+        mAnonymousFields.clear();
+    }
+
+    void format(CXCursor cursor, CXCursorKind ck, const char*& disp, const char*& ins)
+    {
+        if (formatter)
+        {
+            formatter->format(cursor, ck, disp, ins);
+            return;
+        }
+        std::string i;
+        std::string d;
+        parse_res(i, d, cursor);
+        disp = store.getStrings().intern(d.c_str());
+        ins  = store.getStrings().intern(i.c_str());
     }
 
     void add_completion_children(CXCursor cursor, CXCursorKind ck, bool &recurse)
@@ -722,13 +1041,16 @@ public:
             case CXCursor_MacroDefinition:
             case CXCursor_Constructor:
             {
-                std::string ins;
-                std::string disp;
-                parse_res(ins, disp, cursor);
-                if (ins.length() != 0)
+                // only the constructors are wanted, don't bother
+                // formatting anything else.
+                if (constructorsOnly && ck != CXCursor_Constructor)
+                    break;
+                const char *ins  = NULL;
+                const char *disp = NULL;
+                format(cursor, ck, disp, ins);
+                if (ins[0] != '\0')
                 {
-                    std::shared_ptr<CacheEntry> entry(new CacheEntry(cursor, disp, ins, access, isBaseClass));
-                    entries.push_back(entry);
+                    entries.push_back(store.addInterned(CacheEntry(cursor, disp, ins, access, isBaseClass)));
                 }
                 else if (ck == CXCursor_StructDecl || ck == CXCursor_UnionDecl)
                 {
@@ -765,9 +1087,12 @@ public:
         }
     }
     CursorList            mParents;
+    EntryStore &          store;
     EntryList &           entries;
     CX_CXXAccessSpecifier access;
     bool                  isBaseClass;
+    CacheFormatter*       formatter;
+    bool                  constructorsOnly;
 
     void addConstructors(CXCursor cursor, CXCursorKind ck)
     {
@@ -777,14 +1102,14 @@ public:
             case CXCursor_StructDecl:
             case CXCursor_ClassDecl:
             {
-                CursorList children;
                 EntryList e;
-                CompletionVisitorData d(e, access);
+                CompletionVisitorData d(store, e, access, false, formatter);
+                d.constructorsOnly = true;
                 d.visit_children(cursor);
                 for (EntryList::iterator i = e.begin(); i < e.end(); i++)
                 {
-                    std::shared_ptr<CacheEntry> entry = *i;
-                    if (clang_getCursorKind(entry->cursor) == CXCursor_Constructor && entry->access == CX_CXXPublic)
+                    const CacheEntry* entry = *i;
+                    if (entry->access == CX_CXXPublic)
                         entries.push_back(entry);
                 }
                 break;
@@ -818,7 +1143,9 @@ private:
                 if (!clang_Cursor_isNull(ref) && !clang_isInvalid(clang_getCursorKind(ref)) && !clang_equalCursors(ref, parent))
                 {
                     data->mParents.push_back(ref);
-                    CompletionVisitorData d(data->entries, ck == CXCursor_CXXBaseSpecifier ? CX_CXXPrivate : CX_CXXProtected, true);
+                    CacheFormatter* f = data->formatter && data->formatter->covers(ref) ? data->formatter : NULL;
+                    CompletionVisitorData d(data->store, data->entries, ck == CXCursor_CXXBaseSpecifier ? CX_CXXPrivate : CX_CXXProtected, true, f);
+                    d.constructorsOnly = data->constructorsOnly;
                     if (clang_getCursorKind(ref) == CXCursor_StructDecl)
                     {
                         d.access = CX_CXXPublic;
@@ -843,376 +1170,586 @@ private:
     }
 };
 
-class  NamespaceHelper
+// the namespace a namespace alias refers to.
+CXCursor get_alias_target(CXCursor cursor)
 {
-public:
-    NamespaceHelper(CursorList &children)
+    while (!clang_Cursor_isNull(cursor) && clang_getCursorKind(cursor) == CXCursor_NamespaceAlias)
     {
-        nsLength = children.size();
-        ns = new char*[nsLength];
-        for (size_t i = 0; i < nsLength; i++)
-        {
-            CXString s = clang_getCursorSpelling(children[i]);
-            const char *str = clang_getCString(s);
-            size_t len = strlen(str)+1;
-            ns[i] = new char[len];
-            memcpy(ns[i], str, len);
-            clang_disposeString(s);
-        }
-    }
-
-    ~NamespaceHelper()
-    {
-        for (size_t i = 0; i < nsLength; i++)
-        {
-            delete[] ns[i];
-        }
-        delete[] ns;
+        CursorList l;
+        clang_visitChildren(cursor, getchildren_visitor, &l);
+        if (!l.size() || !clang_isReference(clang_getCursorKind(l.back())))
+            return clang_getNullCursor();
+        cursor = clang_getCursorReferenced(l.back());
     }
+    return cursor;
+}
 
-    char **ns;
-    size_t nsLength;
-};
-
-
-
-
-
-class Cache;
-class NamespaceFinder
+std::string get_spelling(CXCursor cursor)
 {
-public:
-    NamespaceFinder(Cache *cache, CXCursor base, const char ** ns, size_t nsLength)
-    : mCache(cache), mBase(base), namespaces(ns), namespaceCount(nsLength)
-    {
+    CXString s = clang_getCursorSpelling(cursor);
+    const char *str = clang_getCString(s);
+    std::string ret(str ? str : "");
+    clang_disposeString(s);
+    return ret;
+}
 
-    }
-    virtual void execute()
+// the fully qualified name of a namespace, such as "a::b".
+std::string get_qualified_name(CXCursor cursor)
+{
+    std::string ret;
+    for (; !clang_Cursor_isNull(cursor) && clang_getCursorKind(cursor) == CXCursor_Namespace; cursor = clang_getCursorSemanticParent(cursor))
     {
-        clang_visitChildren(mBase, &NamespaceFinder::visitor, this);
+        std::string name = get_spelling(cursor);
+        if (name.empty())
+            continue;
+        ret = ret.empty() ? name : name + "::" + ret;
     }
+    return ret;
+}
 
-    virtual bool visitor(CXCursor cursor, CXCursor parent, bool &recurse, CXCursorKind ck) = 0;
+std::string qualify(const std::string& scope, const std::string& name)
+{
+    return scope.empty() ? name : scope + "::" + name;
+}
 
-    CursorList &GetParents()
+// libclang doesn't tell whether a namespace is inline, go by the names the
+// standard libraries use for their versioning namespaces (std::__1 of
+// libc++, std::__cxx11 of libstdc++).
+bool is_inline_namespace(const std::string& name)
+{
+    if (name.compare(0, 5, "__cxx") == 0)
+        return true;
+    if (name.size() < 3 || name.compare(0, 2, "__") != 0)
+        return false;
+    for (size_t i = 2; i < name.size(); i++)
     {
-        return mParents;
+        if (name[i] < '0' || name[i] > '9')
+            return false;
     }
+    return true;
+}
+
+typedef std::vector<std::unique_ptr<CachePartition> > PartitionList;
 
-    Cache *getCache() const
+// compares entries of a partition by their index.
+class IndexCompare
+{
+public:
+    IndexCompare(const EntryList& entries)
+    : mEntries(entries)
+    {}
+    bool operator()(unsigned int a, unsigned int b) const
     {
-        return mCache;
+        return EntryCompare()(mEntries[a], mEntries[b]);
     }
-protected:
-    Cache*       mCache;
-    CXCursor     mBase;
-    CursorList   mParents;
-    const char **namespaces;
-    size_t       namespaceCount;
-
-    static CXChildVisitResult visitor(CXCursor cursor, CXCursor parent, CXClientData client_data);
+private:
+    const EntryList& mEntries;
 };
 
-
-class NamespaceVisitorData : public NamespaceFinder
+// Visits the top level cursors of a translation unit and sorts them into
+// partitions by the file they're in. A file that was in the previous
+// partitions with the same modification time and that isn't among the
+// changed files has its strings replayed from the previous partition.
+// The cursors don't survive a reparse, so the top level cursors of the
+// unchanged files are still visited to make their entries with the new
+// cursors. Replaying saves formatting, sorting and trimming them.
+class PartitionVisitorData
 {
 public:
-    NamespaceVisitorData(Cache * cache, const char* firstName, const char **ns, size_t nsLength, bool trim = true)
-    : NamespaceFinder(cache, clang_getNullCursor(), ns, nsLength), mFirstName(firstName), mTrim(trim)
+    // context is the context of the shared formats, or empty to not share them.
+    PartitionVisitorData(EntryStore& store, const PartitionList* previous, const char** changed, unsigned int length, const std::string& context)
+    : mStore(store), mContext(context)
+    {
+        if (previous)
+        {
+            for (PartitionList::const_iterator i = previous->begin(); i != previous->end(); ++i)
+                mPrevious[(*i)->file] = i->get();
+        }
+        for (unsigned int i = 0; i < length; ++i)
+            mChanged.insert(changed[i]);
+    }
+
+    static CXChildVisitResult visit(CXCursor cursor, CXCursor parent, CXClientData client_data)
     {
+        PartitionVisitorData* data = (PartitionVisitorData*) client_data;
+        CXCursorKind ck = clang_getCursorKind(cursor);
+        if (ck == CXCursor_UsingDirective || (ck == CXCursor_Namespace && get_spelling(cursor).empty()))
+            data->mScopes.push_back(cursor);
+        // the declarations of an extern "C" block can come from any number
+        // of files included in it, each goes to the partition of its file.
+        if (ck == CXCursor_UnexposedDecl || ck == CXCursor_LinkageSpec)
+            return CXChildVisit_Recurse;
+        data->getBuilder(cursor).visitor.visit(cursor, parent);
+        return CXChildVisit_Continue;
     }
-    ~NamespaceVisitorData()
+
+    // the using directives and the anonymous namespaces at the global
+    // scope. They don't make entries but names can be found through them.
+    CursorList& getScopes()
     {
+        return mScopes;
     }
-    virtual void execute();
 
-    virtual bool visitor(CXCursor cursor, CXCursor parent, bool &recurse, CXCursorKind ck)
+    // move the finished partitions, each with its entries sorted, to partitions.
+    void finish(PartitionList& partitions)
     {
-        if (ck == CXCursor_UsingDirective)
+        for (std::vector<std::unique_ptr<Builder> >::iterator i = mBuilders.begin(); i != mBuilders.end(); ++i)
         {
-            CursorList children;
-            clang_visitChildren(cursor, getchildren_visitor, &children);
-            NamespaceHelper h(children);
-            NamespaceVisitorData d(mCache, h.ns[0], (const char**) (h.nsLength > 1 ? &h.ns[1] : NULL), h.nsLength-1);
-            d.execute();
-            EntryList &entries = d.getEntries();
-            for (EntryList::iterator i = entries.begin(); i < entries.end(); i++)
+            Builder& b = **i;
+            b.visitor.visit_anonymous_fields();
+            CachePartition& p = *b.partition;
+            IndexCompare cmp(p.entries);
+            std::shared_ptr<PartitionFormats> formats;
+            if (b.formatter.replayedAll())
             {
-                mEntries.push_back(*i);
+                p.formats = b.formatter.getSource();
+                if (p.formats->order.size() == p.entries.size())
+                    p.order = p.formats->order;
             }
+            else
+            {
+                formats = b.formatter.finish();
+                p.formats = formats;
+            }
+            // the entries of base classes in other files may still differ
+            if (p.order.size() != p.entries.size() || !std::is_sorted(p.order.begin(), p.order.end(), cmp))
+            {
+                p.order.resize(p.entries.size());
+                for (unsigned int j = 0; j < p.order.size(); ++j)
+                    p.order[j] = j;
+                std::sort(p.order.begin(), p.order.end(), cmp);
+            }
+            if (formats)
+            {
+                formats->order = p.order;
+                if (b.shared)
+                    g_sharedFormats.publish(mContext, p.file, p.mtime, formats);
+            }
+            // the entries use the strings of the formats
+            mStore.keepAlive(p.formats);
+            partitions.push_back(std::move(b.partition));
         }
-        else
-        {
-            CompletionVisitorData d(mEntries);
-            d.add_completion_children(cursor, ck, recurse);
-            d.addConstructors(cursor, ck);
-        }
-
-        return false;
+        mBuilders.clear();
     }
 
-    EntryList &getEntries()
+private:
+    struct Builder
     {
-        return mEntries;
-    }
+        // the strings of shared formats are kept in a pool of their own so
+        // that the other caches using them don't keep all of this one's.
+        Builder(EntryStore& store, CXFile file, const std::string& name, time_t mtime, std::shared_ptr<const PartitionFormats> source, bool share)
+        : partition(new CachePartition(name, mtime)), shared(share),
+          formatter(share ? std::make_shared<StringPool>() : store.getSharedStrings(), store.getStrings(), file, std::move(source)),
+          visitor(store, partition->entries, CX_CXXPublic, false, &formatter)
+        {}
+        std::unique_ptr<CachePartition> partition;
+        bool                            shared; // whether new formats are shared
+        CacheFormatter                  formatter;
+        CompletionVisitorData           visitor;
+    };
+
+    Builder& getBuilder(CXCursor cursor)
+    {
+        CXFile file = NULL;
+        clang_getExpansionLocation(clang_getCursorLocation(cursor), &file, NULL, NULL, NULL);
+        std::map<CXFile, Builder*>::iterator i = mFiles.find(file);
+        if (i != mFiles.end())
+            return *i->second;
+
+        std::string name;
+        time_t mtime = 0;
+        if (file)
+        {
+            CXString s = clang_getFileName(file);
+            name = clang_getCString(s);
+            clang_disposeString(s);
+            mtime = clang_getFileTime(file);
+        }
+        std::map<std::string, Builder*>::iterator n = mNames.find(name);
+        if (n != mNames.end())
+        {
+            mFiles[file] = n->second;
+            return *n->second;
+        }
+        // The contents of the changed files aren't what their modification
+        // times say, so their formats are neither reused nor shared.
+        std::shared_ptr<const PartitionFormats> source;
+        bool share = false;
+        if (mChanged.find(name) == mChanged.end())
+        {
+            std::map<std::string, const CachePartition*>::iterator p = mPrevious.find(name);
+            if (p != mPrevious.end() && p->second->mtime == mtime)
+                source = p->second->formats;
+            share = !mContext.empty() && !name.empty();
+            if (!source && share)
+                source = g_sharedFormats.find(mContext, name, mtime);
+        }
 
+        mBuilders.push_back(std::unique_ptr<Builder>(new Builder(mStore, file, name, mtime, source, share)));
+        mFiles[file] = mNames[name] = mBuilders.back().get();
+        return *mBuilders.back();
+    }
 
-protected:
-    const char *mFirstName;
-    EntryList   mEntries;
-    bool        mTrim;
+    EntryStore&                                  mStore;
+    std::string                                  mContext;
+    std::map<std::string, const CachePartition*> mPrevious;
+    std::set<std::string>                        mChanged;
+    std::map<CXFile, Builder*>                   mFiles;
+    std::map<std::string, Builder*>              mNames;
+    std::vector<std::unique_ptr<Builder> >       mBuilders;
+    CursorList                                   mScopes;
 };
 
-class UsingNamespaceFinder : public NamespaceVisitorData
+// merges the sorted entries of the partitions, used as a min heap.
+class PartitionMergeCompare
 {
 public:
-    UsingNamespaceFinder(const char *firstName, const char **ns, size_t nsLength, NamespaceFinder *realFinder)
-    : NamespaceVisitorData(realFinder->getCache(), firstName, ns, nsLength), mRealFinder(realFinder)
-    {
+    typedef std::pair<const CachePartition*, size_t> Position;
 
+    bool operator()(const Position& a, const Position& b) const
+    {
+        return EntryCompare()(get(b), get(a));
     }
-    virtual bool visitor(CXCursor cursor, CXCursor parent, bool &recurse, CXCursorKind ck)
+    static const CacheEntry* get(const Position& p)
     {
-        CXCursor par;
-        if (mRealFinder->GetParents().size())
-            par = mRealFinder->GetParents().back();
-        else
-            par = clang_getNullCursor();
-        CXChildVisitResult r = NamespaceFinder::visitor(cursor, par, mRealFinder);
-        if (r == CXChildVisit_Recurse)
-        {
-            clang_visitChildren(cursor, NamespaceFinder::visitor, mRealFinder);
-        }
-        return false;
+        return p.first->entries[p.first->order[p.second]];
     }
-private:
-    NamespaceFinder *mRealFinder;
-
 };
 
-
-CXChildVisitResult NamespaceFinder::visitor(CXCursor cursor, CXCursor parent, CXClientData client_data)
+// The namespaces of a translation unit by their fully qualified names
+// and the types declared in them, so that finding a type in a namespace
+// or completing the members of one doesn't need to walk the whole
+// translation unit. The index is made out of the namespaces at the
+// global scope, the members of a namespace are collected the first time
+// they're asked for. Aliases and using directives are followed when
+// looking up a name.
+class NamespaceIndex
 {
-    if (clang_Cursor_isNull(cursor))
-        return CXChildVisit_Break;
-    NamespaceFinder *nvd = (NamespaceFinder*) client_data;
-
-    while (nvd->mParents.size() && !clang_equalCursors(nvd->mParents.back(), parent))
+public:
+    NamespaceIndex(const EntryList& namespaces, const CursorList& scopes)
+    : mStore(std::make_shared<EntryStore>())
     {
-        nvd->mParents.pop_back();
+        for (EntryList::const_iterator i = namespaces.begin(); i != namespaces.end(); ++i)
+        {
+            add("", (*i)->cursor, clang_getCursorKind((*i)->cursor));
+        }
+        for (CursorList::const_iterator i = scopes.begin(); i != scopes.end(); ++i)
+        {
+            add("", *i, clang_getCursorKind(*i));
+        }
     }
-    CXCursorKind ck = clang_getCursorKind(cursor);
-    bool recurse = false;
 
-    switch (ck)
+    CXCursor findType(const char **ns, unsigned int nsLength, const char *type)
     {
-        default: break;
-        case CXCursor_UsingDirective:
-        {
-            if (nvd->mParents.size() < nvd->namespaceCount)
-            {
-                CursorList children;
-                clang_visitChildren(cursor, getchildren_visitor, &children);
-                NamespaceHelper h(children);
+        std::string scope;
+        if (!resolve(ns, nsLength, scope))
+            return clang_getNullCursor();
 
-                UsingNamespaceFinder unf(h.ns[0], (const char**) (h.nsLength > 1 ? &h.ns[1] : NULL), h.nsLength-1, nvd);
-                unf.execute();
-            }
-            break;
-        }
-        case CXCursor_NamespaceAlias:
+        std::vector<std::string> scopes;
+        getScopes(scope, scopes);
+        for (std::vector<std::string>::iterator i = scopes.begin(); i != scopes.end(); ++i)
         {
-            if (nvd->mParents.size() < nvd->namespaceCount)
-            {
-                CXString s = clang_getCursorSpelling(cursor);
-                const char *str = clang_getCString(s);
-                if (str)
-                {
-                    if (!strcmp(nvd->namespaces[nvd->mParents.size()], str))
-                    {
-                        CXCursor curr = cursor;
-                        CursorList children;
-                        while (clang_getCursorKind(curr) != CXCursor_Namespace)
-                        {
-                            CursorList l;
-                            clang_visitChildren(curr, getchildren_visitor, &l);
-                            assert(l.size() && clang_isReference(clang_getCursorKind(l.back())));
-                            curr = clang_getCursorReferenced(l.back());
-                        }
-                        while (!clang_Cursor_isNull(curr) && clang_getCursorKind(curr) == CXCursor_Namespace)
-                        {
-                            children.insert(children.begin(), curr);
-                            curr = clang_getCursorLexicalParent(curr);
-                        }
-                        NamespaceHelper h(children);
-                        NamespaceVisitorData d(nvd->mCache, h.ns[0], h.nsLength > 1 ? (const char **) &h.ns[1] : NULL, h.nsLength-1, false);
-                        d.execute();
-                        nvd->mParents.push_back(cursor);
-                        EntryList &entries = d.getEntries();
-                        for (EntryList::iterator i = entries.begin(); i < entries.end(); i++)
-                        {
-                            std::shared_ptr<CacheEntry> e = (*i);
-
-                            CXChildVisitResult r = NamespaceFinder::visitor(e->cursor, cursor, nvd);
-                            if (r == CXChildVisit_Recurse)
-                            {
-                                clang_visitChildren(e->cursor, NamespaceFinder::visitor, nvd);
-                            }
-                        }
-                    }
-                }
-                clang_disposeString(s);
-            }
-            break;
+            std::unordered_map<std::string, CXCursor>::iterator t = mTypes.find(qualify(*i, type));
+            if (t != mTypes.end())
+                return t->second;
         }
-        case CXCursor_Namespace:
+        return clang_getNullCursor();
+    }
+
+    CacheCompletionResults* getMembers(const char **ns, unsigned int nsLength)
+    {
+        std::string scope;
+        if (!resolve(ns, nsLength, scope))
+            return new CacheCompletionResults(mStore, EntryList());
+
+        Namespace& n = mNamespaces[scope];
+        if (!n.members)
         {
-            if (nvd->mParents.size() < nvd->namespaceCount)
+            n.members = std::make_shared<EntryList>();
+            EntryList& entries = *n.members;
+            std::vector<std::string> scopes;
+            getScopes(scope, scopes);
+            for (std::vector<std::string>::iterator i = scopes.begin(); i != scopes.end(); ++i)
             {
-                CXString s = clang_getCursorSpelling(cursor);
-                const char *str = clang_getCString(s);
-                if (str)
+                CursorList& cursors = mNamespaces[*i].cursors;
+                for (CursorList::iterator c = cursors.begin(); c != cursors.end(); ++c)
                 {
-                    if (!strcmp(nvd->namespaces[nvd->mParents.size()], str))
-                    {
-                        recurse = true;
-                    }
+                    CompletionVisitorData d(*mStore, entries);
+                    d.visit_children(*c);
                 }
-                clang_disposeString(s);
             }
-            break;
+            std::sort(entries.begin(), entries.end(), EntryCompare());
+            trim(entries);
         }
-    }
-    if (nvd->namespaceCount == 0 || (nvd->mParents.size() == nvd->namespaceCount && clang_equalCursors(nvd->mParents.back(), parent)))
-    {
-        bool bk = nvd->visitor(cursor, parent, recurse, ck);
-        if (bk)
-            return CXChildVisit_Break;
+        return new CacheCompletionResults(mStore, n.members, 0, n.members->size());
     }
 
-    if (recurse)
+private:
+    struct Namespace
     {
-        nvd->mParents.push_back(cursor);
-        return CXChildVisit_Recurse;
-    }
-    return CXChildVisit_Continue;
-}
+        CursorList                 cursors; // a namespace may be opened any number of times
+        std::vector<std::string>   usings;  // namespaces whose names are visible in this one
+        std::string                alias;   // the namespace this is an alias of
+        std::shared_ptr<EntryList> members;
+    };
 
-class FindData : public NamespaceFinder
-{
-public:
-    FindData(Cache *cache, CXCursor base, const char **namespaces, size_t nsLength, const char* s)
-    : NamespaceFinder(cache, base, namespaces, nsLength), mFound(false), mSpelling(s)
+    struct AddData
     {
+        NamespaceIndex*    index;
+        const std::string& scope;
+    };
 
+    static CXChildVisitResult add_visitor(CXCursor cursor, CXCursor parent, CXClientData client_data)
+    {
+        AddData* data = (AddData*) client_data;
+        data->index->add(data->scope, cursor, clang_getCursorKind(cursor));
+        return CXChildVisit_Continue;
     }
 
-    virtual bool visitor(CXCursor cursor, CXCursor parent, bool &recurse, CXCursorKind ck)
+    void add(const std::string& scope, CXCursor cursor, CXCursorKind ck)
     {
         switch (ck)
         {
             default: break;
-            case CXCursor_UsingDirective:
+            case CXCursor_Namespace:
             {
-                CursorList children;
-                clang_visitChildren(cursor, getchildren_visitor, &children);
-                size_t nsLength = children.size();
-                char **ns = new char*[nsLength];
-                for (size_t i = 0; i < nsLength; i++)
-                {
-                    CXString s = clang_getCursorSpelling(children[i]);
-                    const char *str = clang_getCString(s);
-                    size_t len = strlen(str)+1;
-                    ns[i] = new char[len];
-                    memcpy(ns[i], str, len);
-                    clang_disposeString(s);
-                }
-                FindData d(mCache, mBase, (const char **) ns, nsLength, mSpelling);
-                d.execute();
-                if (!clang_Cursor_isNull(d.getCursor()))
-                {
-                    mFound = true;
-                    mCursor = d.getCursor();
-                }
-                for (size_t i = 0; i < nsLength; i++)
+                std::string name = get_spelling(cursor);
+                std::string qualified = scope;
+                // the members of an anonymous namespace are in the enclosing one
+                if (!name.empty())
                 {
-                    delete[] ns[i];
+                    qualified = qualify(scope, name);
+                    if (is_inline_namespace(name))
+                        mNamespaces[scope].usings.push_back(qualified);
                 }
-                delete[] ns;
+                mNamespaces[qualified].cursors.push_back(cursor);
+                AddData d = {this, qualified};
+                clang_visitChildren(cursor, add_visitor, &d);
+                break;
+            }
+            case CXCursor_UnexposedDecl: // extern "C" for example
+            {
+                AddData d = {this, scope};
+                clang_visitChildren(cursor, add_visitor, &d);
+                break;
+            }
+            case CXCursor_NamespaceAlias:
+            {
+                CXCursor target = get_alias_target(cursor);
+                if (!clang_Cursor_isNull(target))
+                    mNamespaces[qualify(scope, get_spelling(cursor))].alias = get_qualified_name(target);
+                break;
+            }
+            case CXCursor_UsingDirective:
+            {
+                CXCursor target = get_alias_target(get_using_cursor(cursor, ck));
+                if (!clang_Cursor_isNull(target))
+                    mNamespaces[scope].usings.push_back(get_qualified_name(target));
                 break;
             }
             case CXCursor_UsingDeclaration:
             {
-                bool rec = false;
-                CXCursor cur = get_using_cursor(cursor, ck);
-                if (!clang_Cursor_isNull(cur))
-                {
-                    visitor(cur, cursor, rec, clang_getCursorKind(cur));
-                }
+                CXCursor target = get_using_cursor(cursor, ck);
+                if (!clang_Cursor_isNull(target))
+                    addType(scope, target, clang_getCursorKind(target));
+                break;
             }
-            break;
+            case CXCursor_ClassTemplate:
+            case CXCursor_StructDecl:
+            case CXCursor_ClassDecl:
+            case CXCursor_TypedefDecl:
+                addType(scope, cursor, ck);
+                break;
+        }
+    }
+
+    void addType(const std::string& scope, CXCursor cursor, CXCursorKind ck)
+    {
+        switch (ck)
+        {
+            default: break;
             case CXCursor_ClassTemplate:
             case CXCursor_StructDecl:
             case CXCursor_ClassDecl:
             case CXCursor_TypedefDecl:
             {
-                CXString s = clang_getCursorSpelling(cursor);
-                const char *str = clang_getCString(s);
-                if (str)
-                {
-                    if (!strcmp(str, mSpelling))
-                    {
-                        bool hasChildren = false;
-                        clang_visitChildren(cursor, haschildren_visitor, &hasChildren);
-                        if (hasChildren)
-                        {
-                            mCursor = cursor;
-                            mFound = true;
-                        }
-                    }
-                }
-                clang_disposeString(s);
+                // forward declarations don't have children
+                std::string name = qualify(scope, get_spelling(cursor));
+                if (mTypes.find(name) != mTypes.end())
+                    break;
+                bool hasChildren = false;
+                clang_visitChildren(cursor, haschildren_visitor, &hasChildren);
+                if (hasChildren)
+                    mTypes[name] = cursor;
                 break;
             }
         }
-        return mFound;
     }
-    CXCursor getCursor()
+
+    // the namespace and the namespaces whose names are visible in it
+    // through using directives, the namespace itself first.
+    void getScopes(const std::string& scope, std::vector<std::string>& scopes)
     {
-        if (mFound)
-            return mCursor;
-        return clang_getNullCursor();
+        std::set<std::string> seen;
+        scopes.push_back(scope);
+        seen.insert(scope);
+        for (size_t i = 0; i < scopes.size(); i++)
+        {
+            std::unordered_map<std::string, Namespace>::iterator n = mNamespaces.find(scopes[i]);
+            if (n == mNamespaces.end())
+                continue;
+            std::vector<std::string>& usings = n->second.usings;
+            for (std::vector<std::string>::iterator u = usings.begin(); u != usings.end(); ++u)
+            {
+                if (seen.insert(*u).second)
+                    scopes.push_back(*u);
+            }
+        }
     }
 
-private:
-    CXCursor    mCursor;
-    bool        mFound;
-    const char *mSpelling;
+    // find the namespace the names refer to, starting from the global scope.
+    bool resolve(const char **ns, unsigned int nsLength, std::string& scope)
+    {
+        scope.clear();
+        for (unsigned int i = 0; i < nsLength; i++)
+        {
+            std::vector<std::string> scopes;
+            getScopes(scope, scopes);
+            std::unordered_map<std::string, Namespace>::iterator n = mNamespaces.end();
+            for (std::vector<std::string>::iterator s = scopes.begin(); s != scopes.end() && n == mNamespaces.end(); ++s)
+            {
+                n = mNamespaces.find(qualify(*s, ns[i]));
+            }
+            // aliases of aliases
+            for (int depth = 0; n != mNamespaces.end() && !n->second.alias.empty() && depth < 16; depth++)
+            {
+                n = mNamespaces.find(n->second.alias);
+            }
+            if (n == mNamespaces.end() || !n->second.alias.empty())
+                return false;
+            scope = n->first;
+        }
+        return true;
+    }
+
+    std::shared_ptr<EntryStore>                     mStore;
+    std::unordered_map<std::string, Namespace>      mNamespaces;
+    std::unordered_map<std::string, CXCursor>       mTypes; // qualified name -> declaration
 };
 
 
 class Cache
 {
 public:
-    Cache(CXCursor base) : mBaseCursor(base)
+    // Builds the cache of the translation unit. previous is the cache of
+    // an earlier parse of the same translation unit, the strings of the
+    // files that haven't changed since are taken from it. The files given
+    // as unsaved files need to be listed as changed since their
+    // modification times tell nothing. The strings of the files are
+    // shared with the caches of other translation units made with the
+    // same context, see SharedFormats. The context of the previous cache
+    // is used when there is one.
+    Cache(CXCursor base, const Cache* previous=NULL, const char** changed=NULL, unsigned int length=0, const char* context=NULL)
+    : mBaseCursor(base), mEntries(std::make_shared<EntryList>()),
+      mContext(previous ? previous->mContext : context ? context : ""), mMemberStore(std::make_shared<EntryStore>())
     {
-        CompletionVisitorData d(mEntries, CX_CXXPublic);
-        d.visit_children(base);
+        // The strings taken from the previous cache need to stay in the
+        // same pool. Strings that are no longer used pile up in it over
+        // the reparses, so start over once the pool has doubled in size.
+        if (previous && previous->mStore->getStrings().size() > 2 * previous->mFreshStrings)
+            previous = NULL;
+        if (previous)
+            mStore = std::make_shared<EntryStore>(previous->mStore->getSharedStrings());
+        else
+            mStore = std::make_shared<EntryStore>();
+
+        PartitionVisitorData d(*mStore, previous ? &previous->mPartitions : NULL, changed, length, mContext);
+        clang_visitChildren(base, PartitionVisitorData::visit, &d);
+        d.finish(mPartitions);
+        mScopes.swap(d.getScopes());
+        mFreshStrings = previous ? previous->mFreshStrings : mStore->getStrings().size();
 
-        std::sort(mEntries.begin(), mEntries.end(), EntryCompare());
-        for (EntryList::iterator i = mEntries.begin(); i != mEntries.end(); ++i)
+        EntryList& entries = *mEntries;
+        mergePartitions(entries);
+        for (EntryList::iterator i = entries.begin(); i != entries.end(); ++i)
         {
-            std::shared_ptr<CacheEntry> e = *i;
+            const CacheEntry* e = *i;
             CXCursorKind ck = clang_getCursorKind(e->cursor);
             if (ck == CXCursor_Namespace || ck == CXCursor_NamespaceAlias)
             {
                 mNamespaces.push_back(e);
             }
         }
-        trim(mEntries);
+        trim(entries);
+        buildPrefixIndex();
         clang_visitChildren(base, get_objc_categories_visitor, &mObjCCategories);
     }
 
+    void mergePartitions(EntryList& entries) const
+    {
+        std::vector<PartitionMergeCompare::Position> heap;
+        size_t count = 0;
+        for (PartitionList::const_iterator i = mPartitions.begin(); i != mPartitions.end(); ++i)
+        {
+            if (!(*i)->entries.empty())
+                heap.push_back(PartitionMergeCompare::Position(i->get(), 0));
+            count += (*i)->entries.size();
+        }
+        PartitionMergeCompare cmp;
+        std::make_heap(heap.begin(), heap.end(), cmp);
+        entries.reserve(count);
+        while (!heap.empty())
+        {
+            std::pop_heap(heap.begin(), heap.end(), cmp);
+            PartitionMergeCompare::Position& p = heap.back();
+            entries.push_back(PartitionMergeCompare::get(p));
+            if (++p.second < p.first->entries.size())
+                std::push_heap(heap.begin(), heap.end(), cmp);
+            else
+                heap.pop_back();
+        }
+    }
+
+    // The entries are sorted by their display string so the entries
+    // starting with a character are next to each other. Remember where
+    // each of those runs starts so that a prefix search only needs to
+    // look at the run of its first character.
+    void buildPrefixIndex()
+    {
+        const EntryList& entries = *mEntries;
+        size_t pos = 0;
+        for (unsigned int c = 0; c < 256; ++c)
+        {
+            while (pos < entries.size() && (unsigned char)entries[pos]->display[0] < c)
+                ++pos;
+            mPrefixIndex[c] = pos;
+        }
+        mPrefixIndex[256] = entries.size();
+    }
+
+    // find the range of entries whose display string starts with the prefix.
+    void findPrefix(const char *prefix, size_t& start, size_t& end) const
+    {
+        const EntryList& entries = *mEntries;
+        if (prefix[0] == '\0')
+        {
+            start = 0;
+            end   = entries.size();
+            return;
+        }
+        const unsigned char c = prefix[0];
+        EntryList::const_iterator first = entries.begin() + mPrefixIndex[c];
+        EntryList::const_iterator last  = entries.begin() + mPrefixIndex[c + 1];
+        if (prefix[1] != '\0')
+        {
+            EntryPrefixCompare cmp(prefix);
+            first = std::lower_bound(first, last, prefix, cmp);
+            last  = std::upper_bound(first, last, prefix, cmp);
+        }
+        start = first - entries.begin();
+        end   = last - entries.begin();
+    }
+
     bool isMemberKind(CXCursorKind ck)
     {
         switch (ck)
@@ -1229,55 +1766,78 @@ public:
                 return true;
         }
     }
-    CacheCompletionResults* clangComplete(const char *filename, unsigned int row, unsigned int col, CXUnsavedFile* unsaved, unsigned int usLength, bool memberCompletion)
+    // complete with clang_codeCompleteAt. Only the results whose typed
+    // text starts with prefix (ignoring case) are returned and with a
+    // limit only that many of the most likely ones, most likely first.
+    // Without a limit the results are sorted by their display string.
+    CacheCompletionResults* clangComplete(const char *filename, unsigned int row, unsigned int col, CXUnsavedFile* unsaved, unsigned int usLength, bool memberCompletion, const char *prefix, unsigned int limit)
     {
         CXCodeCompleteResults* res =  clang_codeCompleteAt(clang_Cursor_getTranslationUnit(mBaseCursor) , filename, row, col, unsaved, usLength, CXCodeComplete_IncludeMacros|CXCodeComplete_IncludeCodePatterns);
         if (!res)
             return NULL;
         clang_sortCodeCompletionResults(res->Results, res->NumResults);
-        // TODO: binary search to find the range
-        int start = 0;
-        int end = res->NumResults;
-        EntryList entries;
-        CXCursor tmp = clang_getNullCursor();
+        CXCompletionResult* start = res->Results;
+        CXCompletionResult* end   = res->Results + res->NumResults;
+        if (prefix[0] != '\0')
+        {
+            CompletionPrefixCompare cmp(prefix);
+            start = std::lower_bound(start, end, prefix, cmp);
+            end   = std::upper_bound(start, end, prefix, cmp);
+        }
 
-        while (start < end)
+        std::vector<unsigned int> candidates;
+        for (CXCompletionResult* r = start; r < end; r++)
         {
-            if (clang_getCompletionAvailability(res->Results[start].CompletionString) == CXAvailability_NotAccessible ||
-                (memberCompletion && !isMemberKind(res->Results[start].CursorKind)))
+            if (clang_getCompletionAvailability(r->CompletionString) == CXAvailability_NotAccessible ||
+                (memberCompletion && !isMemberKind(r->CursorKind)))
             {
-                start++;
                 continue;
             }
+            candidates.push_back(r - res->Results);
+        }
+        if (limit)
+        {
+            CompletionPriorityCompare cmp(res->Results);
+            std::sort(candidates.begin(), candidates.end(), cmp);
+        }
 
+        // the results without anything to insert don't count towards
+        // the limit, only the ones taken are formatted.
+        std::shared_ptr<EntryStore> store = std::make_shared<EntryStore>();
+        EntryList entries;
+        CXCursor tmp = clang_getNullCursor();
+        for (std::vector<unsigned int>::iterator i = candidates.begin(); i != candidates.end(); ++i)
+        {
+            if (limit && entries.size() == limit)
+                break;
+            const CXCompletionResult& r = res->Results[*i];
             std::string insertion;
             std::string representation;
-            parse_res(insertion, representation, res->Results[start].CursorKind, res->Results[start].CompletionString);
+            parse_res(insertion, representation, r.CursorKind, r.CompletionString);
             if (insertion.length() != 0)
             {
-                std::shared_ptr<CacheEntry> entry(new CacheEntry(tmp, representation, insertion));
-                entries.push_back(entry);
+                entries.push_back(store->add(tmp, representation, insertion));
             }
-            start++;
         }
         clang_disposeCodeCompleteResults(res);
-        return new CacheCompletionResults(std::move(entries));
+        if (!limit)
+            std::sort(entries.begin(), entries.end(), EntryCompare());
+        return new CacheCompletionResults(store, std::move(entries));
     }
 
-    CacheCompletionResults* complete(const char *prefix)
+    CacheCompletionResults* complete(const char *prefix, unsigned int limit)
     {
-        EntryList::iterator start = std::lower_bound(mEntries.begin(), mEntries.end(), prefix, EntryStringCompare());
-        EntryList::iterator end = std::upper_bound(mEntries.begin(), mEntries.end(), prefix, EntryStringCompare());
+        size_t start, end;
+        findPrefix(prefix, start, end);
+        if (limit && end - start > limit)
+            end = start + limit;
 
-        return new CacheCompletionResults(start, end);
+        return new CacheCompletionResults(mStore, mEntries, start, end);
     }
 
     CacheCompletionResults* getNamespaceMembers(const char **ns, unsigned int nsLength)
     {
-        NamespaceVisitorData d(this, ns[0], nsLength > 1 ? &ns[1] : NULL, nsLength-1);
-        d.execute();
-        EntryList& entries = d.getEntries();
-        return new CacheCompletionResults(entries.begin(), entries.end());
+        return getNamespaceIndex().getMembers(ns, nsLength);
     }
     void addCategories(CXCursor cur, CompletionVisitorData* d)
     {
@@ -1291,10 +1851,23 @@ public:
             }
         }
     }
+    // The members of a class are the same every time it's completed so
+    // they're collected once per class and shared by the results.
     CacheCompletionResults* completeCursor(CXCursor cur)
     {
-        EntryList entries;
-        CompletionVisitorData d(entries, clang_getCursorKind(cur) == CXCursor_ClassDecl ? CX_CXXPrivate : CX_CXXPublic);
+        CXString s = clang_getCursorUSR(cur);
+        std::string usr = clang_getCString(s);
+        clang_disposeString(s);
+        if (!usr.empty())
+        {
+            std::unordered_map<std::string, std::shared_ptr<EntryList> >::iterator i = mMembers.find(usr);
+            if (i != mMembers.end())
+                return new CacheCompletionResults(mMemberStore, i->second, 0, i->second->size());
+        }
+
+        std::shared_ptr<EntryList> members = std::make_shared<EntryList>();
+        EntryList& entries = *members;
+        CompletionVisitorData d(*mMemberStore, entries, clang_getCursorKind(cur) == CXCursor_ClassDecl ? CX_CXXPrivate : CX_CXXPublic);
         d.visit_children(cur);
         addCategories(cur, &d);
         for (CursorList::iterator i = d.mParents.begin(); i != d.mParents.end(); i++)
@@ -1303,106 +1876,71 @@ public:
         }
 
         std::sort(entries.begin(), entries.end(), EntryCompare());
-        trim(mEntries);
+        trim(entries);
 
-        return new CacheCompletionResults(entries.begin(), entries.end());
+        if (!usr.empty())
+            mMembers[usr] = members;
+        return new CacheCompletionResults(mMemberStore, members, 0, members->size());
     }
     CXCursor findType(const char ** namespaces, unsigned int nsLength, const char *type)
     {
         if (nsLength == 0)
         {
+            size_t start, end;
             std::string disp(type);
             disp += "\t";
-            EntryList::iterator pos = std::lower_bound(mEntries.begin(), mEntries.end(), disp.c_str(), EntryStringCompare());
-            if (pos != mEntries.end() && !strncmp((*pos)->display, disp.c_str(), disp.length()))
+            findPrefix(disp.c_str(), start, end);
+            if (start < end)
             {
-                return (*pos)->cursor;
+                return (*mEntries)[start]->cursor;
             }
             // see if it's a template
             disp = type;
             disp += "<";
-            pos = std::lower_bound(mEntries.begin(), mEntries.end(), disp.c_str(), EntryStringCompare());
-            if (pos != mEntries.end() && !strncmp((*pos)->display, disp.c_str(), disp.length()))
+            findPrefix(disp.c_str(), start, end);
+            if (start < end)
             {
-                return (*pos)->cursor;
+                return (*mEntries)[start]->cursor;
             }
 
             return clang_getNullCursor();
         }
-        // TODO: should use mNamespaces for the first namespace entry
-        FindData d(this, mBaseCursor, namespaces, nsLength, type);
-        d.execute();
-        return d.getCursor();
+        return getNamespaceIndex().findType(namespaces, nsLength, type);
     }
 
-    EntryList& getNamespaces()
+    NamespaceIndex& getNamespaceIndex()
     {
-        return mNamespaces;
+        if (!mNamespaceIndex)
+            mNamespaceIndex.reset(new NamespaceIndex(mNamespaces, mScopes));
+        return *mNamespaceIndex;
     }
 private:
     CategoryContainer   mObjCCategories;
     CXCursor            mBaseCursor;
-    EntryList           mEntries;
+    std::shared_ptr<EntryStore> mStore;
+    std::shared_ptr<EntryList> mEntries;
+    PartitionList       mPartitions;
+    size_t              mFreshStrings; // strings in the pool after the last full build
+    std::string         mContext; // of the shared formats
     EntryList           mNamespaces;
+    CursorList          mScopes; // see PartitionVisitorData::getScopes
+    std::unique_ptr<NamespaceIndex> mNamespaceIndex; // made when first needed
+    std::shared_ptr<EntryStore> mMemberStore; // the entries of mMembers
+    std::unordered_map<std::string, std::shared_ptr<EntryList> > mMembers; // class USR -> members
+    size_t              mPrefixIndex[257]; // first character -> first entry starting with it
 };
 
-void NamespaceVisitorData::execute()
-{
-    EntryList::iterator start = std::lower_bound(mCache->getNamespaces().begin(), mCache->getNamespaces().end(), mFirstName, EntryStringCompare(true));
-    EntryList::iterator end   = std::upper_bound(mCache->getNamespaces().begin(), mCache->getNamespaces().end(), mFirstName, EntryStringCompare(true));
-    while (start < end)
-    {
-        if (clang_getCursorKind((*start)->cursor) == CXCursor_NamespaceAlias)
-        {
-            CXCursor cursor = (*start)->cursor;
-            CXCursor curr = cursor;
-            CursorList children;
-            while (clang_getCursorKind(curr) != CXCursor_Namespace)
-            {
-                CursorList l;
-                clang_visitChildren(curr, getchildren_visitor, &l);
-                assert(l.size() && clang_isReference(clang_getCursorKind(l.back())));
-                curr = clang_getCursorReferenced(l.back());
-            }
-            while (!clang_Cursor_isNull(curr) && clang_getCursorKind(curr) == CXCursor_Namespace)
-            {
-                children.insert(children.begin(), curr);
-                curr = clang_getCursorLexicalParent(curr);
-            }
-            NamespaceHelper h(children);
-            NamespaceVisitorData d(mCache, h.ns[0], h.nsLength > 1 ? (const char **) &h.ns[1] : NULL, h.nsLength-1, false);
-            d.execute();
-            EntryList &entries = d.getEntries();
-            for (EntryList::iterator i = entries.begin(); i < entries.end(); i++)
-            {
-                std::shared_ptr<CacheEntry> e = (*i);
-
-                CXChildVisitResult r = NamespaceFinder::visitor(e->cursor, cursor, this);
-                if (r == CXChildVisit_Recurse)
-                {
-                    clang_visitChildren(e->cursor, NamespaceFinder::visitor, this);
-                }
-            }
-        }
-        else
-        {
-            clang_visitChildren((*start)->cursor, NamespaceFinder::visitor, this);
-        }
-        start++;
-    }
-
-    std::sort(mEntries.begin(), mEntries.end(), EntryCompare());
-    if (mTrim)
-        trim(mEntries);
-}
-
-
 extern "C"
 {
 
 DLLAPI CacheCompletionResults* cache_clangComplete(Cache* cache, const char *filename, unsigned int row, unsigned int col, CXUnsavedFile *unsaved, unsigned int usLength, bool memberCompletion)
 {
-    return cache->clangComplete(filename, row, col, unsaved, usLength, memberCompletion);
+    return cache->clangComplete(filename, row, col, unsaved, usLength, memberCompletion, "", 0);
+}
+
+DLLAPI CacheCompletionResults* cache_clangComplete_prefix(Cache* cache, const char *filename, unsigned int row, unsigned int col, CXUnsavedFile *unsaved, unsigned int usLength, bool memberCompletion, const char *prefix, unsigned int limit)
+{
+    return cache->clangComplete(filename, row, col, unsaved, usLength, memberCompletion, prefix, limit);
 }
 
 DLLAPI CacheCompletionResults* cache_completeCursor(Cache* cache, CXCursor cur)
@@ -1410,6 +1948,12 @@ DLLAPI CacheCompletionResults* cache_completeCursor(Cache* cache, CXCursor cur)
     return cache->completeCursor(cur);
 }
 
+DLLAPI CacheCompletionResults* cache_completeCursor_filtered(Cache* cache, CXCursor cur, const CompletionFilter* filters, unsigned int length)
+{
+    std::unique_ptr<CacheCompletionResults> all(cache->completeCursor(cur));
+    return all->filter(filters, length);
+}
+
 DLLAPI CXCursor cache_findType(Cache* cache, const char **namespaces, unsigned int nsLength, const char *type)
 {
     return cache->findType(namespaces, nsLength, type);
@@ -1421,7 +1965,16 @@ DLLAPI CacheCompletionResults* cache_completeNamespace(Cache* cache, const char
 
 DLLAPI CacheCompletionResults* cache_complete_startswith(Cache* cache, const char *prefix)
 {
-    return cache->complete(prefix);
+    return cache->complete(prefix, 0);
+}
+DLLAPI CacheCompletionResults* cache_complete_startswith_limit(Cache* cache, const char *prefix, unsigned int limit)
+{
+    return cache->complete(prefix, limit);
+}
+DLLAPI CacheCompletionResults* cache_complete_startswith_filtered(Cache* cache, const char *prefix, const CompletionFilter* filters, unsigned int length)
+{
+    std::unique_ptr<CacheCompletionResults> all(cache->complete(prefix, 0));
+    return all->filter(filters, length);
 }
 DLLAPI unsigned int completionResults_length(CacheCompletionResults *comp)
 {
@@ -1431,6 +1984,10 @@ DLLAPI const CacheEntry* completionResults_getEntry(CacheCompletionResults *comp
 {
     return comp->getEntry(index);
 }
+DLLAPI const PackedResults* completionResults_pack(CacheCompletionResults *comp)
+{
+    return comp->pack();
+}
 DLLAPI void completionResults_dispose(CacheCompletionResults *comp)
 {
     delete comp;
@@ -1441,6 +1998,16 @@ DLLAPI Cache* createCache(CXCursor base)
     return new Cache(base);
 }
 
+DLLAPI Cache* createCacheShared(CXCursor base, const char *context)
+{
+    return new Cache(base, NULL, NULL, 0, context);
+}
+
+DLLAPI Cache* updateCache(Cache* previous, CXCursor base, const char **changed, unsigned int length)
+{
+    return new Cache(base, previous, changed, length);
+}
+
 DLLAPI void deleteCache(Cache *cache)
 {
     delete cache;
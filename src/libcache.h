@@ -40,8 +40,10 @@ freely, subject to the following restrictions:
 #include <string>
 #include <cstring>
 #include <vector>
+#include <algorithm>
 #include <memory>
 #include <map>
+#include <unordered_set>
 #include <cassert>
 
 class CacheCompletionResults;
@@ -52,21 +54,14 @@ class CacheEntry;
 // So this type here must be maintained binary compatible with
 // the definition in internals/translationunit.py
 // Hence also the use of "raw" C style strings.
+// The strings are owned by the EntryStore the entry lives in.
 
 class CacheEntry
 {
 public:
-    CacheEntry(const CacheEntry&) = delete;
-
-
-    CacheEntry(CXCursor c, const std::string &disp, const std::string &ins, CX_CXXAccessSpecifier a=CX_CXXPublic, bool base=false)
-    : cursor(c), access(a), isStatic(false), isBaseClass(base)
+    CacheEntry(CXCursor c, const char *disp, const char *ins, CX_CXXAccessSpecifier a=CX_CXXPublic, bool base=false)
+    : cursor(c), insert(ins), display(disp), access(a), isStatic(false), isBaseClass(base)
     {
-        display = new char[disp.length()+1];
-        insert  = new char[ins.length()+1];
-        std::strcpy(display, disp.c_str());
-        std::strcpy(insert, ins.c_str());
-
         if (clang_Cursor_isNull(c))
             return;
 
@@ -79,65 +74,335 @@ public:
             default:                           isStatic = false;                       break;
         }
     }
-   ~CacheEntry()
-    {
-        delete [] display;
-        delete [] insert;
-    }
     bool operator==(const CacheEntry& other) const
     {
-        return std::strcmp(display, other.display) == 0 && std::strcmp(insert, other.insert) == 0;
+        return (display == other.display || std::strcmp(display, other.display) == 0) &&
+               (insert == other.insert || std::strcmp(insert, other.insert) == 0);
     }
     // see class comments.
     CXCursor              cursor;
-    char *                insert;
-    char *                display;
+    const char *          insert;
+    const char *          display;
     CX_CXXAccessSpecifier access;
     bool                  isStatic;
     bool                  isBaseClass;
+};
+
+// Null terminated strings allocated out of big blocks. Each distinct
+// string is stored once, the same display and insert strings come up
+// over and over again (overloads, the same declarations seen through
+// different headers). The blocks start small and grow, a pool may only
+// hold the strings of a single header.
+class StringPool
+{
+public:
+    StringPool() : mUsed(0), mBlockSize(0)
+    {}
+
+    StringPool(const StringPool&) = delete;
+    StringPool& operator=(const StringPool&) = delete;
+
+    const char* intern(const char *str)
+    {
+        std::unordered_set<const char*, Hash, Equal>::const_iterator i = mStrings.find(str);
+        if (i != mStrings.end())
+            return *i;
+
+        const std::size_t length = std::strlen(str) + 1;
+        char *ret = NULL;
+        if (length > BlockSize / 4)
+        {
+            mBlocks.emplace_back(new char[length]);
+            ret = mBlocks.back().get();
+            // keep filling the current block
+            if (mBlocks.size() > 1)
+                std::swap(mBlocks[mBlocks.size()-1], mBlocks[mBlocks.size()-2]);
+        }
+        else
+        {
+            if (mUsed + length > mBlockSize)
+            {
+                mBlockSize = std::max<std::size_t>(mBlockSize * 2, FirstBlockSize);
+                while (mBlockSize < length)
+                    mBlockSize *= 2;
+                mBlockSize = std::min<std::size_t>(mBlockSize, BlockSize);
+                mBlocks.emplace_back(new char[mBlockSize]);
+                mUsed = 0;
+            }
+            ret = mBlocks.back().get() + mUsed;
+            mUsed += length;
+        }
+        std::memcpy(ret, str, length);
+        mStrings.insert(ret);
+        return ret;
+    }
+
+    // number of distinct strings in the pool.
+    std::size_t size() const
+    {
+        return mStrings.size();
+    }
 
-    CacheEntry& operator=(const CacheEntry&) = delete;
 private:
+    enum { FirstBlockSize = 1024, BlockSize = 64 * 1024 };
+
+    struct Hash
+    {
+        std::size_t operator()(const char *str) const
+        {
+            // FNV-1a
+            std::size_t hash = 2166136261u;
+            for (; *str; ++str)
+                hash = (hash ^ (unsigned char)*str) * 16777619u;
+            return hash;
+        }
+    };
+    struct Equal
+    {
+        bool operator()(const char *a, const char *b) const
+        {
+            return std::strcmp(a, b) == 0;
+        }
+    };
 
+    std::vector<std::unique_ptr<char[]> > mBlocks;
+    std::size_t mUsed;      // bytes used in the last block
+    std::size_t mBlockSize; // bytes in the last block
+    std::unordered_set<const char*, Hash, Equal> mStrings;
+};
+
+// Owns a set of CacheEntries and their strings. The entries are allocated
+// in blocks that never move, so the pointers to them stay valid for as
+// long as the store lives. The strings may be shared with other stores.
+class EntryStore
+{
+public:
+    EntryStore(std::shared_ptr<StringPool> strings=std::make_shared<StringPool>())
+    : mStrings(std::move(strings))
+    {}
+
+    EntryStore(const EntryStore&) = delete;
+    EntryStore& operator=(const EntryStore&) = delete;
+
+    const CacheEntry* add(CXCursor c, const std::string &disp, const std::string &ins, CX_CXXAccessSpecifier a=CX_CXXPublic, bool base=false)
+    {
+        return add(CacheEntry(c, mStrings->intern(disp.c_str()), mStrings->intern(ins.c_str()), a, base));
+    }
+
+    // add a copy of an entry, possibly from another store.
+    const CacheEntry* add(const CacheEntry& entry)
+    {
+        if (mBlocks.empty() || mBlocks.back().size() == BlockSize)
+        {
+            mBlocks.push_back(std::vector<CacheEntry>());
+            mBlocks.back().reserve(BlockSize);
+        }
+        mBlocks.back().push_back(entry);
+        CacheEntry& ret = mBlocks.back().back();
+        ret.display = mStrings->intern(entry.display);
+        ret.insert  = mStrings->intern(entry.insert);
+        return &ret;
+    }
+
+    // add an entry whose strings are already in the pool of this store
+    // or in one kept alive with keepAlive.
+    const CacheEntry* addInterned(const CacheEntry& entry)
+    {
+        if (mBlocks.empty() || mBlocks.back().size() == BlockSize)
+        {
+            mBlocks.push_back(std::vector<CacheEntry>());
+            mBlocks.back().reserve(BlockSize);
+        }
+        mBlocks.back().push_back(entry);
+        return &mBlocks.back().back();
+    }
+
+    // keep owner, something owning strings the entries use, alive for
+    // as long as the store.
+    void keepAlive(std::shared_ptr<const void> owner)
+    {
+        mOwners.push_back(std::move(owner));
+    }
+
+    StringPool& getStrings() const
+    {
+        return *mStrings;
+    }
+
+    const std::shared_ptr<StringPool>& getSharedStrings() const
+    {
+        return mStrings;
+    }
+
+private:
+    enum { BlockSize = 1024 };
+
+    std::shared_ptr<StringPool> mStrings;
+    std::vector<std::vector<CacheEntry> > mBlocks;
+    std::vector<std::shared_ptr<const void> > mOwners;
+};
+
+// IMPORTANT: This type is used through ctypes from Python code, see
+// PackedResults in internals/translationunit.py.
+// The entries of a CacheCompletionResults packed into a few arrays so
+// that they can be read all at once instead of entry by entry. strings
+// has the display and the insert string of each entry one after another,
+// each null terminated.
+enum PackedFlags
+{
+    PackedStatic    = 1,
+    PackedBaseClass = 2
+};
+
+struct PackedResults
+{
+    unsigned int          length;  // number of entries
+    unsigned int          size;    // bytes in strings
+    const char *          strings;
+    const unsigned int *  kinds;   // CXCursorKind of each entry
+    const unsigned int *  access;  // CX_CXXAccessSpecifier of each entry
+    const unsigned char * flags;   // PackedFlags of each entry
+};
+
+// IMPORTANT: This type is used through ctypes from Python code, see
+// CompletionFilter in internals/translationunit.py.
+// Which entries of a completion to keep. An entry is kept when it
+// passes all the conditions of the filter.
+struct CompletionFilter
+{
+    const unsigned int * kinds;        // CXCursorKinds
+    unsigned int         kindsLength;
+    bool                 excludeKinds; // drop the kinds instead of keeping only them
+    int                  isStatic;     // 1 static members only, 0 non static only, -1 either
+    int                  baseClass;    // 1 members of base classes only, 0 none of them, -1 either
+    unsigned int         maxAccess;    // the most restricted CX_CXXAccessSpecifier kept
+    bool                 basePrivates; // keep the private members of base classes
+
+    bool accepts(const CacheEntry& e) const
+    {
+        if (isStatic != -1 && e.isStatic != (isStatic == 1))
+            return false;
+        if (baseClass != -1 && e.isBaseClass != (baseClass == 1))
+            return false;
+        if ((unsigned int) e.access > maxAccess)
+            return false;
+        if (!basePrivates && e.isBaseClass && e.access == CX_CXXPrivate)
+            return false;
+        if (kindsLength)
+        {
+            const unsigned int ck = clang_getCursorKind(e.cursor);
+            bool found = false;
+            for (unsigned int i = 0; i < kindsLength && !found; i++)
+                found = kinds[i] == ck;
+            if (found == excludeKinds)
+                return false;
+        }
+        return true;
+    }
 };
 
 typedef std::vector<CXCursor>                CursorList;
-typedef std::vector<std::shared_ptr<CacheEntry> > EntryList;
+typedef std::vector<const CacheEntry*>       EntryList;
 typedef std::map<CXCursor, CursorList>       CategoryContainer;
 
+// A range of entries. The entries are either owned by the results
+// or shared with whoever produced them (such as the Cache) in which
+// case nothing is copied. The store the entries live in is kept alive
+// as long as the results are.
 class CacheCompletionResults
 {
 public:
-    CacheCompletionResults(EntryList::iterator start, EntryList::iterator end)
-    : mEntries(start, end)
-    {}
+    CacheCompletionResults(std::shared_ptr<const EntryStore> store, std::shared_ptr<const EntryList> entries, std::size_t start, std::size_t end)
+    : mStore(std::move(store)), mEntries(std::move(entries)), mStart(start), mEnd(end)
+    {
+        assert(mStart <= mEnd && mEnd <= mEntries->size());
+    }
 
-    CacheCompletionResults(EntryList&& results) : mEntries(std::move(results))
+    CacheCompletionResults(std::shared_ptr<const EntryStore> store, EntryList&& results)
+    : mStore(std::move(store)), mEntries(std::make_shared<EntryList>(std::move(results))), mStart(0), mEnd(mEntries->size())
     {}
 
     unsigned int length() const
     {
-        return mEntries.size();
+        return mEnd - mStart;
     }
     const CacheEntry* getEntry(unsigned int index) const
     {
-        assert(index >= 0 && index < mEntries.size());
-        return mEntries[index].get();
+        assert(index < length());
+        return (*mEntries)[mStart + index];
     }
 
-    CacheEntry& operator[](std::size_t index)
+    const CacheEntry& operator[](std::size_t index) const
     {
-        assert(index < mEntries.size());
-        return *mEntries[index];
+        assert(index < length());
+        return *(*mEntries)[mStart + index];
     }
-    const CacheEntry& operator[](std::size_t index) const
+
+    // the entries that pass any of the filters. The entries themselves
+    // aren't copied.
+    CacheCompletionResults* filter(const CompletionFilter* filters, unsigned int count) const
     {
-        assert(index < mEntries.size());
-        return *mEntries[index];
+        EntryList entries;
+        for (std::size_t i = mStart; i < mEnd; i++)
+        {
+            const CacheEntry* e = (*mEntries)[i];
+            for (unsigned int j = 0; j < count; j++)
+            {
+                if (filters[j].accepts(*e))
+                {
+                    entries.push_back(e);
+                    break;
+                }
+            }
+        }
+        return new CacheCompletionResults(mStore, std::move(entries));
+    }
+
+    // pack the entries, the packed results live as long as these do.
+    const PackedResults* pack()
+    {
+        if (mPacked)
+            return &mPacked->results;
+
+        mPacked.reset(new Packed());
+        Packed& p = *mPacked;
+        const unsigned int count = length();
+        p.kinds.reserve(count);
+        p.access.reserve(count);
+        p.flags.reserve(count);
+        for (unsigned int i = 0; i < count; i++)
+        {
+            const CacheEntry& e = (*this)[i];
+            p.strings.append(e.display).push_back('\0');
+            p.strings.append(e.insert).push_back('\0');
+            p.kinds.push_back(clang_getCursorKind(e.cursor));
+            p.access.push_back(e.access);
+            p.flags.push_back((e.isStatic ? PackedStatic : 0) | (e.isBaseClass ? PackedBaseClass : 0));
+        }
+        p.results.length  = count;
+        p.results.size    = p.strings.size();
+        p.results.strings = p.strings.data();
+        p.results.kinds   = p.kinds.data();
+        p.results.access  = p.access.data();
+        p.results.flags   = p.flags.data();
+        return &p.results;
     }
 
 private:
-    EntryList mEntries;
+    struct Packed
+    {
+        PackedResults              results;
+        std::string                strings;
+        std::vector<unsigned int>  kinds;
+        std::vector<unsigned int>  access;
+        std::vector<unsigned char> flags;
+    };
+
+    std::unique_ptr<Packed> mPacked;
+    std::shared_ptr<const EntryStore> mStore;
+    std::shared_ptr<const EntryList> mEntries;
+    std::size_t mStart;
+    std::size_t mEnd;
 };
 
 
@@ -147,24 +412,57 @@ extern "C"
 
 DLLAPI CacheCompletionResults* cache_clangComplete(Cache* cache, const char *filename, unsigned int row, unsigned int col, CXUnsavedFile *unsaved, unsigned int usLength, bool memberCompletion);
 
+// same as above but returns only the results whose typed text starts
+// with prefix (ignoring case), at most limit of the most likely ones
+// with the most likely first. 0 for no limit.
+DLLAPI CacheCompletionResults* cache_clangComplete_prefix(Cache* cache, const char *filename, unsigned int row, unsigned int col, CXUnsavedFile *unsaved, unsigned int usLength, bool memberCompletion, const char *prefix, unsigned int limit);
+
 DLLAPI CacheCompletionResults* cache_completeCursor(Cache* cache, CXCursor cur);
 
+// the members of the cursor that pass any of the filters.
+DLLAPI CacheCompletionResults* cache_completeCursor_filtered(Cache* cache, CXCursor cur, const CompletionFilter* filters, unsigned int length);
+
 DLLAPI CXCursor cache_findType(Cache* cache, const char **namespaces, unsigned int nsLength, const char *type);
 
 DLLAPI CacheCompletionResults* cache_completeNamespace(Cache* cache, const char **namespaces, unsigned int length);
 
 DLLAPI CacheCompletionResults* cache_complete_startswith(Cache* cache, const char *prefix);
 
+// same as above but returns at most limit entries, 0 for no limit.
+DLLAPI CacheCompletionResults* cache_complete_startswith_limit(Cache* cache, const char *prefix, unsigned int limit);
+
+// the entries starting with prefix that pass any of the filters.
+DLLAPI CacheCompletionResults* cache_complete_startswith_filtered(Cache* cache, const char *prefix, const CompletionFilter* filters, unsigned int length);
+
 DLLAPI unsigned int completionResults_length(CacheCompletionResults *comp);
 
 DLLAPI const CacheEntry* completionResults_getEntry(CacheCompletionResults *comp, unsigned int index);
 
+// all the entries at once, owned by the results.
+DLLAPI const PackedResults* completionResults_pack(CacheCompletionResults *comp);
+
 DLLAPI void completionResults_dispose(CacheCompletionResults *comp);
 
 DLLAPI Cache* createCache(CXCursor base);
 
+// like createCache but the strings of the headers are shared with the
+// caches of other translation units compiled with the same options.
+// context identifies the options, the caches made from this one with
+// updateCache keep sharing with the same context.
+DLLAPI Cache* createCacheShared(CXCursor base, const char *context);
+
+// make the cache of a reparsed translation unit reusing what it can of
+// the cache made before the reparse. changed lists the files whose
+// contents were given as unsaved files in either parse. The previous
+// cache must not be deleted before this returns.
+DLLAPI Cache* updateCache(Cache* previous, CXCursor base, const char **changed, unsigned int length);
+
 DLLAPI void deleteCache(Cache *cache);
 
 DLLAPI const char* getVersion();
 
 } // extern C
+
+// the number of files whose formats are shared in the context and are
+// still used by some cache. Not exported, for the unit tests.
+size_t getSharedFormatsCount(const char* context);
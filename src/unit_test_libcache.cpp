@@ -70,9 +70,554 @@ void test_success()
     clang_disposeIndex(index);
 }
 
+// parse the source as the contents of test.cpp.
+CXTranslationUnit parse(CXIndex index, const char* source)
+{
+    const char* args[] = {"-x", "c++", "-std=c++11"};
+    CXUnsavedFile file = {"test.cpp", source, (unsigned long)std::strlen(source)};
+    return clang_parseTranslationUnit(index, "test.cpp", args, 3, &file, 1, CXTranslationUnit_None);
+}
+
+// the display strings of the results, joined with '|'.
+std::string get_displays(CacheCompletionResults* results)
+{
+    std::string ret;
+    for (unsigned int i = 0; i < completionResults_length(results); ++i)
+    {
+        if (i)
+            ret += "|";
+        ret += completionResults_getEntry(results, i)->display;
+    }
+    completionResults_dispose(results);
+    return ret;
+}
+
+void test_complete_prefix()
+{
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit tu = parse(index,
+        "int alpha;\n"
+        "int alphabet;\n"
+        "int Alpha;\n"
+        "int beta;\n"
+        "void zeta(int);\n");
+    TEST_REQUIRE(tu != nullptr);
+
+    Cache* cache = createCache(clang_getTranslationUnitCursor(tu));
+    TEST_CHECK(get_displays(cache_complete_startswith(cache, "alpha")) == "alpha\tint|alphabet\tint");
+    TEST_CHECK(get_displays(cache_complete_startswith(cache, "Al")) == "Alpha\tint");
+    TEST_CHECK(get_displays(cache_complete_startswith(cache, "z")) == "zeta(int)\tvoid");
+    TEST_CHECK(get_displays(cache_complete_startswith(cache, "alphabets")) == "");
+    TEST_CHECK(get_displays(cache_complete_startswith(cache, "gamma")) == "");
+    TEST_CHECK(get_displays(cache_complete_startswith(cache, "\xff")) == "");
+    TEST_CHECK(get_displays(cache_complete_startswith(cache, "")) == "Alpha\tint|alpha\tint|alphabet\tint|beta\tint|zeta(int)\tvoid");
+
+    // at most limit of the entries, 0 for no limit
+    TEST_CHECK(get_displays(cache_complete_startswith_limit(cache, "alpha", 1)) == "alpha\tint");
+    TEST_CHECK(get_displays(cache_complete_startswith_limit(cache, "alpha", 5)) == "alpha\tint|alphabet\tint");
+    TEST_CHECK(get_displays(cache_complete_startswith_limit(cache, "alpha", 0)) == "alpha\tint|alphabet\tint");
+    TEST_CHECK(get_displays(cache_complete_startswith_limit(cache, "", 2)) == "Alpha\tint|alpha\tint");
+
+    // the results outlive the cache
+    CacheCompletionResults* results = cache_complete_startswith(cache, "b");
+    deleteCache(cache);
+    TEST_CHECK(get_displays(results) == "beta\tint");
+
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(index);
+}
+
+void test_clang_complete_limit()
+{
+    // the overloads of alpha are the most likely results but have
+    // nothing to insert, then the parameter and the local variable.
+    const char* source =
+        "int alpha(int);\n"
+        "int alpha(double);\n"
+        "void f(int zeta) {\n"
+        "    int yota = 0;\n"
+        "    alpha(\n"
+        "}\n";
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit tu = parse(index, source);
+    TEST_REQUIRE(tu != nullptr);
+
+    CXUnsavedFile file = {"test.cpp", source, (unsigned long)std::strlen(source)};
+    Cache* cache = createCache(clang_getTranslationUnitCursor(tu));
+    // the most likely first
+    TEST_CHECK(get_displays(cache_clangComplete_prefix(cache, "test.cpp", 5, 11, &file, 1, false, "", 2)) == "yota\tint|zeta\tint");
+    CacheCompletionResults* results = cache_clangComplete_prefix(cache, "test.cpp", 5, 11, &file, 1, false, "", 3);
+    TEST_CHECK(completionResults_length(results) == 3);
+    TEST_CHECK(get_displays(results).find("yota\tint|zeta\tint|") == 0);
+    TEST_CHECK(get_displays(cache_clangComplete_prefix(cache, "test.cpp", 5, 11, &file, 1, false, "z", 2)) == "zeta\tint");
+
+    // sorted by the display string without a limit
+    TEST_CHECK(get_displays(cache_clangComplete_prefix(cache, "test.cpp", 5, 11, &file, 1, false, "alpha", 0)) ==
+        "alpha(double)\tint|alpha(int)\tint");
+
+    deleteCache(cache);
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(index);
+}
+
+// the display string of the only entry starting with the prefix.
+const char* get_display(Cache* cache, const char* prefix)
+{
+    CacheCompletionResults* results = cache_complete_startswith(cache, prefix);
+    const char* ret = completionResults_length(results) == 1 ? completionResults_getEntry(results, 0)->display : nullptr;
+    completionResults_dispose(results);
+    return ret;
+}
+
+void test_update_cache()
+{
+    // the strings of the caches sharing their formats are in pools of
+    // their own, a string that is made again isn't the same string.
+    const char* source_int  = "#define T int\n#include \"t.h\"\n#include \"u.h\"\nint main_value;\n";
+    const char* source_long = "#define T long\n#include \"t.h\"\n#include \"u.h\"\nint main_value;\n";
+    // the headers are found next to the file only with absolute names
+    CXUnsavedFile files[] = {
+        {"/unit_test/test.cpp", source_int, (unsigned long)std::strlen(source_int)},
+        {"/unit_test/t.h", "T t_value;\n", 11},
+        {"/unit_test/u.h", "int u_value;\n", 13}
+    };
+    const char* args[] = {"-x", "c++", "-std=c++11"};
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit tu = clang_parseTranslationUnit(index, "/unit_test/test.cpp", args, 3, files, 3, CXTranslationUnit_None);
+    TEST_REQUIRE(tu != nullptr);
+    Cache* first = createCacheShared(clang_getTranslationUnitCursor(tu), "test_update_cache");
+    const char* main_value = get_display(first, "main_value");
+    const char* t_value    = get_display(first, "t_value");
+    const char* u_value    = get_display(first, "u_value");
+    TEST_REQUIRE(main_value && t_value && u_value);
+    TEST_CHECK(std::strcmp(t_value, "t_value\tint") == 0);
+
+    // the headers haven't changed, the changed file is made again
+    const char* changed[] = {"/unit_test/test.cpp"};
+    TEST_REQUIRE(clang_reparseTranslationUnit(tu, 3, files, 0) == 0);
+    Cache* second = updateCache(first, clang_getTranslationUnitCursor(tu), changed, 1);
+    TEST_CHECK(get_display(second, "t_value") == t_value);
+    TEST_CHECK(get_display(second, "u_value") == u_value);
+    TEST_CHECK(get_display(second, "main_value") != main_value);
+    TEST_CHECK(std::strcmp(get_display(second, "main_value"), main_value) == 0);
+    deleteCache(first);
+
+    // t.h is the same file but its declarations aren't what they were
+    files[0].Contents = source_long;
+    files[0].Length   = std::strlen(source_long);
+    TEST_REQUIRE(clang_reparseTranslationUnit(tu, 3, files, 0) == 0);
+    Cache* third = updateCache(second, clang_getTranslationUnitCursor(tu), changed, 1);
+    TEST_CHECK(std::strcmp(get_display(third, "t_value"), "t_value\tlong") == 0);
+    TEST_CHECK(get_display(third, "u_value") == u_value);
+    deleteCache(second);
+
+    // a header listed as changed is made again even if it looks the same
+    const char* changed_header[] = {"/unit_test/test.cpp", "/unit_test/u.h"};
+    TEST_REQUIRE(clang_reparseTranslationUnit(tu, 3, files, 0) == 0);
+    Cache* fourth = updateCache(third, clang_getTranslationUnitCursor(tu), changed_header, 2);
+    TEST_CHECK(get_display(fourth, "u_value") != u_value);
+    TEST_CHECK(std::strcmp(get_display(fourth, "u_value"), "u_value\tint") == 0);
+    deleteCache(third);
+
+    deleteCache(fourth);
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(index);
+}
+
+CXTranslationUnit parse_shared(CXIndex index, const char* filename, const char* source)
+{
+    const char* args[] = {"-x", "c++", "-std=c++11"};
+    CXUnsavedFile files[] = {
+        {filename, source, (unsigned long)std::strlen(source)},
+        {"/unit_test/h.h", "int h_value;\n", 13}
+    };
+    return clang_parseTranslationUnit(index, filename, args, 3, files, 2, CXTranslationUnit_None);
+}
+
+void test_shared_formats()
+{
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit a = parse_shared(index, "/unit_test/a.cpp", "#include \"h.h\"\nint a_value;\n");
+    CXTranslationUnit b = parse_shared(index, "/unit_test/b.cpp", "#include \"h.h\"\nint b_value;\n");
+    TEST_REQUIRE(a != nullptr && b != nullptr);
+
+    // the caches of the context share the formats of the header
+    Cache* first = createCacheShared(clang_getTranslationUnitCursor(a), "test_shared_formats");
+    TEST_CHECK(getSharedFormatsCount("test_shared_formats") == 2);
+    Cache* second = createCacheShared(clang_getTranslationUnitCursor(b), "test_shared_formats");
+    TEST_CHECK(getSharedFormatsCount("test_shared_formats") == 3);
+    const char* h_value = get_display(first, "h_value");
+    TEST_REQUIRE(h_value != nullptr);
+    TEST_CHECK(std::strcmp(h_value, "h_value\tint") == 0);
+    TEST_CHECK(get_display(second, "h_value") == h_value);
+
+    // but not with an unshared cache or with another context
+    Cache* unshared = createCache(clang_getTranslationUnitCursor(b));
+    TEST_CHECK(get_display(unshared, "h_value") != h_value);
+    TEST_CHECK(std::strcmp(get_display(unshared, "h_value"), h_value) == 0);
+    Cache* other = createCacheShared(clang_getTranslationUnitCursor(b), "test_shared_formats_other");
+    TEST_CHECK(get_display(other, "h_value") != h_value);
+    TEST_CHECK(getSharedFormatsCount("test_shared_formats_other") == 2);
+    deleteCache(unshared);
+    deleteCache(other);
+    TEST_CHECK(getSharedFormatsCount("test_shared_formats_other") == 0);
+
+    // the header is still used by the second cache
+    deleteCache(first);
+    TEST_CHECK(getSharedFormatsCount("test_shared_formats") == 2);
+    first = createCacheShared(clang_getTranslationUnitCursor(a), "test_shared_formats");
+    TEST_CHECK(get_display(first, "h_value") == h_value);
+    TEST_CHECK(getSharedFormatsCount("test_shared_formats") == 3);
+
+    // the results keep all the formats of their cache alive
+    CacheCompletionResults* results = cache_complete_startswith(second, "h_value");
+    deleteCache(first);
+    deleteCache(second);
+    TEST_CHECK(getSharedFormatsCount("test_shared_formats") == 2);
+    TEST_CHECK(get_displays(results) == "h_value\tint");
+    TEST_CHECK(getSharedFormatsCount("test_shared_formats") == 0);
+
+    clang_disposeTranslationUnit(a);
+    clang_disposeTranslationUnit(b);
+    clang_disposeIndex(index);
+}
+
+void test_namespace_index()
+{
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit tu = parse(index,
+        "namespace std { inline namespace __1 { class vector { public: int size(); }; int count; } }\n"
+        "namespace lib { inline namespace __cxx11 { class string { public: int length(); }; } int make(); }\n"
+        "namespace outer { namespace inner { int deep; class Deep { public: int x; }; } }\n"
+        "namespace alias = outer::inner;\n"
+        "namespace alias2 = alias;\n"
+        "namespace user { using namespace outer::inner; int own; }\n"
+        "using namespace outer;\n");
+    TEST_REQUIRE(tu != nullptr);
+    Cache* cache = createCache(clang_getTranslationUnitCursor(tu));
+
+    // the members of an inline namespace are members of the enclosing one
+    const char* std_[] = {"std"};
+    const char* std_1[] = {"std", "__1"};
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, std_, 1)) == "__1\tnamespace|count\tint|vector\tclass");
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, std_1, 2)) == "count\tint|vector\tclass");
+    TEST_CHECK(!clang_Cursor_isNull(cache_findType(cache, std_, 1, "vector")));
+    TEST_CHECK(cache_findType(cache, std_, 1, "vector") == cache_findType(cache, std_1, 2, "vector"));
+    const char* lib[] = {"lib"};
+    const char* lib_cxx11[] = {"lib", "__cxx11"};
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, lib, 1)) == "__cxx11\tnamespace|make()\tint|string\tclass");
+    TEST_CHECK(!clang_Cursor_isNull(cache_findType(cache, lib, 1, "string")));
+    TEST_CHECK(cache_findType(cache, lib, 1, "string") == cache_findType(cache, lib_cxx11, 2, "string"));
+
+    // aliases, aliases of aliases and using directives
+    const char* inner[] = {"outer", "inner"};
+    const char* alias[] = {"alias"};
+    const char* alias2[] = {"alias2"};
+    const char* user[] = {"user"};
+    const char* global_using[] = {"inner"};
+    const std::string members = "Deep\tclass|deep\tint";
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, inner, 2)) == members);
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, alias, 1)) == members);
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, alias2, 1)) == members);
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, global_using, 1)) == members);
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, user, 1)) == "Deep\tclass|deep\tint|own\tint");
+    const CXCursor deep = cache_findType(cache, inner, 2, "Deep");
+    TEST_CHECK(!clang_Cursor_isNull(deep));
+    TEST_CHECK(cache_findType(cache, alias, 1, "Deep") == deep);
+    TEST_CHECK(cache_findType(cache, alias2, 1, "Deep") == deep);
+    TEST_CHECK(cache_findType(cache, user, 1, "Deep") == deep);
+    TEST_CHECK(cache_findType(cache, global_using, 1, "Deep") == deep);
+
+    const char* nothing[] = {"nothing"};
+    TEST_CHECK(get_displays(cache_completeNamespace(cache, nothing, 1)) == "");
+    TEST_CHECK(clang_Cursor_isNull(cache_findType(cache, nothing, 1, "Deep")));
+    TEST_CHECK(clang_Cursor_isNull(cache_findType(cache, std_, 1, "Deep")));
+
+    deleteCache(cache);
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(index);
+}
+
+void test_members_memo()
+{
+    const char* before = "class Foo { public: int a; };\n";
+    const char* after  = "class Foo { public: int a; int b; };\n";
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit tu = parse(index, before);
+    TEST_REQUIRE(tu != nullptr);
+    Cache* first = createCache(clang_getTranslationUnitCursor(tu));
+    CXCursor foo = cache_findType(first, nullptr, 0, "Foo");
+    TEST_REQUIRE(!clang_Cursor_isNull(foo));
+
+    // the members are collected once per class
+    CacheCompletionResults* a = cache_completeCursor(first, foo);
+    CacheCompletionResults* b = cache_completeCursor(first, foo);
+    TEST_REQUIRE(completionResults_length(a) == 1 && completionResults_length(b) == 1);
+    TEST_CHECK(completionResults_getEntry(a, 0) == completionResults_getEntry(b, 0));
+    const CacheEntry* memoized = completionResults_getEntry(a, 0);
+    completionResults_dispose(b);
+
+    // a rebuilt cache collects them again
+    CXUnsavedFile file = {"test.cpp", after, (unsigned long)std::strlen(after)};
+    const char* changed[] = {"test.cpp"};
+    TEST_REQUIRE(clang_reparseTranslationUnit(tu, 1, &file, 0) == 0);
+    Cache* second = updateCache(first, clang_getTranslationUnitCursor(tu), changed, 1);
+    deleteCache(first);
+    foo = cache_findType(second, nullptr, 0, "Foo");
+    TEST_REQUIRE(!clang_Cursor_isNull(foo));
+    b = cache_completeCursor(second, foo);
+    TEST_CHECK(completionResults_getEntry(b, 0) != memoized);
+    TEST_CHECK(get_displays(b) == "a\tint|b\tint");
+
+    // the results of the old cache outlive it
+    TEST_CHECK(get_displays(a) == "a\tint");
+
+    deleteCache(second);
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(index);
+}
+
+void test_string_pool()
+{
+    StringPool pool;
+    const char* a = pool.intern("alpha");
+    TEST_CHECK(std::strcmp(a, "alpha") == 0);
+    TEST_CHECK(pool.intern(std::string("alpha").c_str()) == a);
+    TEST_CHECK(pool.size() == 1);
+
+    // the strings don't move when the pool grows
+    std::vector<std::string> strings;
+    std::vector<const char*> interned;
+    for (int i = 0; i < 10000; ++i)
+    {
+        strings.push_back(std::string(i % 100, 'x') + std::to_string(i));
+        interned.push_back(pool.intern(strings.back().c_str()));
+    }
+    const std::string big(100 * 1024, 'y');
+    const char* b = pool.intern(big.c_str());
+    for (int i = 0; i < 10000; ++i)
+        TEST_CHECK(strings[i] == interned[i]);
+    TEST_CHECK(big == b);
+    TEST_CHECK(pool.intern("alpha") == a);
+    TEST_CHECK(pool.size() == 10002);
+}
+
+void test_entry_store()
+{
+    std::shared_ptr<StringPool> strings = std::make_shared<StringPool>();
+    EntryStore store(strings);
+    const CacheEntry* a = store.add(clang_getNullCursor(), "a\tint", "a");
+    const CacheEntry* b = store.add(clang_getNullCursor(), "a\tint", "a", CX_CXXPrivate, true);
+    TEST_CHECK(a != b);
+    TEST_CHECK(a->display == b->display);
+    TEST_CHECK(b->access == CX_CXXPrivate && b->isBaseClass);
+    TEST_CHECK(strings->size() == 2);
+
+    // the entries don't move when the store grows
+    std::vector<const CacheEntry*> entries;
+    for (int i = 0; i < 5000; ++i)
+        entries.push_back(store.add(clang_getNullCursor(), std::to_string(i), "i"));
+    for (int i = 0; i < 5000; ++i)
+        TEST_CHECK(entries[i]->display == std::to_string(i));
+
+    // a copy from another store has its strings in this one
+    EntryStore other;
+    const CacheEntry* c = other.add(*a);
+    TEST_CHECK(c->display != a->display && std::strcmp(c->display, a->display) == 0);
+    TEST_CHECK(other.getStrings().size() == 2);
+}
+
+const char* const members_source =
+    "class Base {\n"
+    "public:\n"
+    "    int pub;\n"
+    "    static int spub;\n"
+    "protected:\n"
+    "    int prot;\n"
+    "private:\n"
+    "    int priv;\n"
+    "};\n"
+    "class Foo : public Base {\n"
+    "public:\n"
+    "    int x;\n"
+    "    static void s();\n"
+    "    void m();\n"
+    "private:\n"
+    "    int hidden;\n"
+    "};\n";
+
+// the packed entries as "display,insert,kind,access,flags" joined with '|'.
+std::string get_packed(const PackedResults* packed)
+{
+    std::string ret;
+    const char* str = packed->strings;
+    for (unsigned int i = 0; i < packed->length; ++i)
+    {
+        if (i)
+            ret += "|";
+        ret += str;
+        str += std::strlen(str) + 1;
+        ret += ",";
+        ret += str;
+        str += std::strlen(str) + 1;
+        ret += "," + std::to_string(packed->kinds[i]);
+        ret += "," + std::to_string(packed->access[i]);
+        ret += "," + std::to_string(packed->flags[i]);
+    }
+    TEST_CHECK(str == packed->strings + packed->size);
+    return ret;
+}
+
+void test_pack()
+{
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit tu = parse(index, members_source);
+    TEST_REQUIRE(tu != nullptr);
+
+    Cache* cache = createCache(clang_getTranslationUnitCursor(tu));
+    CXCursor foo = cache_findType(cache, nullptr, 0, "Foo");
+    TEST_REQUIRE(!clang_Cursor_isNull(foo));
+
+    CacheCompletionResults* results = cache_completeCursor(cache, foo);
+    const PackedResults* packed = completionResults_pack(results);
+    TEST_CHECK(packed->length == completionResults_length(results));
+    TEST_CHECK(get_packed(packed) ==
+        "hidden\tint,hidden,6,3,0|"
+        "m()\tvoid,m(),21,1,0|"
+        "priv\tint,priv,6,3,2|"
+        "prot\tint,prot,6,2,2|"
+        "pub\tint,pub,6,1,2|"
+        "s()\tvoid,s(),21,1,1|"
+        "spub\tint,spub,9,1,3|"
+        "x\tint,x,6,1,0");
+    // packing again gives the same arrays
+    TEST_CHECK(completionResults_pack(results) == packed);
+    completionResults_dispose(results);
+
+    results = cache_complete_startswith(cache, "nothing");
+    packed = completionResults_pack(results);
+    TEST_CHECK(packed->length == 0 && packed->size == 0);
+    completionResults_dispose(results);
+
+    deleteCache(cache);
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(index);
+}
+
+// a filter that keeps every entry.
+CompletionFilter keep_all()
+{
+    CompletionFilter f = {nullptr, 0, false, -1, -1, CX_CXXPrivate, true};
+    return f;
+}
+
+void test_completion_filter()
+{
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit tu = parse(index, members_source);
+    TEST_REQUIRE(tu != nullptr);
+
+    Cache* cache = createCache(clang_getTranslationUnitCursor(tu));
+    CXCursor foo = cache_findType(cache, nullptr, 0, "Foo");
+    TEST_REQUIRE(!clang_Cursor_isNull(foo));
+
+    CompletionFilter f = keep_all();
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) ==
+        "hidden\tint|m()\tvoid|priv\tint|prot\tint|pub\tint|s()\tvoid|spub\tint|x\tint");
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 0)) == "");
+
+    // static members only, non static members only
+    f.isStatic = 1;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) == "s()\tvoid|spub\tint");
+    f.isStatic = 0;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) ==
+        "hidden\tint|m()\tvoid|priv\tint|prot\tint|pub\tint|x\tint");
+
+    // members of the base classes only, none of them
+    f = keep_all();
+    f.baseClass = 1;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) ==
+        "priv\tint|prot\tint|pub\tint|spub\tint");
+    f.baseClass = 0;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) ==
+        "hidden\tint|m()\tvoid|s()\tvoid|x\tint");
+
+    // the access of the members
+    f = keep_all();
+    f.maxAccess = CX_CXXPublic;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) ==
+        "m()\tvoid|pub\tint|s()\tvoid|spub\tint|x\tint");
+    f.maxAccess = CX_CXXProtected;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) ==
+        "m()\tvoid|prot\tint|pub\tint|s()\tvoid|spub\tint|x\tint");
+    f = keep_all();
+    f.basePrivates = false;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) ==
+        "hidden\tint|m()\tvoid|prot\tint|pub\tint|s()\tvoid|spub\tint|x\tint");
+
+    // keep only the kinds, drop the kinds
+    const unsigned int methods[] = {CXCursor_CXXMethod};
+    f = keep_all();
+    f.kinds = methods;
+    f.kindsLength = 1;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) == "m()\tvoid|s()\tvoid");
+    f.excludeKinds = true;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, &f, 1)) ==
+        "hidden\tint|priv\tint|prot\tint|pub\tint|spub\tint|x\tint");
+
+    // an entry is kept when it passes any of the filters
+    CompletionFilter any[2] = {keep_all(), keep_all()};
+    any[0].isStatic = 1;
+    any[1].maxAccess = CX_CXXPublic;
+    any[1].baseClass = 0;
+    TEST_CHECK(get_displays(cache_completeCursor_filtered(cache, foo, any, 2)) ==
+        "m()\tvoid|s()\tvoid|spub\tint|x\tint");
+
+    deleteCache(cache);
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(index);
+}
+
+void test_complete_prefix_filter()
+{
+    CXIndex index = clang_createIndex(0, 0);
+    CXTranslationUnit tu = parse(index,
+        "int alpha;\n"
+        "int alphabet;\n"
+        "void alphanumeric();\n"
+        "struct alphas {};\n"
+        "int beta;\n");
+    TEST_REQUIRE(tu != nullptr);
+
+    Cache* cache = createCache(clang_getTranslationUnitCursor(tu));
+    const unsigned int kinds[] = {CXCursor_VarDecl};
+    CompletionFilter f = keep_all();
+    f.kinds = kinds;
+    f.kindsLength = 1;
+    TEST_CHECK(get_displays(cache_complete_startswith_filtered(cache, "alpha", &f, 1)) == "alpha\tint|alphabet\tint");
+    TEST_CHECK(get_displays(cache_complete_startswith_filtered(cache, "b", &f, 1)) == "beta\tint");
+    f.excludeKinds = true;
+    TEST_CHECK(get_displays(cache_complete_startswith_filtered(cache, "alpha", &f, 1)) == "alphanumeric()\tvoid|alphas\tstruct");
+    TEST_CHECK(get_displays(cache_complete_startswith_filtered(cache, "b", &f, 1)) == "");
+
+    deleteCache(cache);
+    clang_disposeTranslationUnit(tu);
+    clang_disposeIndex(index);
+}
 
 int test_main(int argc, char* argv[])
 {
+    test_complete_prefix();
+    test_clang_complete_limit();
+    test_update_cache();
+    test_shared_formats();
+    test_namespace_index();
+    test_members_memo();
+    test_string_pool();
+    test_entry_store();
+    test_pack();
+    test_completion_filter();
+    test_complete_prefix_filter();
     test_success();
 
     return 0;
@@ -0,0 +1,35 @@
+"""
+A minimal test runner in the spirit of src/test_minimal.h for the parts
+of the plugin that can be tested without Sublime Text and libclang.
+Run a test from the root of the repository, for example:
+
+    python unittests/test_translationunitcache.py
+
+or all of them with "make python_tests".
+"""
+import os
+import sys
+import traceback
+
+# the tests import the modules in internals the way unittest.py does.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def check_equal(value, expected):
+    if value != expected:
+        raise AssertionError("expected %r but got %r" % (expected, value))
+
+# run the test functions in the order given and exit with an error
+# status if any of them fails.
+def run(tests):
+    failed = 0
+    for test in tests:
+        try:
+            test()
+        except:
+            failed = failed + 1
+            print("\n%s failed" % test.__name__)
+            traceback.print_exc()
+    if failed:
+        print("\n%d test(s) failed" % failed)
+        sys.exit(1)
+    print("\nSuccess!")
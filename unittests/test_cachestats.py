@@ -0,0 +1,76 @@
+from minimal import run, check_equal
+from internals.cachestats import CacheStats, format_stats
+
+
+def test_record():
+    stats = CacheStats()
+    stats.record("a.cpp", "parse", 2.0)
+    stats.record("a.cpp", "parse", 4.0)
+    stats.record("a.cpp", "complete", 0.5)
+    files = stats.as_dict()["files"]
+    check_equal(sorted(files.keys()), ["a.cpp"])
+    check_equal(files["a.cpp"]["parse"], {"count" : 2, "total" : 6.0, "mean" : 3.0, "max" : 4.0, "last" : 4.0})
+    check_equal(files["a.cpp"]["complete"]["count"], 1)
+
+def test_record_wait():
+    stats = CacheStats()
+    stats.record_wait("INTERACTIVE", 0.25)
+    stats.record_wait("INTERACTIVE", 0.75)
+    stats.record_wait("BACKGROUND", 3.0)
+    waits = stats.as_dict()["queue_wait"]
+    check_equal(waits["INTERACTIVE"], {"count" : 2, "total" : 1.0, "mean" : 0.5, "max" : 0.75, "last" : 0.75})
+    check_equal(waits["BACKGROUND"]["count"], 1)
+
+def test_counters():
+    stats = CacheStats()
+    stats.count("hits")
+    stats.count("hits")
+    stats.count("misses", 3)
+    check_equal(stats.as_dict()["counters"], {"hits" : 2, "misses" : 3})
+
+    # the dictionary is a copy
+    stats.as_dict()["counters"]["hits"] = 10
+    check_equal(stats.as_dict()["counters"]["hits"], 2)
+
+    stats.clear()
+    values = stats.as_dict()
+    check_equal(values["counters"], {})
+    check_equal(values["queue_wait"], {})
+    check_equal(values["files"], {})
+
+def test_format_stats():
+    stats = CacheStats()
+    stats.count("hits", 3)
+    stats.count("misses")
+    stats.count("joined_parses", 2)
+    stats.record_wait("VISIBLE", 0.5)
+    stats.record("b.cpp", "reparse", 1.5)
+    values = stats.as_dict()
+    values["seconds"] = 60
+    values["live_translation_units"] = 2
+    values["memory_usage"] = 3 * 1024 * 1024
+    values["queue_depth"] = {"VISIBLE" : 1, "BACKGROUND" : 4}
+    lines = format_stats(values).split("\n")
+    check_equal(lines[0], "Collected over 60 seconds")
+    assert "Translation units: 2 live, 3.0 MB" in lines
+    assert "Queued tasks: BACKGROUND 4, VISIBLE 1" in lines
+    assert "Cache: 3 hits, 1 misses (75.0% hit rate)" in lines
+    assert "  joined_parses: 2" in lines
+    assert "  %-24s %7d %8.3f %8.3f" % ("VISIBLE", 1, 0.5, 0.5) in lines
+    index = lines.index("b.cpp")
+    check_equal(lines[index + 1], "  %-24s %7d %8.3f %8.3f %8.3f" % ("reparse", 1, 1.5, 1.5, 1.5))
+
+def test_format_empty_stats():
+    values = CacheStats().as_dict()
+    values["live_translation_units"] = 0
+    values["memory_usage"] = 0
+    values["queue_depth"] = {}
+    assert "Cache: 0 hits, 0 misses (0.0% hit rate)" in format_stats(values).split("\n")
+
+
+if __name__ == "__main__":
+    run([test_record,
+         test_record_wait,
+         test_counters,
+         test_format_stats,
+         test_format_empty_stats])
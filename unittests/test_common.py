@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from minimal import run, check_equal
+from internals.common import TaskQueue, TaskPriority, Future, Worker, ProjectFileIndex
+
+
+def test_queue_priority_order():
+    q = TaskQueue()
+    q.put("background", TaskPriority.BACKGROUND)
+    q.put("visible", TaskPriority.VISIBLE)
+    q.put("interactive 1", TaskPriority.INTERACTIVE)
+    q.put("interactive 2", TaskPriority.INTERACTIVE)
+    check_equal(q.depths(), [2, 1, 1])
+    check_equal([q.get() for i in range(4)], ["interactive 1", "interactive 2", "visible", "background"])
+    assert q.empty()
+
+    # without a priority the task is visible
+    q.put("default")
+    check_equal(q.depths(), [0, 1, 0])
+
+def test_queue_starvation():
+    # without a limit the urgent task always goes first
+    q = TaskQueue()
+    q.put("background", TaskPriority.BACKGROUND)
+    time.sleep(0.05)
+    q.put("interactive", TaskPriority.INTERACTIVE)
+    check_equal(q.get(), "interactive")
+    check_equal(q.get(), "background")
+
+    # a task that has waited over the limit goes first,
+    # the one that has waited the longest of them.
+    q = TaskQueue(0.05)
+    q.put("background", TaskPriority.BACKGROUND)
+    q.put("visible", TaskPriority.VISIBLE)
+    time.sleep(0.1)
+    q.put("interactive", TaskPriority.INTERACTIVE)
+    waited, item = q.get_timed()
+    check_equal(item, "background")
+    assert waited >= 0.05
+    check_equal(q.get(), "visible")
+    check_equal(q.get(), "interactive")
+
+def test_queue_promote():
+    q = TaskQueue()
+    q.put("background", TaskPriority.BACKGROUND)
+    q.put("visible", TaskPriority.VISIBLE)
+    assert q.promote("background", TaskPriority.INTERACTIVE)
+    # not queued or already as urgent
+    assert not q.promote("other", TaskPriority.INTERACTIVE)
+    assert not q.promote("background", TaskPriority.VISIBLE)
+    check_equal(q.depths(), [1, 1, 0])
+    check_equal(q.get(), "background")
+    check_equal(q.get(), "visible")
+
+def test_future():
+    f = Future()
+    done = []
+    f.add_done_callback(lambda f: done.append(f.result()))
+    assert not f.done()
+    try:
+        f.result(0.01)
+        assert False, "expected a timeout"
+    except RuntimeError:
+        pass
+    f.set_result(42)
+    assert f.done()
+    check_equal(f.result(), 42)
+    check_equal(done, [42])
+    # called right away once done
+    f.add_done_callback(lambda f: done.append(f.result() + 1))
+    check_equal(done, [42, 43])
+
+    f = Future()
+    f.set_error(ValueError("failed"))
+    try:
+        f.result()
+        assert False, "expected the error of the task"
+    except ValueError:
+        pass
+
+def test_worker_serializes_keyed_tasks():
+    worker = Worker(2)
+    lock = threading.Lock()
+    running = []
+    log = []
+    def task(name):
+        lock.acquire()
+        running.append(name)
+        concurrent = len(running)
+        lock.release()
+        time.sleep(0.05)
+        lock.acquire()
+        running.remove(name)
+        log.append((name, concurrent))
+        lock.release()
+        return name
+    futures = [worker.schedule(task, name, "file.cpp") for name in ["a", "b", "c"]]
+    other = worker.schedule(task, "other", "other.cpp")
+    check_equal([f.result(30) for f in futures], ["a", "b", "c"])
+    check_equal(other.result(30), "other")
+    # the tasks of a key run one at a time in the order they were scheduled
+    check_equal([name for name, concurrent in log if name != "other"], ["a", "b", "c"])
+    # while the task of another key runs next to them
+    assert max([concurrent for name, concurrent in log]) == 2
+
+def touch(name):
+    open(name, "w").close()
+
+def test_project_file_index():
+    root = tempfile.mkdtemp()
+    try:
+        sub = os.path.join(root, "src", "sub")
+        os.makedirs(sub)
+        source = os.path.join(sub, "a.cpp")
+        # no recheck delay so that changes are seen right away
+        index = ProjectFileIndex(0)
+        check_equal(index.find(source), None)
+
+        # a project file in an ancestor applies to everything below it
+        project = os.path.join(root, "a.sublime-project")
+        touch(project)
+        check_equal(index.find(source), project)
+        check_equal(index.find(os.path.join(root, "src", "b.cpp")), project)
+
+        # the nearest one wins
+        nearer = os.path.join(root, "src", "b.sublime-project")
+        touch(nearer)
+        check_equal(index.find(source), nearer)
+
+        os.remove(nearer)
+        check_equal(index.find(source), project)
+    finally:
+        shutil.rmtree(root)
+
+def test_project_file_index_recheck():
+    root = tempfile.mkdtemp()
+    try:
+        source = os.path.join(root, "a.cpp")
+        index = ProjectFileIndex(3600)
+        check_equal(index.find(source), None)
+        project = os.path.join(root, "a.sublime-project")
+        touch(project)
+        # the directories are only checked every now and then
+        check_equal(index.find(source), None)
+        index.invalidate(root)
+        check_equal(index.find(source), project)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    run([test_queue_priority_order,
+         test_queue_starvation,
+         test_queue_promote,
+         test_future,
+         test_worker_serializes_keyed_tasks,
+         test_project_file_index,
+         test_project_file_index_recheck])
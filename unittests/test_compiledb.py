@@ -0,0 +1,50 @@
+from minimal import run, check_equal
+from internals.compiledb import convert_command
+
+
+def test_convert_command():
+    source, args = convert_command("/build", ["g++", "-c", "-o", "a.o", "-Iinc", "-I", "../lib",
+        "-DX=1", "-MD", "-MF", "a.d", "-std=c++11", "src/a.cpp"])
+    check_equal(source, "/build/src/a.cpp")
+    check_equal(args, ["-I/build/inc", "-I", "/lib", "-DX=1", "-std=c++11"])
+
+def test_convert_command_paths():
+    # absolute paths stay, the other path options are made absolute too
+    source, args = convert_command("/build", ["clang", "/src/b.c", "-isystem", "/usr/include",
+        "-include", "config.h", "-iquote.", "-oout.o", "-x", "c"])
+    check_equal(source, "/src/b.c")
+    check_equal(args, ["-isystem", "/usr/include", "-include", "/build/config.h", "-iquote/build", "-x", "c"])
+
+def test_convert_command_without_source():
+    source, args = convert_command("/build", ["cc", "-c", "-Wall", "a.o", "-o"])
+    check_equal(source, None)
+    check_equal(args, ["-Wall"])
+
+def test_convert_command_separate_values():
+    # the value of an option is never taken for an option or the source
+    source, args = convert_command("/build", ["clang++", "-F", "Frameworks", "-Xpreprocessor", "-P",
+        "-Xclang", "-fno-validate-pch", "-mllvm", "-inline-threshold=100", "--param", "ssp-buffer-size=4",
+        "-include-pch", "pch/all.pch", "--sysroot", "sdk", "--sysroot=sdk", "a.cpp"])
+    check_equal(source, "/build/a.cpp")
+    check_equal(args, ["-F", "/build/Frameworks", "-Xpreprocessor", "-P", "-Xclang", "-fno-validate-pch",
+        "-mllvm", "-inline-threshold=100", "--param", "ssp-buffer-size=4",
+        "-include-pch", "/build/pch/all.pch", "--sysroot", "/build/sdk", "--sysroot=/build/sdk"])
+
+def test_convert_command_build_only_values():
+    source, args = convert_command("/build", ["cc", "-MT", "a.o", "-MQ", "$(objpfx)a.o", "-MJ", "a.json",
+        "-Xlinker", "-rpath", "-Xassembler", "--noexecstack", "-Wall", "-c", "a.c"])
+    check_equal(source, "/build/a.c")
+    check_equal(args, ["-Wall"])
+
+def test_convert_command_missing_value():
+    source, args = convert_command("/build", ["cc", "a.c", "-include-pch"])
+    check_equal(args, ["-include-pch"])
+
+
+if __name__ == "__main__":
+    run([test_convert_command,
+         test_convert_command_paths,
+         test_convert_command_without_source,
+         test_convert_command_separate_values,
+         test_convert_command_build_only_values,
+         test_convert_command_missing_value])
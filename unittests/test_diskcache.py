@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import tempfile
+from minimal import run, check_equal
+from internals.clang import cindex
+from internals.diskcache import DiskCache
+
+# stands in for the files of a libclang translation unit, the time is
+# when libclang read the file.
+class FakeFile(object):
+    def __init__(self, name, time=None):
+        self.name = name
+        self.time = time
+        if time == None:
+            self.time = int(os.path.getmtime(name))
+
+class FakeInclude(object):
+    def __init__(self, include):
+        self.include = include
+
+class FakeTranslationUnit(object):
+    def __init__(self, source, headers, save_error=None):
+        self.source = source
+        self.headers = headers
+        self.save_error = save_error
+
+    def get_file(self, filename):
+        return self.source
+
+    def get_includes(self):
+        return [FakeInclude(h) for h in self.headers]
+
+    def save(self, filename):
+        if self.save_error != None:
+            raise self.save_error
+        write(filename, "AST")
+
+def write(filename, data):
+    f = open(filename, "w")
+    f.write(data)
+    f.close()
+
+def with_files(test):
+    def wrapper():
+        tmp = tempfile.mkdtemp()
+        try:
+            source = os.path.join(tmp, "test.cpp")
+            header = os.path.join(tmp, "test.h")
+            write(source, "#include \"test.h\"\n")
+            write(header, "int value;\n")
+            test(DiskCache(os.path.join(tmp, "cache")), source, header)
+        finally:
+            shutil.rmtree(tmp)
+    wrapper.__name__ = test.__name__
+    return wrapper
+
+def store(cache, source, header):
+    tu = FakeTranslationUnit(FakeFile(source), [FakeFile(header)])
+    assert cache.store(tu, source, "fingerprint")
+
+def set_mtime(filename, mtime):
+    os.utime(filename, (mtime, mtime))
+
+@with_files
+def test_current(cache, source, header):
+    store(cache, source, header)
+    assert cache.is_current(source, "fingerprint")
+    check_equal(len(os.listdir(cache.directory)), 2)
+
+@with_files
+def test_changed_mtime(cache, source, header):
+    store(cache, source, header)
+    set_mtime(header, os.path.getmtime(header) + 10)
+    assert not cache.is_current(source, "fingerprint")
+    # the stale entry is gone
+    check_equal(os.listdir(cache.directory), [])
+    check_equal(cache.load(None, source, "fingerprint"), None)
+
+@with_files
+def test_changed_size(cache, source, header):
+    store(cache, source, header)
+    mtime = os.path.getmtime(header)
+    write(header, "int value, other;\n")
+    set_mtime(header, mtime)
+    check_equal(cache.load(None, source, "fingerprint"), None)
+    check_equal(os.listdir(cache.directory), [])
+
+@with_files
+def test_changed_after_parse(cache, source, header):
+    # the header changed between libclang reading it and the store
+    mtime = int(os.path.getmtime(header))
+    tu = FakeTranslationUnit(FakeFile(source), [FakeFile(header, mtime - 10)])
+    assert cache.store(tu, source, "fingerprint")
+    assert not cache.is_current(source, "fingerprint")
+
+@with_files
+def test_other_fingerprint(cache, source, header):
+    store(cache, source, header)
+    assert not cache.is_current(source, "other")
+    check_equal(cache.load(None, source, "other"), None)
+    # which doesn't make the stored one stale
+    assert cache.is_current(source, "fingerprint")
+
+    # a manifest made for other options isn't used either
+    for f in os.listdir(cache.directory):
+        if f.endswith(".json"):
+            manifest = os.path.join(cache.directory, f)
+            data = json.load(open(manifest))
+            data["fingerprint"] = "other"
+            write(manifest, json.dumps(data))
+    assert not cache.is_current(source, "fingerprint")
+    check_equal(cache.load(None, source, "fingerprint"), None)
+
+@with_files
+def test_corrupt_manifest(cache, source, header):
+    store(cache, source, header)
+    for f in os.listdir(cache.directory):
+        if f.endswith(".json"):
+            write(os.path.join(cache.directory, f), "{")
+    assert not cache.is_current(source, "fingerprint")
+    check_equal(os.listdir(cache.directory), [])
+
+@with_files
+def test_save_error(cache, source, header):
+    error = cindex.TranslationUnitSaveError(cindex.TranslationUnitSaveError.ERROR_UNKNOWN, "")
+    tu = FakeTranslationUnit(FakeFile(source), [FakeFile(header)], error)
+    assert not cache.store(tu, source, "fingerprint")
+    check_equal(os.listdir(cache.directory), [])
+    assert not cache.is_current(source, "fingerprint")
+
+@with_files
+def test_missing_dependency(cache, source, header):
+    tu = FakeTranslationUnit(FakeFile(source), [FakeFile(header)])
+    os.remove(header)
+    assert not cache.store(tu, source, "fingerprint")
+    assert not cache.is_current(source, "fingerprint")
+
+
+if __name__ == "__main__":
+    run([test_current,
+         test_changed_mtime,
+         test_changed_size,
+         test_changed_after_parse,
+         test_other_fingerprint,
+         test_corrupt_manifest,
+         test_save_error,
+         test_missing_dependency])
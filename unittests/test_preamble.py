@@ -0,0 +1,49 @@
+import os
+import tempfile
+from minimal import run, check_equal
+from internals.preamble import get_leading_includes, get_common_prefix
+
+
+def test_leading_includes():
+    data = "\n".join([
+        "// a comment",
+        "#pragma once",
+        "/* a comment",
+        "   over lines */",
+        "#include <vector>",
+        "",
+        "# include \"a.h\" // after",
+        "/* inline */ #include <map>",
+        "int x;",
+        "#include <set>"])
+    check_equal(get_leading_includes("/src/a.cpp", data),
+                (("<vector>", None), ("\"a.h\"", "/src"), ("<map>", None)))
+
+def test_leading_includes_none():
+    check_equal(get_leading_includes("/src/a.cpp", "int x;\n#include <vector>\n"), ())
+    check_equal(get_leading_includes("/src/a.cpp", ""), ())
+
+def test_leading_includes_from_disk():
+    fd, name = tempfile.mkstemp(".cpp")
+    try:
+        os.write(fd, b"#include <vector>\n#include \"b.h\"\n")
+        os.close(fd)
+        check_equal(get_leading_includes(name),
+                    (("<vector>", None), ("\"b.h\"", os.path.dirname(name))))
+        # the buffer wins over the file
+        check_equal(get_leading_includes(name, "#include <map>\n"), (("<map>", None),))
+    finally:
+        os.remove(name)
+    check_equal(get_leading_includes(name), ())
+
+def test_common_prefix():
+    a = get_leading_includes("/src/a.cpp", "#include <vector>\n#include <map>\n#include <set>\n")
+    b = get_leading_includes("/src/b.cpp", "#include <vector>\n#include <map>\n#include <list>\n")
+    check_equal(get_common_prefix(a, b), (("<vector>", None), ("<map>", None)))
+
+
+if __name__ == "__main__":
+    run([test_leading_includes,
+         test_leading_includes_none,
+         test_leading_includes_from_disk,
+         test_common_prefix])
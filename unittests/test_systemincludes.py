@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+from minimal import run, check_equal
+from internals import systemincludes
+from internals.systemincludes import SystemIncludes
+
+# stands in for running the compiler, counts the runs.
+class FakeClangInfo(object):
+    runs = []
+
+    def __init__(self, includes):
+        self.internal_isystem = includes
+
+    @staticmethod
+    def collect(compiler, source):
+        FakeClangInfo.runs.append((compiler, source))
+        return FakeClangInfo(["/include/%s" % os.path.basename(source)])
+
+def with_compiler(test):
+    def wrapper():
+        tmp = tempfile.mkdtemp()
+        clang_info = systemincludes.ClangInfo
+        systemincludes.ClangInfo = FakeClangInfo
+        FakeClangInfo.runs = []
+        try:
+            compiler = os.path.join(tmp, "clang")
+            open(compiler, "w").close()
+            test(compiler, os.path.join(tmp, "cache", "system_includes.json"))
+        finally:
+            systemincludes.ClangInfo = clang_info
+            shutil.rmtree(tmp)
+    wrapper.__name__ = test.__name__
+    return wrapper
+
+@with_compiler
+def test_round_trip(compiler, cache_file):
+    found = SystemIncludes(cache_file)
+    check_equal(found.find(compiler, "c++", "test.cpp").result(5), ["/include/test.cpp"])
+    # the same Future for the same compiler and language
+    assert found.find(compiler, "c++", "test.cpp").done()
+    check_equal(len(FakeClangInfo.runs), 1)
+
+    # the next session reads them from the file
+    found = SystemIncludes(cache_file)
+    future = found.find(compiler, "c++", "test.cpp")
+    assert future.done()
+    check_equal(future.result(), ["/include/test.cpp"])
+    check_equal(len(FakeClangInfo.runs), 1)
+
+@with_compiler
+def test_language_change(compiler, cache_file):
+    found = SystemIncludes(cache_file)
+    check_equal(found.find(compiler, "c++", "test.cpp").result(5), ["/include/test.cpp"])
+    check_equal(found.find(compiler, "c", "test.c").result(5), ["/include/test.c"])
+    check_equal(len(FakeClangInfo.runs), 2)
+
+    # both are kept
+    found = SystemIncludes(cache_file)
+    check_equal(found.find(compiler, "c", "test.c").result(), ["/include/test.c"])
+    check_equal(found.find(compiler, "c++", "test.cpp").result(), ["/include/test.cpp"])
+    check_equal(len(FakeClangInfo.runs), 2)
+
+@with_compiler
+def test_compiler_change(compiler, cache_file):
+    found = SystemIncludes(cache_file)
+    found.find(compiler, "c++", "test.cpp").result(5)
+
+    # an upgraded compiler is run again
+    mtime = os.path.getmtime(compiler) + 10
+    os.utime(compiler, (mtime, mtime))
+    found = SystemIncludes(cache_file)
+    future = found.find(compiler, "c++", "test.cpp")
+    check_equal(future.result(5), ["/include/test.cpp"])
+    check_equal(len(FakeClangInfo.runs), 2)
+
+
+if __name__ == "__main__":
+    run([test_round_trip,
+         test_language_change,
+         test_compiler_change])
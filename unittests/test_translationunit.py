@@ -0,0 +1,43 @@
+from minimal import run, check_equal
+from internals.translationunit import HeaderTranslationUnit
+
+# stands in for the translation unit a header is parsed as part of.
+class FakeHost(object):
+    def __init__(self, filename, includes, unsaved_files):
+        self.filename      = filename
+        self.includes      = set(includes)
+        self.unsaved_files = unsaved_files
+        self.reparses      = []
+
+    def reparse(self, unsaved_files):
+        self.reparses.append(unsaved_files)
+        self.unsaved_files = unsaved_files
+
+def test_header_merges_unsaved_files():
+    host = FakeHost("/src/a.cpp", ["/src/a.h", "/src/b.h"],
+                    [("/src/a.cpp", "host"), ("/src/a.h", "old"), ("/src/b.h", "other")])
+    header = HeaderTranslationUnit(host, "/src/a.h", None)
+    check_equal(header.includes, set(["/src/b.h"]))
+
+    # the header's buffer replaces the one the host had for it
+    check_equal(header.merge_unsaved_files([("/src/a.h", "new")]),
+                [("/src/a.cpp", "host"), ("/src/b.h", "other"), ("/src/a.h", "new")])
+    # a saved header is read from the disk
+    check_equal(header.merge_unsaved_files([]), [("/src/a.cpp", "host"), ("/src/b.h", "other")])
+
+    header.reparse([("/src/a.h", "new")])
+    check_equal(host.reparses, [[("/src/a.cpp", "host"), ("/src/b.h", "other"), ("/src/a.h", "new")]])
+    check_equal(header.unsaved_files, host.unsaved_files)
+
+def test_header_memory_usage():
+    host = FakeHost("/src/a.cpp", [], [])
+    host.memory_usage = 0
+    header = HeaderTranslationUnit(host, "/src/a.h", None)
+    header.memory_usage = 100
+    check_equal(header.memory_usage, 0)
+    check_equal(host.memory_usage, 100)
+
+
+if __name__ == "__main__":
+    run([test_header_merges_unsaved_files,
+         test_header_memory_usage])
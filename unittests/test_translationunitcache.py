@@ -0,0 +1,400 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from minimal import run, check_equal
+from internals.common import Future, TaskPriority
+from internals.cachestats import stats
+from internals.common import find_project_file
+from internals.translationunitcache import canonicalize_arguments, CompileOptions, CompileOptionsCache, Language, TranslationUnitCache
+
+
+def test_canonicalize_defines():
+    # sorted by name, the last one for a name wins
+    check_equal(canonicalize_arguments(["-DB=1", "-D", "A", "-UB", "-DC=2", "-DB=3"]),
+                ["-DA", "-DB=3", "-DC=2"])
+
+def test_canonicalize_include_paths():
+    # grouped by kind in the search order, the first occurrence counts
+    check_equal(canonicalize_arguments(["-isystem", "/usr/include", "-I/b", "-I", "/a/../b", "-iquote", "q", "-I/a"]),
+                ["-iquoteq", "-I/b", "-I/a", "-isystem/usr/include"])
+
+def test_canonicalize_same_configuration():
+    a = canonicalize_arguments(["-Wall", "-DX", "-I/a", "-std=c++11", "-DY=2"])
+    b = canonicalize_arguments(["-DY=2", "-I", "/a", "-Wall", "-DX", "-std=c++11"])
+    check_equal(a, b)
+
+def test_canonicalize_other_options():
+    # only the last occurrence counts
+    check_equal(canonicalize_arguments(["-Wall", "-x", "c++", "-Wextra", "-Wall"]),
+                ["-x c++", "-Wextra", "-Wall"])
+
+def test_canonicalize_separate_values():
+    # an option and its value count as one
+    check_equal(canonicalize_arguments(["-mllvm", "-a", "-mllvm", "-b", "-Xclang", "-a"]),
+                ["-mllvm -a", "-mllvm -b", "-Xclang -a"])
+    assert canonicalize_arguments(["-mllvm", "-a", "-mllvm", "-b"]) != canonicalize_arguments(["-a", "-mllvm", "-b"])
+
+def test_canonicalize_forced_includes():
+    # the order matters, only the first occurrence of a header counts
+    check_equal(canonicalize_arguments(["-include", "a.h", "-include", "b.h", "-include", "a.h"]),
+                ["-include a.h", "-include b.h"])
+    check_equal(canonicalize_arguments(["-include", "b.h", "-include", "a.h"]),
+                ["-include b.h", "-include a.h"])
+
+def test_canonicalize_dangling_option():
+    # an option missing its value is kept as it is
+    check_equal(canonicalize_arguments(["-Wall", "-D"]), ["-Wall", "-D"])
+    check_equal(canonicalize_arguments(["-I"]), ["-I"])
+    check_equal(canonicalize_arguments(["-DA", "-include"]), ["-DA", "-include"])
+
+def test_canonicalize_non_ascii():
+    check_equal(canonicalize_arguments([u"-I/home/j\xf6rg", u"-DNAME=\xe9"]),
+                [u"-DNAME=\xe9", u"-I/home/j\xf6rg"])
+
+def make_options(options):
+    opts = CompileOptions(Language(Language.CPP), ["/usr/include"])
+    opts.project_options = options
+    return opts
+
+def test_fingerprint():
+    a = make_options(["-DX", "-I/a", "-DY"])
+    b = make_options(["-DY", "-I", "/a", "-DX"])
+    c = make_options(["-DY", "-I", "/b", "-DX"])
+    check_equal(a.fingerprint(), b.fingerprint())
+    assert a.fingerprint() != c.fingerprint()
+
+def test_fingerprint_non_ascii():
+    a = make_options([u"-I/home/j\xf6rg", u"-DNAME=\xe9"])
+    b = make_options([u"-DNAME=\xe9", u"-I/home/j\xf6rg"])
+    check_equal(a.fingerprint(), b.fingerprint())
+
+# stands in for a translation unit parsed by libclang.
+class FakeTranslationUnit(object):
+    def __init__(self, filename, opts, unsaved_files=[]):
+        self.filename      = filename
+        self.opts          = opts
+        self.fingerprint   = opts.fingerprint()
+        self.unsaved_files = list(unsaved_files)
+        self.memory_usage  = 0
+        self.last_used     = 0
+        self.from_disk     = False
+        self.dirty         = len(unsaved_files) > 0
+        self.preamble      = None
+        self.includes      = set()
+        self.reparses      = [] # the unsaved files of each reparse
+
+    def touch(self):
+        pass
+
+    def reparse(self, unsaved_files):
+        self.reparses.append(list(unsaved_files))
+        self.unsaved_files = list(unsaved_files)
+
+# a cache that parses into FakeTranslationUnits and runs the tasks
+# it schedules when asked to instead of on its worker threads.
+class FakeCache(TranslationUnitCache):
+    def __init__(self):
+        TranslationUnitCache.__init__(self, 1)
+        self.index     = "index"
+        self.scheduled = []
+        self.parses    = []
+
+    def schedule(self, task, data, key=None, priority=TaskPriority.VISIBLE):
+        future = Future()
+        self.scheduled.append((task, data, future))
+        return future
+
+    def promote(self, key, priority):
+        pass
+
+    def set_status(self, msg):
+        pass
+
+    def run_scheduled(self):
+        while len(self.scheduled):
+            task, data, future = self.scheduled.pop(0)
+            future.set_result(task(data))
+
+    def _TranslationUnitCache__parse(self, filename, opts, args, unsaved_files, use_disk_cache):
+        self.parses.append(filename)
+        return FakeTranslationUnit(filename, opts, unsaved_files)
+
+    def add(self, tu):
+        self.translationUnits.lock()[tu.filename] = tu
+        self.translationUnits.unlock()
+        self._TranslationUnitCache__track(tu)
+
+def test_file_changed_keeps_unsaved_files():
+    cache = FakeCache()
+    opts = make_options([])
+    header = os.path.abspath("header.h")
+    tu = FakeTranslationUnit("source.cpp", opts, [("source.cpp", "edited"), (header, "old")])
+    tu.includes = set([header])
+    cache.add(tu)
+
+    # the dependent is reparsed with its own buffer, not the file on
+    # the disk, and the saved header is read from the disk.
+    cache.file_changed(header)
+    cache.run_scheduled()
+    check_equal(tu.reparses, [[("source.cpp", "edited")]])
+    check_equal(cache.parses, [])
+def test_reparse_coalesced():
+    cache = FakeCache()
+    opts = make_options([])
+    tu = FakeTranslationUnit("test.cpp", opts)
+    cache.add(tu)
+    done = []
+
+    # the requests made before the reparse starts are merged into one,
+    # the latest unsaved files win and only the latest caller is told.
+    first  = cache.reparse("test.cpp", opts, [("test.cpp", "one")], lambda: done.append(1))
+    second = cache.reparse("test.cpp", opts, [("test.cpp", "two")], lambda: done.append(2))
+    assert first is second
+    check_equal(len(cache.scheduled), 1)
+    cache.run_scheduled()
+    check_equal(tu.reparses, [[("test.cpp", "two")]])
+    check_equal(done, [2])
+
+    # a request made after the reparse started gets one of its own
+    cache.reparse("test.cpp", opts, [("test.cpp", "three")], lambda: done.append(3))
+    check_equal(len(cache.scheduled), 1)
+    cache.run_scheduled()
+    check_equal(tu.reparses[-1], [("test.cpp", "three")])
+    check_equal(done, [2, 3])
+
+def test_reparse_superseded_while_running():
+    cache = FakeCache()
+    opts = make_options([])
+    tu = FakeTranslationUnit("test.cpp", opts)
+    cache.add(tu)
+    done = []
+
+    # the file is edited again while it's being reparsed
+    reparse = tu.reparse
+    def edited(unsaved_files):
+        reparse(unsaved_files)
+        if len(tu.reparses) == 1:
+            cache.reparse("test.cpp", opts, [("test.cpp", "two")], lambda: done.append(2))
+    tu.reparse = edited
+
+    cache.reparse("test.cpp", opts, [("test.cpp", "one")], lambda: done.append(1))
+    cache.run_scheduled()
+    check_equal(tu.reparses, [[("test.cpp", "one")], [("test.cpp", "two")]])
+    check_equal(done, [2])
+
+def test_reparse_refresh_keeps_request():
+    cache = FakeCache()
+    opts = make_options([])
+    tu = FakeTranslationUnit("test.cpp", opts)
+    cache.add(tu)
+    done = []
+
+    # a refresh of the file from the disk doesn't replace the edits of
+    # the pending interactive request or keep its caller from being told.
+    future = cache.reparse("test.cpp", opts, [("test.cpp", "edited")], lambda: done.append(1))
+    assert cache.reparse("test.cpp", make_options(["-DX"]), [], None, TaskPriority.BACKGROUND, True) is future
+    check_equal(len(cache.scheduled), 1)
+    cache.run_scheduled()
+    check_equal(tu.reparses, [[("test.cpp", "edited")]])
+    check_equal(done, [1])
+# add translation units last used in the order given.
+def add_used(cache, filenames, memory_usage=0):
+    opts = make_options([])
+    for i, filename in enumerate(filenames):
+        tu = FakeTranslationUnit(filename, opts)
+        tu.last_used = i + 1
+        tu.memory_usage = memory_usage
+        cache.add(tu)
+
+def get_cached(cache):
+    tus = cache.translationUnits.lock()
+    ret = sorted(tus.keys())
+    cache.translationUnits.unlock()
+    return ret
+
+def test_evict_closed_first():
+    cache = FakeCache()
+    add_used(cache, ["a.cpp", "c.cpp", "b.cpp", "d.cpp"])
+    cache.set_file_open("a.cpp", True)
+    cache.set_file_open("d.cpp", True)
+
+    # the closed files go first, the least recently used of them first
+    cache.set_limits(3, 0)
+    check_equal(get_cached(cache), ["a.cpp", "b.cpp", "d.cpp"])
+    cache.set_limits(2, 0)
+    check_equal(get_cached(cache), ["a.cpp", "d.cpp"])
+
+    # and then the open ones
+    cache.set_limits(1, 0)
+    check_equal(get_cached(cache), ["d.cpp"])
+
+def test_evict_memory():
+    cache = FakeCache()
+    add_used(cache, ["a.cpp", "b.cpp", "c.cpp"], 10)
+    cache.set_limits(0, 30)
+    check_equal(get_cached(cache), ["a.cpp", "b.cpp", "c.cpp"])
+    cache.set_limits(0, 25)
+    check_equal(get_cached(cache), ["b.cpp", "c.cpp"])
+
+def test_evict_keeps_used_files():
+    cache = FakeCache()
+    add_used(cache, ["a.cpp", "b.cpp"])
+    tu = FakeTranslationUnit("c.cpp", make_options([]))
+    tu.last_used = 3
+    tu.includes = set(["c.h"])
+    cache.add(tu)
+    pl = cache.parsingList.lock()
+    pl.append("a.cpp")
+    cache.parsingList.unlock()
+
+    # the file being parsed and the one to keep stay even over the limit
+    cache.maxCount = 1
+    cache._TranslationUnitCache__evict("b.cpp")
+    check_equal(get_cached(cache), ["a.cpp", "b.cpp"])
+    # and the evicted one no longer depends on its headers
+    assert "c.h" not in cache.dependents
+
+# a cache whose parse waits until it's let to finish.
+class SlowCache(FakeCache):
+    def __init__(self):
+        FakeCache.__init__(self)
+        self.started  = threading.Event()
+        self.finish   = threading.Event()
+
+    def _TranslationUnitCache__parse(self, filename, opts, args, unsaved_files, use_disk_cache):
+        self.started.set()
+        self.finish.wait(5)
+        return FakeCache._TranslationUnitCache__parse(self, filename, opts, args, unsaved_files, use_disk_cache)
+
+def wait_for(condition):
+    end = time.time() + 5
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+def test_single_flight_parse():
+    cache = SlowCache()
+    opts = make_options([])
+    stats.clear()
+    results = []
+    def get():
+        results.append(cache.get_translation_unit("test.cpp", opts))
+    first = threading.Thread(target=get)
+    first.start()
+    assert cache.started.wait(5)
+
+    # the second caller waits for the parse that's already going on
+    second = threading.Thread(target=get)
+    second.start()
+    assert wait_for(lambda: stats.as_dict()["counters"].get("joined_parses") == 1)
+    cache.finish.set()
+    first.join(5)
+    second.join(5)
+    check_equal(cache.parses, ["test.cpp"])
+    check_equal(len(results), 2)
+    assert results[0] is results[1]
+    check_equal(stats.as_dict()["counters"]["misses"], 1)
+
+    # and the file is in the cache from then on
+    assert cache.get_translation_unit("test.cpp", opts) is results[0]
+    check_equal(cache.parses, ["test.cpp"])
+
+# makes the options of a file from its project file, counts the calls.
+class FakeOptions(object):
+    def __init__(self):
+        self.created = []
+        self.includes = Future()
+        self.includes.set_result(["/usr/include"])
+
+    def create(self, view, filename, language):
+        self.created.append(filename)
+        opts = CompileOptions(language, [])
+        opts.project_file = find_project_file(filename) or ""
+        return opts
+
+    def system_includes(self, language):
+        return self.includes
+
+def test_compile_options_project_change():
+    tmp = tempfile.mkdtemp()
+    try:
+        project_file = os.path.join(tmp, "test.sublime-project")
+        open(project_file, "w").close()
+        filename = os.path.join(tmp, "test.cpp")
+        options = FakeOptions()
+        cache = CompileOptionsCache(options.create, options.system_includes)
+        opts = cache.get(None, filename, Language(Language.CPP))
+        check_equal(opts.project_file, os.path.normpath(project_file))
+        assert cache.get(None, filename, Language(Language.CPP)) is opts
+        check_equal(len(options.created), 1)
+
+        # the options of each language are kept
+        cache.get(None, filename, Language(Language.C))
+        check_equal(len(options.created), 2)
+
+        # an edited project file makes them again
+        mtime = os.path.getmtime(project_file) + 10
+        os.utime(project_file, (mtime, mtime))
+        assert cache.get(None, filename, Language(Language.CPP)) is not opts
+        check_equal(len(options.created), 3)
+        cache.get(None, filename, Language(Language.CPP))
+        check_equal(len(options.created), 3)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_compile_options_clear():
+    options = FakeOptions()
+    cache = CompileOptionsCache(options.create, options.system_includes)
+    cache.get(None, "test.cpp", Language(Language.CPP))
+    cache.get(None, "other.cpp", Language(Language.CPP))
+    cache.forget("test.cpp", Language(Language.CPP))
+    cache.get(None, "test.cpp", Language(Language.CPP))
+    cache.get(None, "other.cpp", Language(Language.CPP))
+    check_equal(options.created, ["test.cpp", "other.cpp", "test.cpp"])
+
+    # the settings changed
+    cache.clear()
+    cache.get(None, "test.cpp", Language(Language.CPP))
+    cache.get(None, "other.cpp", Language(Language.CPP))
+    check_equal(len(options.created), 5)
+
+def test_compile_options_pending_system_includes():
+    options = FakeOptions()
+    options.includes = Future()
+    cache = CompileOptionsCache(options.create, options.system_includes)
+
+    # the options without the system includes aren't kept
+    cache.get(None, "test.cpp", Language(Language.CPP))
+    cache.get(None, "test.cpp", Language(Language.CPP))
+    check_equal(len(options.created), 2)
+
+    options.includes.set_result(["/usr/include"])
+    cache.get(None, "test.cpp", Language(Language.CPP))
+    cache.get(None, "test.cpp", Language(Language.CPP))
+    check_equal(len(options.created), 3)
+
+
+if __name__ == "__main__":
+    run([test_canonicalize_defines,
+         test_canonicalize_include_paths,
+         test_canonicalize_same_configuration,
+         test_canonicalize_other_options,
+         test_canonicalize_separate_values,
+         test_canonicalize_forced_includes,
+         test_canonicalize_dangling_option,
+         test_canonicalize_non_ascii,
+         test_fingerprint,
+         test_fingerprint_non_ascii,
+         test_file_changed_keeps_unsaved_files,
+         test_reparse_coalesced,
+         test_reparse_superseded_while_running,
+         test_reparse_refresh_keeps_request,
+         test_evict_closed_first,
+         test_evict_memory,
+         test_evict_keeps_used_files,
+         test_single_flight_parse,
+         test_compile_options_project_change,
+         test_compile_options_clear,
+         test_compile_options_pending_system_includes])